@@ -9,6 +9,7 @@ from qlib.data.dataset.handler import DataHandlerLP
 from qlib.workflow import R
 from qlib.workflow.record_temp import SignalRecord, PortAnaRecord
 from qlib.data import D
+from regime import get_market_regime
 
 def load_config(path="config.yaml"):
     with open(path, "r") as f:
@@ -34,37 +35,6 @@ def get_momentum_signal(instruments, start_time, end_time):
     df['momentum'] = df['return_20d']
     return df[['momentum']]
 
-def get_market_regime(benchmark, start_time, end_time):
-    # 3-State Regime detection using MA20 and MA60
-    # Uptrend (1): Price > MA60 AND MA20 > MA60
-    # Downtrend (-1): Price < MA60 AND MA20 < MA60
-    # Choppy (0): Everything else
-    
-    fields = ["$close", "Mean($close, 60)", "Mean($close, 20)"]
-    names = ["close", "ma60", "ma20"]
-    df = D.features([benchmark], fields, start_time=start_time, end_time=end_time)
-    df.columns = names
-    
-    # Logic
-    df['regime'] = 0 # Default to Choppy
-    
-    uptrend_mask = (df['close'] > df['ma60']) & (df['ma20'] > df['ma60'])
-    downtrend_mask = (df['close'] < df['ma60']) & (df['ma20'] < df['ma60'])
-    
-    df.loc[uptrend_mask, 'regime'] = 1
-    df.loc[downtrend_mask, 'regime'] = -1
-    
-    # Handle index
-    df_reset = df.reset_index()
-    if 'datetime' in df_reset.columns:
-        df_reset = df_reset.set_index('datetime')
-    
-    regime = df_reset['regime']
-    if isinstance(regime.index, pd.DatetimeIndex) or 'datetime' in regime.index.names:
-         regime = regime[~regime.index.duplicated(keep='last')]
-         
-    return regime
-
 import lightgbm as lgb
 
 def run_adaptive_strategy():
@@ -111,28 +81,20 @@ def run_adaptive_strategy():
 
 # ... Imports ...
 from qlib.contrib.data.handler import Alpha158
-
-class CustomHandler(Alpha158):
-    def get_feature_config(self):
-        # Alpha158 returns a tuple: (fields, names)
-        # fields is a list or tuple of strings (expressions)
-        # names is a list or tuple of strings (column names)
-        base_conf = super().get_feature_config()
-        fields = list(base_conf[0])
-        names = list(base_conf[1])
-        
-        # Add Distance from MA features
-        new_fields = [
-            "($close - Mean($close, 10)) / Mean($close, 10)",
-            "($close - Mean($close, 20)) / Mean($close, 20)",
-            "($close - Mean($close, 60)) / Mean($close, 60)",
-        ]
-        new_names = ["DIST_MA10", "DIST_MA20", "DIST_MA60"]
-        
-        fields.extend(new_fields)
-        names.extend(new_names)
-        
-        return (fields, names)
+from qlib.data.dataset import DatasetH
+from handlers import DIST_MA_FIELDS, DIST_MA_NAMES
+from moe_data import ExtendedDatasetH, RegimePartitionedView
+from feature_store import FeatureStore
+from experts import train_experts, predict_by_regime
+from lgb_cache import BinnedDatasetCache
+from compact_signal import CompactSignal
+from walk_forward import walk_forward_predict
+from daily_run import save_bundle
+from data_quality import DataQuality, DEFAULT_PARAMS
+from memory_budget import MemoryBudget, release_data_keys
+from stream_inference import predict_streaming
+from panel import Panel
+from ooc_training import train_experts_ooc
 
 import lightgbm as lgb
 
@@ -144,40 +106,24 @@ def run_adaptive_strategy():
     benchmark = config['benchmark']
     data_handler_config = config['data_handler_config']
     
+    segments = {
+        "train": [data_handler_config['fit_start_time'], data_handler_config['fit_end_time']],
+        "valid": ["2021-01-01", "2021-12-31"],
+        "test": [config['port_analysis_config']['backtest']['start_time'], config['port_analysis_config']['backtest']['end_time']],
+    }
+    
     # 1. Standard Dataset (for Uptrend/Downtrend) - Original Alpha158
-    dataset_config_std = {
-        "class": "DatasetH",
-        "module_path": "qlib.data.dataset",
-        "kwargs": {
-            "handler": {
-                "class": "Alpha158",
-                "module_path": "qlib.contrib.data.handler",
-                "kwargs": data_handler_config,
-            },
-            "segments": {
-                "train": [data_handler_config['fit_start_time'], data_handler_config['fit_end_time']],
-                "valid": ["2021-01-01", "2021-12-31"],
-                "test": [config['port_analysis_config']['backtest']['start_time'], config['port_analysis_config']['backtest']['end_time']],
-            },
-        },
+    handler_config_std = {
+        "class": "Alpha158",
+        "module_path": "qlib.contrib.data.handler",
+        "kwargs": data_handler_config,
     }
     
-    # 2. Choppy Dataset (Extra Features)
-    dataset_config_choppy = {
-        "class": "DatasetH",
-        "module_path": "qlib.data.dataset",
-        "kwargs": {
-            "handler": {
-                "class": "CustomHandler", # Use our custom class defined above
-                "module_path": "adaptive_strategy", # This file
-                "kwargs": data_handler_config,
-            },
-            "segments": {
-                "train": [data_handler_config['fit_start_time'], data_handler_config['fit_end_time']],
-                "valid": ["2021-01-01", "2021-12-31"],
-                "test": [config['port_analysis_config']['backtest']['start_time'], config['port_analysis_config']['backtest']['end_time']],
-            },
-        },
+    # 2. Choppy Dataset (Extra Features) - Alpha158 + DIST_MA, layered on the SAME Alpha158 handler
+    extension_config_choppy = {
+        "class": "FeatureExtensionHandler",
+        "module_path": "handlers",
+        "kwargs": {"fields": DIST_MA_FIELDS, "names": DIST_MA_NAMES, **data_handler_config},
     }
     
     # LightGBM Params (Standard)
@@ -203,177 +149,209 @@ def run_adaptive_strategy():
     lgb_params_choppy['max_depth'] = 5
     lgb_params_choppy['num_leaves'] = 31 # 2^5 - 1 roughly
 
+    # Walk-forward retraining (walk_forward.py); off by default
+    wf_config = config.get('walk_forward', {})
+
+    # Memory-budget mode (memory_budget.py): float32 frames, early release, per-stage peak RSS; off by default
+    memory = MemoryBudget(**config.get('memory', {}))
+
     print("Backtesting Mixture of Experts (MoE) Strategy...")
     with R.start(experiment_name="moe_strategy"):
         recorder = R.get_recorder()
         
         # Initialize Datasets
+        # Alpha158 is computed once and shared; the Choppy dataset only adds the DIST_MA columns on top.
+        # Processed frames are cached on disk keyed by config + data snapshot (see feature_store.py).
+        memory.stage("features")
+        store = FeatureStore(**config.get('feature_store', {}), dtype=memory.dtype)
         print("Initializing Standard Dataset...")
-        dataset_std = init_instance_by_config(dataset_config_std)
+        handler_std = store.load_or_build(handler_config_std)
+        dataset_std = DatasetH(handler=handler_std, segments=segments)
         
         print("Initializing Choppy Dataset (Enhanced)...")
-        # We need to register the class if it's dynamic, OR just use the class object in config if run locally.
-        # But Qlib expects module_path. 
-        # Trick: Pass the CLASS directly if using internal init, but config dict usually requires strings.
-        # Since we are running this script, "adaptive_strategy" is __main__ or the file name.
-        # Let's try "sys.modules[__name__]" approach or just simpler:
-        # We can substitute the "class" string with the actual class object in the config 
-        # IF we use 'init_instance_by_config' it might fail if it tries to import string.
-        # HACK: Modify init keys after config load or use the object directly.
-        # Actually simplest is to define CustomHandler in a separate file, BUT I want to keep it self-contained.
-        # Let's use `adaptive_strategy.CustomHandler` assuming this file is importable? 
-        # If run as script, module is __main__.
-        
-        # Workaround: Manually init the handler and dataset.
-        from qlib.data.dataset import DatasetH
-        handler_choppy = CustomHandler(**data_handler_config)
-        dataset_choppy = DatasetH(handler=handler_choppy, segments=dataset_config_choppy['kwargs']['segments'])
+        handler_ext = store.load_or_build(extension_config_choppy)
+        dataset_choppy = ExtendedDatasetH(handler=handler_std, segments=segments, extensions=[handler_ext])
+
+        # Label of the test segment (Required for PortAnaRecord), taken before the frames are released
+        label_df = dataset_std.prepare("test", col_set="label")
+        if isinstance(label_df, pd.Series):
+             label_df = label_df.to_frame()
+
+        if memory.enabled:
+            # From here on only DK_L of Alpha158 and DK_I of the extension are read
+            release_data_keys(handler_std, keep=[DataHandlerLP.DK_L])
+            release_data_keys(handler_ext, keep=[DataHandlerLP.DK_I])
+
+        memory.stage("data quality")
+        # Data-quality ban list + exclusion mask, scanned once per data snapshot and cached (data_quality.py)
+        dq_config = dict(config.get('data_quality', {}))
+        quality = None
+        # Excluded rows (e.g. labels across an implausible jump) are left out of the expert fits; scanned
+        # over the fit window only (no hindsight from the valid / test years)
+        exclude = DataQuality.training_filter(dq_config, data_handler_config)
+        if dq_config.pop('enabled', True):
+            dq_config.pop('filter_training', None)
+            quality = DataQuality.load_or_scan(data_handler_config['instruments'], data_handler_config['start_time'],
+                                               data_handler_config['end_time'], **dq_config)
+            print(quality.summary())
 
-        
         # Get Regime for Training Data
         print(f"Detecting Regimes for Training Data ({benchmark})...")
+        # One benchmark query for the whole run; train/test labels are slices of the same series
         train_start = data_handler_config['fit_start_time']
         train_end = data_handler_config['fit_end_time']
-        train_regime = get_market_regime(benchmark, train_start, train_end)
+        test_start = config['port_analysis_config']['backtest']['start_time']
+        test_end = config['port_analysis_config']['backtest']['end_time']
+        full_regime = get_market_regime(benchmark, min(train_start, test_start), max(train_end, test_end))
+        train_regime = full_regime.loc[train_start:train_end]
         
-        models = {}
-        dataset_map = {
-            1: dataset_std,
-            -1: dataset_std,
-            0: dataset_choppy
-        }
         params_map = {
             1: lgb_params_std,
             -1: lgb_params_std,
             0: lgb_params_choppy
         }
-        
-        for regime_val, regime_name in [(1, 'Uptrend'), (0, 'Choppy'), (-1, 'Downtrend')]:
-            print(f"Training {regime_name} Model...")
-            
-            ds = dataset_map[regime_val]
-            params = params_map[regime_val]
-            
-            regime_dates = train_regime[train_regime == regime_val].index
-            
-            train_df = ds.prepare("train", col_set=["feature", "label"], data_key=DataHandlerLP.DK_L)
-            subset_df = train_df.loc[train_df.index.get_level_values('datetime').isin(regime_dates)]
-            
-            if subset_df.empty:
-                print(f"Warning: No data for {regime_name} regime. Skipping training.")
-                models[regime_val] = None
-                continue
-                
-            x_train = subset_df['feature']
-            y_train = subset_df['label']
-            
-            valid_df = ds.prepare("valid", col_set=["feature", "label"], data_key=DataHandlerLP.DK_L)
-            x_valid = valid_df['feature']
-            y_valid = valid_df['label']
-            
-            model = lgb.LGBMRegressor(**params)
-            
-            callbacks = [lgb.early_stopping(stopping_rounds=50, verbose=False), lgb.log_evaluation(period=0)]
-            
-            model.fit(
-                x_train, y_train,
-                eval_set=[(x_valid, y_valid)],
-                eval_metric="mse",
-                callbacks=callbacks
-            )
-            
-            models[regime_val] = model
-            print(f"{regime_name} Model Trained.")
 
-        # Inference
-        print("Running Inference...")
-        test_start = config['port_analysis_config']['backtest']['start_time']
-        test_end = config['port_analysis_config']['backtest']['end_time']
-        
-        test_regime = get_market_regime(benchmark, test_start, test_end)
-        
-        # Prepare Test Dataframes
-        test_df_std = dataset_std.prepare("test", col_set=["feature", "label"], data_key=DataHandlerLP.DK_L)
-        test_df_choppy = dataset_choppy.prepare("test", col_set=["feature", "label"], data_key=DataHandlerLP.DK_L)
-        
-        x_test_std = test_df_std['feature']
-        x_test_choppy = test_df_choppy['feature']
-        
-        predictions = []
+        memory.stage("training")
+        if wf_config.get('enabled', False):
+            # Walk-forward: experts are warm-started fold by fold, out-of-sample scores only
+            print(f"Walk-Forward Training ({wf_config.get('window', 'expanding')} window, "
+                  f"every {wf_config.get('cadence_months', 3)} months)...")
+            wf_kwargs = {k: v for k, v in wf_config.items() if k != 'enabled'}
+            final_series, models = walk_forward_predict(
+                {1: dataset_std, -1: dataset_std, 0: dataset_choppy}, params_map, full_regime, segments,
+                exclude=exclude, prepare=memory.prepare, **wf_kwargs
+            )
+            test_start = final_series.index.get_level_values('datetime').min()
+            test_regime = full_regime.loc[test_start:test_end]
+        else:
+            # Each segment is prepared once per dataset and split by regime with precomputed row positions
+            view_std = RegimePartitionedView(dataset_std, train_regime, name="std", exclude=exclude,
+                                             prepare=memory.prepare)
+            view_choppy = RegimePartitionedView(dataset_choppy, train_regime, name="choppy", exclude=exclude,
+                                                prepare=memory.prepare)
+            view_map = {
+                1: view_std,
+                -1: view_std,
+                0: view_choppy
+            }
         
-        for regime_val, model in models.items():
-            if model is None: 
-                continue
-                
-            # Use correct input
-            if regime_val == 0:
-                x_in = x_test_choppy
+            # Serial by default; `training.parallel_experts` trains the three experts concurrently
+            # in worker processes sharing one `training.n_jobs` thread budget.
+            training_config = config.get('training', {})
+            lgb_cache_path = training_config.get('lgb_dataset_cache')
+            ooc_config = training_config.get('out_of_core', {})
+            if ooc_config.get('enabled', False):
+                # Out-of-core: LightGBM datasets streamed from date-chunked feature files (ooc_training.py)
+                models = train_experts_ooc(
+                    {1: dataset_std, -1: dataset_std, 0: dataset_choppy}, params_map, train_regime,
+                    path=ooc_config.get('path', 'ooc_chunks'), chunk_months=ooc_config.get('chunk_months', 12),
+                    batch_rows=ooc_config.get('batch_rows', 65536), exclude=exclude,
+                )
             else:
-                x_in = x_test_std
-                
-            pred = model.predict(x_in)
-            pred_series = pd.Series(pred, index=x_in.index)
-            pred_series.name = regime_val 
-            predictions.append(pred_series)
-            
-        combined_pred = pd.concat(predictions, axis=1) # Columns: 1, 0, -1
-        
-        # Join with Test Regime
-        test_regime_reindexed = test_regime.reindex(combined_pred.index.get_level_values('datetime'))
-        
-        final_series = pd.Series(index=combined_pred.index, dtype=float)
+                models = train_experts(
+                    view_map, params_map,
+                    parallel=training_config.get('parallel_experts', False),
+                    n_jobs=training_config.get('n_jobs', lgb_params_std['n_jobs']),
+                    cache=BinnedDatasetCache(lgb_cache_path) if lgb_cache_path else None,
+                )
+
+            # Training frames are no longer needed
+            view_std.release()
+            view_choppy.release()
+
+            # Inference
+            memory.stage("inference")
+            print("Running Inference...")
+            test_regime = full_regime.loc[test_start:test_end]
         
-        for r_val in [-1, 0, 1]:
-            if r_val in combined_pred.columns:
-                mask = (test_regime_reindexed.values == r_val)
-                final_series[mask] = combined_pred[r_val][mask]
-                
+            # Each expert predicts only the rows of its own regime, straight into one score array
+            inference_config = config.get('inference', {})
+            if inference_config.get('chunk_months'):
+                # Streaming: the test segment is prepared chunk by chunk (thread pool prefetch), so only
+                # a few chunks of features are ever in memory
+                final_series = predict_streaming(
+                    models, {1: dataset_std, -1: dataset_std, 0: dataset_choppy}, test_regime, "test",
+                    chunk_months=inference_config['chunk_months'], prefetch=inference_config.get('prefetch', 1),
+                    prepare=memory.prepare, panel=inference_config.get('panel', True),
+                )
+            else:
+                # Prepare Test Dataframes
+                test_df_std = memory.prepare(dataset_std, "test", col_set=["feature", "label"],
+                                             data_key=DataHandlerLP.DK_L, name="std_test")
+                test_df_choppy = memory.prepare(dataset_choppy, "test", col_set=["feature", "label"],
+                                                data_key=DataHandlerLP.DK_L, name="choppy_test")
+
+                x_test_std = test_df_std['feature']
+                x_test_choppy = test_df_choppy['feature']
+                if inference_config.get('panel', True):
+                    x_test_std, x_test_choppy = Panel.from_frame(x_test_std), Panel.from_frame(x_test_choppy)
+
+                final_series = predict_by_regime(models, {1: x_test_std, -1: x_test_std, 0: x_test_choppy}, test_regime)
+                del test_df_std, test_df_choppy, x_test_std, x_test_choppy
+
+        if memory.enabled:
+            # Scores are in; no handler frame is read again
+            release_data_keys(handler_std)
+            release_data_keys(handler_ext)
+
+        cash_threshold = 0.0
+
+        # Experts + feature expressions + fitted processors for the incremental daily run (daily_run.py)
+        daily_config = config.get('daily_run', {})
+        if daily_config.get('bundle_path'):
+            save_bundle(daily_config['bundle_path'], models, handler_std, handler_ext,
+                        instruments=data_handler_config['instruments'], benchmark=benchmark, cash_threshold=cash_threshold,
+                        banned=quality.banned_instruments() if quality is not None else [],
+                        quality_params={k: v for k, v in dq_config.items() if k in DEFAULT_PARAMS})
+
         final_series = final_series.fillna(-999.0)
+        # Scores before the cash logic (strategy_sweep.py can sweep the threshold on these)
+        raw_series = final_series.copy()
         
         # Cash Logic
-        print("Applying Cash Logic (Score < 0)...")
-        final_series[final_series < 0] = -999.0
+        print(f"Applying Cash Logic (Score < {cash_threshold})...")
+        final_series[final_series < cash_threshold] = -999.0
         
         combined = final_series.to_frame('final_score')
         
         # --- DATA FILTER ---
-        print("Applying Data Quality Filter (Close > 0.01)...")
-        comb_insts = combined.index.get_level_values('instrument').unique().tolist()
-        comb_dates = combined.index.get_level_values('datetime').unique()
-        start_date = comb_dates.min()
-        end_date = comb_dates.max()
-        
-        prices = D.features(comb_insts, ['$close'], start_time=start_date, end_time=end_date)
-        prices.columns = ['close']
-        
-        combined = combined.join(prices, how='left')
-        
-        bad_rows = combined[combined['close'] <= 0.01]
-        bad_instruments = bad_rows.index.get_level_values('instrument').unique()
-        
-        if len(bad_instruments) > 0:
-            print(f"Banning {len(bad_instruments)} instruments with corrupted data: {bad_instruments.tolist()}")
-            combined = combined[~combined.index.get_level_values('instrument').isin(bad_instruments)]
-        else:
-            print("No instruments banned.")
+        # Point-in-time exclusion mask of the data snapshot (data_quality.py): only what was known on each
+        # date (the ban list and the label-based exclusions look ahead, they only filter training rows).
+        # Looked up through the prediction's index codes: no price reload, no join
+        if quality is not None:
+            print("Applying Data Quality Filter...")
+            excluded = quality.excluded(combined.index, point_in_time=True)
+            print(f"Excluding {int(excluded.sum())} of {len(combined)} prediction rows")
+            combined = combined[~excluded]
         
         final_pred = combined[['final_score']]
         final_pred.columns = ['score']
         
         # Save Prediction
-        R.save_objects(**{"pred.pkl": final_pred})
+        # Compact per-date signal: only the names the strategy may buy (score above the cash threshold),
+        # sorted by score; TopKSkipStrategy reads it natively through PortAnaRecord's <PRED>
+        signal = CompactSignal.from_scores(final_pred['score'], min_score=cash_threshold)
+        print(f"Compact signal: {len(signal)} of {len(final_pred)} rows eligible")
+        R.save_objects(**{"pred.pkl": signal})
+        R.save_objects(**{"raw_pred.pkl": CompactSignal.from_scores(raw_series.reindex(final_pred.index))})
+        
+        # Save Regime (the dashboard export reuses these exact labels)
+        R.save_objects(**{"regime.pkl": test_regime})
 
-        # Save Label (Required for PortAnaRecord)
-        # We need the label for the test segment
-        label_df = dataset_std.prepare("test", col_set="label")
-        if isinstance(label_df, pd.Series):
-             label_df = label_df.to_frame()
+        # Save Label (prepared above)
+        label_df = label_df.loc[pd.Timestamp(test_start):]
         R.save_objects(**{"label.pkl": label_df})
         
         # Run Portfolio Analysis
         port_analysis_config = config['port_analysis_config']
+        if wf_config.get('enabled', False):
+            # Backtest only the out-of-sample folds
+            port_analysis_config['backtest']['start_time'] = str(pd.Timestamp(test_start).date())
+        memory.stage("backtest")
         par = PortAnaRecord(recorder, port_analysis_config, "day")
         par.generate()
+        memory.report()
+        memory.cleanup()
         
         print(f"Adaptive Strategy Finished. Results in: {recorder.get_local_dir()}")
 
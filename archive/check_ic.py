@@ -4,6 +4,11 @@ import os
 from qlib.data import D
 import qlib
 
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from ic_engine import evaluate
+from compact_signal import load_pred
+
 def check_ic():
     # Initialize Qlib (Minimal)
     qlib.init(provider_uri=r"C:\Users\wuwei\.qlib\qlib_data\cn_data", region="cn") # Default, just need libs
@@ -24,7 +29,7 @@ def check_ic():
         print("Predictions or Labels not found.")
         return
 
-    pred = pd.read_pickle(pred_path)
+    pred = load_pred(pred_path)
     label = pd.read_pickle(label_path)
     
     # Ensure index alignment
@@ -45,22 +50,17 @@ def check_ic():
     
     print(f"Training Period Data Points: {len(df_train)}")
     
-    # Calculate IC (Rank Correlation)
-    # Group by Date, then correlation
-    def calc_ic(g):
-        return g['score'].corr(g['return'], method='pearson') # Pearson or Spearman
-        
-    def calc_rank_ic(g):
-        return g['score'].corr(g['return'], method='spearman')
-    
-    daily_ic = df_train.groupby(level='datetime').apply(calc_ic)
-    daily_rank_ic = df_train.groupby(level='datetime').apply(calc_rank_ic)
+    # Calculate IC (Pearson) and Rank IC (Spearman) per date, all dates in one pass
+    daily, summary = evaluate(df_train['score'], df_train['return'])
+    daily_rank_ic = daily['rank_ic']
     
     print(f"\n--- IC Analysis (2010-2020) ---")
-    print(f"Mean Pearson IC: {daily_ic.mean():.4f}")
-    print(f"Mean Rank IC (Information Coefficient): {daily_rank_ic.mean():.4f}")
-    print(f"ICStd: {daily_ic.std():.4f}")
-    print(f"ICIR (IC / Std): {daily_ic.mean() / daily_ic.std():.4f}")
+    print(f"Mean Pearson IC: {summary['IC']:.4f}")
+    print(f"Mean Rank IC (Information Coefficient): {summary['Rank IC']:.4f}")
+    print(f"ICStd: {summary['ICStd']:.4f}")
+    print(f"ICIR (IC / Std): {summary['ICIR']:.4f}")
+    print(f"Rank ICIR: {summary['Rank ICIR']:.4f}")
+    print(f"Top-Bottom Quintile Spread (daily mean): {summary['Spread']:.6f}")
     
     print("\n--- Interpretation ---")
     if daily_rank_ic.mean() > 0:
@@ -4,6 +4,10 @@ import json
 import os
 import glob
 
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from compact_signal import load_pred
+
 def diagnose():
     print("Loading data...")
     # Load Dashboard Data for Equity Curve
@@ -71,7 +75,7 @@ def diagnose():
     # Let's try to load pred.pkl
     try:
         pred_path = os.path.join(latest_run, "pred.pkl")
-        pred = pd.read_pickle(pred_path)
+        pred = load_pred(pred_path)
         print("Predictions loaded successfully.")
         print("Score stats:")
         print(pred.describe())
@@ -7,6 +7,12 @@ from qlib.workflow import R
 from qlib.workflow.record_temp import SignalRecord, PortAnaRecord
 from qlib.utils import exists_qlib_data, flatten_dict
 from qlib.tests.data import GetData
+from qlib.data.dataset import DatasetH
+
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from feature_store import FeatureStore
 
 def load_config(path="config.yaml"):
     with open(path, "r") as f:
@@ -68,7 +74,10 @@ def run_workflow():
         # Train Model
         print("Training model...")
         model = init_instance_by_config(model_config)
-        dataset = init_instance_by_config(dataset_config)
+        # Reuse the processed Alpha158 frames from the feature store when the config/data is unchanged
+        store = FeatureStore(**config.get('feature_store', {}))
+        handler = store.load_or_build(dataset_config['kwargs']['handler'])
+        dataset = DatasetH(handler=handler, segments=dataset_config['kwargs']['segments'])
         model.fit(dataset)
         
         # Prediction
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+from qlib.backtest.signal import Signal
+from custom_strategy import SignalRanking
+
+# Compact per-date signal: only the eligible candidates of each date, stored CSR-style.
+#
+#   rows offsets[d]:offsets[d+1] are the candidates of dates[d], best score first
+#   codes[i] -> instruments[codes[i]], scores[i] -> its score
+#
+# Rows that can never be bought (e.g. scores sent to -999 by the cash logic) are not stored, so the
+# pickled artifact holds a fraction of the full (datetime, instrument) frame. A date's cross-section is
+# an O(1) slice, and TopKSkipStrategy / fast_backtest read the per-date order directly (ranking()),
+# without sorting anything at backtest time.
+#
+#   signal = CompactSignal.from_scores(pred["score"], min_score=0.0)
+#   R.save_objects(**{"pred.pkl": signal})     # PortAnaRecord passes it to the strategy as <PRED>
+
+
+class CompactSignal(Signal):
+    def __init__(self, dates, instruments, offsets, codes, scores):
+        self.dates = pd.DatetimeIndex(dates)
+        self.instruments = np.asarray(instruments, dtype=object)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float64)
+        self._date_pos = None
+
+    @classmethod
+    def from_scores(cls, score, min_score=None):
+        # score: Series / DataFrame (first column) on a (datetime, instrument) index.
+        # Keeps the finite scores >= min_score; ties keep the row order of `score` (as SignalRanking)
+        if isinstance(score, pd.DataFrame):
+            score = score.iloc[:, 0]
+        values = score.to_numpy(dtype=np.float64)
+        keep = np.isfinite(values)
+        if min_score is not None:
+            keep &= values >= min_score
+
+        date_codes, dates = pd.factorize(score.index.get_level_values("datetime"), sort=True)
+        inst_codes, instruments = pd.factorize(score.index.get_level_values("instrument")[keep])
+        date_codes = date_codes[keep]
+        values = values[keep]
+
+        order = np.lexsort((np.arange(len(values)), -values, date_codes))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(date_codes, minlength=len(dates)))])
+        return cls(dates, instruments, offsets, inst_codes[order], values[order])
+
+    def __len__(self):
+        return len(self.codes)
+
+    def date_pos(self, date):
+        # Position of `date` (None if it has no signal); one dict lookup
+        if self._date_pos is None:
+            self._date_pos = {d: i for i, d in enumerate(self.dates)}
+        return self._date_pos.get(pd.Timestamp(date))
+
+    def cross_section(self, date):
+        # Candidates of one date as an instrument-indexed Series, best first (None if no signal that day)
+        di = self.date_pos(date)
+        if di is None:
+            return None
+        lo, hi = self.offsets[di], self.offsets[di + 1]
+        return pd.Series(self.scores[lo:hi], index=pd.Index(self.instruments[self.codes[lo:hi]], name="instrument"))
+
+    def get_signal(self, start_time, end_time):
+        # Signal interface: latest score of each instrument within [start_time, end_time] (as SignalWCache)
+        lo = np.searchsorted(self.dates, pd.Timestamp(start_time), side="left")
+        hi = np.searchsorted(self.dates, pd.Timestamp(end_time), side="right")
+        if hi <= lo:
+            return None
+        if hi - lo == 1:
+            return self.cross_section(self.dates[lo])
+        latest = {}
+        for di in range(lo, hi):
+            s, e = self.offsets[di], self.offsets[di + 1]
+            latest.update(zip(self.instruments[self.codes[s:e]], self.scores[s:e]))
+        return pd.Series(latest, dtype=np.float64).rename_axis("instrument")
+
+    def ranking(self):
+        # SignalRanking over the stored order (rows are already sorted best first)
+        return SignalRanking.from_sorted(self.dates, self.instruments, self.offsets, self.codes)
+
+    @property
+    def index(self):
+        # (datetime, instrument) MultiIndex of the stored rows (e.g. for PortAnaRecord's date range)
+        date_codes = np.repeat(np.arange(len(self.dates)), np.diff(self.offsets))
+        return pd.MultiIndex(levels=[self.dates, pd.Index(self.instruments)], codes=[date_codes, self.codes],
+                             names=["datetime", "instrument"], verify_integrity=False)
+
+    def to_series(self):
+        return pd.Series(self.scores, index=self.index, name="score")
+
+    def to_frame(self):
+        return self.to_series().to_frame()
+
+
+def load_pred(path):
+    # pred.pkl of a recorder run as a (datetime, instrument) frame, compact or not
+    pred = pd.read_pickle(path)
+    if isinstance(pred, CompactSignal):
+        return pred.to_frame()
+    return pred
@@ -1,73 +1,425 @@
 import copy
+import itertools
 import numpy as np
 import pandas as pd
 from qlib.contrib.strategy.signal_strategy import TopkDropoutStrategy
 from qlib.backtest.decision import Order, OrderDir, TradeDecisionWO
+from qlib.backtest.position import Position
+
+
+class SignalRanking:
+    # Per-date candidate lists of a score signal, ranked ONCE for the whole backtest.
+    #
+    # Rows are ordered by (date, score descending); ties keep the signal's row order and NaN scores go last
+    # (as pandas sort_values). Each step reads its date's slice of the ranked array and looks up the rank of
+    # held stocks with a binary search, so the per-step cost depends on topk and not on the universe size.
+    def __init__(self, signal):
+        if isinstance(signal, pd.DataFrame):
+            signal = signal.iloc[:, 0]
+        date_codes, self.dates = pd.factorize(signal.index.get_level_values("datetime"), sort=True)
+        inst_codes, instruments = pd.factorize(signal.index.get_level_values("instrument"))
+        self.names = np.asarray(instruments, dtype=object)
+        self.code_of = {name: i for i, name in enumerate(self.names)}
+
+        score = signal.to_numpy(dtype=np.float64)
+        n = len(score)
+        order = np.lexsort((np.arange(n), -score, date_codes))  # -NaN sorts last
+        counts = np.bincount(date_codes, minlength=len(self.dates))
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+        self.ranked = inst_codes[order]
+
+        # Rank of each row within its date; rows with a NaN score count as unscored (-1)
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.arange(n) - self.offsets[date_codes[order]]
+        rank[np.isnan(score)] = -1
+
+        # Rows of each date sorted by instrument code, for rank lookups
+        by_code = np.lexsort((inst_codes, date_codes))
+        self.lookup_codes = inst_codes[by_code]
+        self.lookup_rank = rank[by_code]
+
+    @classmethod
+    def from_sorted(cls, dates, names, offsets, ranked):
+        # Ranking of per-date rows that are already sorted best first (e.g. a CompactSignal), no re-sort.
+        # ranked: instrument code of each row, offsets: row range of each date
+        self = cls.__new__(cls)
+        self.dates = pd.DatetimeIndex(dates)
+        self.names = np.asarray(names, dtype=object)
+        self.code_of = {name: i for i, name in enumerate(self.names)}
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.ranked = np.asarray(ranked, dtype=np.int64)
+
+        date_codes = np.repeat(np.arange(len(self.dates)), np.diff(self.offsets))
+        rank = np.arange(len(self.ranked)) - self.offsets[date_codes]
+        by_code = np.lexsort((self.ranked, date_codes))
+        self.lookup_codes = self.ranked[by_code]
+        self.lookup_rank = rank[by_code]
+        return self
+
+    @classmethod
+    def from_cross_section(cls, pred_score, time):
+        # Ranking of a single instrument-indexed cross-section
+        if isinstance(pred_score, pd.DataFrame):
+            pred_score = pred_score.iloc[:, 0]
+        return cls(pd.concat({time: pred_score}, names=["datetime", "instrument"]))
+
+    def date_positions(self, start_time, end_time):
+        # Positions of the signal dates within [start_time, end_time]
+        lo = np.searchsorted(self.dates, pd.Timestamp(start_time), side="left")
+        hi = np.searchsorted(self.dates, pd.Timestamp(end_time), side="right")
+        return range(lo, hi)
+
+    def size(self, di):
+        return int(self.offsets[di + 1] - self.offsets[di])
+
+    def iter_names(self, di, start=0, chunk=256):
+        # Instruments of date `di` from rank `start` on, best first
+        lo, hi = self.offsets[di] + start, self.offsets[di + 1]
+        for s in range(lo, hi, chunk):
+            yield from self.names[self.ranked[s:min(s + chunk, hi)]]
+
+    def positions(self, di, names):
+        # Rank of each name on date `di`; -1 if it has no score that day
+        codes = np.array([self.code_of.get(name, -1) for name in names], dtype=np.int64)
+        lo, hi = self.offsets[di], self.offsets[di + 1]
+        if hi == lo:
+            return np.full(len(codes), -1, dtype=np.int64)
+        seg = self.lookup_codes[lo:hi]
+        idx = np.minimum(np.searchsorted(seg, codes), len(seg) - 1)
+        found = (codes >= 0) & (seg[idx] == codes)
+        return np.where(found, self.lookup_rank[lo:hi][idx], -1)
+
+    def order(self, di, names, first=0):
+        # (scored, unscored): names with a rank >= first, best first, and all other names in input order
+        names = np.asarray(list(names), dtype=object)
+        pos = self.positions(di, names)
+        scored = pos >= first
+        return names[scored][np.argsort(pos[scored], kind="stable")], names[~scored]
+
+
+class TradabilityMatrix:
+    # (date x instrument) tradability flags for the whole backtest, built ONCE from the exchange quotes.
+    #
+    # Same rule as Exchange.is_stock_tradable for a single-bar step: a stock is suspended if it has no quote
+    # row that day or its $close is NaN, and blocked for buying / selling by the exchange's limit_buy /
+    # limit_sell columns. Flags are packed in one uint8 per cell: BUY_OK | SELL_OK.
+    BUY_OK = 1
+    SELL_OK = 2
+
+    def __init__(self, quote_df):
+        inst_codes, instruments = pd.factorize(quote_df.index.get_level_values("instrument"))
+        date_codes, self.dates = pd.factorize(quote_df.index.get_level_values("datetime"), sort=True)
+        self.code_of = {name: i for i, name in enumerate(instruments)}
+        self._index_codes = (date_codes, inst_codes)
+
+        active = quote_df["$close"].notna().to_numpy()
+        flags = (
+            (active & ~quote_df["limit_buy"].to_numpy(dtype=bool)) * self.BUY_OK
+            + (active & ~quote_df["limit_sell"].to_numpy(dtype=bool)) * self.SELL_OK
+        ).astype(np.uint8)
+        # One extra column for instruments without quotes (never tradable)
+        self.flags = np.zeros((len(self.dates), len(instruments) + 1), dtype=np.uint8)
+        self.flags[date_codes, inst_codes] = flags
+
+    @classmethod
+    def from_exchange(cls, exchange):
+        # None if the exchange does not expose its quote frame
+        quote_df = getattr(exchange, "quote_df", None)
+        if quote_df is None or not {"$close", "limit_buy", "limit_sell"}.issubset(quote_df.columns):
+            return None
+        return cls(quote_df)
+
+    def date_positions(self, start_time, end_time):
+        lo = np.searchsorted(self.dates, pd.Timestamp(start_time), side="left")
+        hi = np.searchsorted(self.dates, pd.Timestamp(end_time), side="right")
+        return range(lo, hi)
+
+    def tradable(self, di, names, direction=None):
+        # Bool array for `names` on date position `di` (-1: no quotes that day, nothing is tradable).
+        # direction None -> tradable for both buying and selling (as is_stock_tradable)
+        if di < 0:
+            return np.zeros(len(names), dtype=bool)
+        missing = self.flags.shape[1] - 1
+        codes = np.fromiter((self.code_of.get(name, missing) for name in names), dtype=np.int64, count=len(names))
+        if direction is None:
+            need = self.BUY_OK | self.SELL_OK
+        elif direction == OrderDir.BUY:
+            need = self.BUY_OK
+        else:
+            need = self.SELL_OK
+        return (self.flags[di, codes] & need) == need
+
+
+class QuotePanel(TradabilityMatrix):
+    # Tradability flags plus batched deal price / factor lookups from the same exchange quotes.
+    #
+    # Quote rows are kept sorted by (date, instrument code) with per-date offsets (no dense price panel),
+    # so the prices of all buy candidates of a step are one searchsorted + take per field.
+    def __init__(self, quote_df, fields):
+        super().__init__(quote_df)
+        date_codes, inst_codes = self._index_codes
+        order = np.lexsort((inst_codes, date_codes))
+        self.row_codes = inst_codes[order]
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(date_codes, minlength=len(self.dates)))])
+        self.values = {field: quote_df[field].to_numpy(dtype=np.float64)[order] for field in fields}
+
+    @classmethod
+    def from_exchange(cls, exchange):
+        quote_df = getattr(exchange, "quote_df", None)
+        fields = {getattr(exchange, "buy_price", "$close"), getattr(exchange, "sell_price", "$close"), "$close", "$factor"}
+        if quote_df is None or not ({"$close", "limit_buy", "limit_sell"} | fields).issubset(quote_df.columns):
+            return None
+        return cls(quote_df, sorted(fields))
+
+    def get(self, di, names, field):
+        # Values of `field` for `names` on date position `di` (NaN where there is no quote row)
+        res = np.full(len(names), np.nan)
+        if di < 0 or self.offsets[di + 1] == self.offsets[di]:
+            return res
+        lo, hi = self.offsets[di], self.offsets[di + 1]
+        codes = np.fromiter((self.code_of.get(name, -1) for name in names), dtype=np.int64, count=len(names))
+        seg = self.row_codes[lo:hi]
+        idx = np.minimum(np.searchsorted(seg, codes), len(seg) - 1)
+        found = (codes >= 0) & (seg[idx] == codes)
+        res[found] = self.values[field][lo + idx[found]]
+        return res
+
+
+def round_amounts_by_trade_unit(exchange, amounts, factors):
+    # Vectorized Exchange.round_amount_by_trade_unit (same float floor-division)
+    if not exchange.trade_w_adj_price and exchange.trade_unit is not None:
+        return (amounts * factors + 0.1) // exchange.trade_unit * exchange.trade_unit / factors
+    return amounts
+
+
+class ShadowPosition:
+    # Array-backed scratch copy of a qlib Position, used to simulate the step's sells before sizing buys.
+    #
+    # Forking reads only the held stocks (amount and hold count for one bar) and the cash, instead of
+    # deep-copying the whole Position. It implements what the strategy and Exchange.deal_order use:
+    # get_cash, get_stock_list, check_stock, get_stock_amount, get_stock_count and update_order,
+    # with the same bookkeeping as Position (incl. delayed settlement of sell proceeds).
+    def __init__(self, stocks, amounts, counts, cash, cash_delay=0.0, settle_delay=False):
+        self.stocks = list(stocks)
+        self.index = {code: i for i, code in enumerate(self.stocks)}
+        self.amounts = np.asarray(amounts, dtype=np.float64)
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.held = np.ones(len(self.stocks), dtype=bool)
+        self.cash = cash
+        self.cash_delay = cash_delay
+        self.settle_delay = settle_delay
+
+    @classmethod
+    def fork(cls, position, bar):
+        stocks = position.get_stock_list()
+        return cls(
+            stocks,
+            [position.get_stock_amount(code) for code in stocks],
+            [position.get_stock_count(code, bar=bar) for code in stocks],
+            position.get_cash(),
+            cash_delay=position.position.get("cash_delay", 0.0),
+            settle_delay=position._settle_type == Position.ST_CASH,
+        )
+
+    def get_cash(self, include_settle=False):
+        return self.cash + self.cash_delay if include_settle else self.cash
+
+    def get_stock_list(self):
+        return [code for code, held in zip(self.stocks, self.held) if held]
+
+    def check_stock(self, stock_id):
+        i = self.index.get(stock_id)
+        return i is not None and bool(self.held[i])
+
+    def _pos(self, code):
+        i = self.index.get(code)
+        if i is None or not self.held[i]:
+            raise KeyError("{} not in current position".format(code))
+        return i
+
+    def get_stock_amount(self, code):
+        return self.amounts[self._pos(code)]
+
+    def get_stock_count(self, code, bar):
+        # Hold count of the bar the shadow was forked with
+        return self.counts[self._pos(code)]
+
+    def update_order(self, order, trade_val, cost, trade_price):
+        trade_amount = trade_val / trade_price
+        if order.direction == Order.BUY:
+            i = self.index.get(order.stock_id)
+            if i is None:
+                self.index[order.stock_id] = len(self.stocks)
+                self.stocks.append(order.stock_id)
+                self.amounts = np.append(self.amounts, trade_amount)
+                self.counts = np.append(self.counts, 0.0)
+                self.held = np.append(self.held, True)
+            elif not self.held[i]:
+                self.amounts[i], self.counts[i], self.held[i] = trade_amount, 0.0, True
+            else:
+                self.amounts[i] += trade_amount
+            self.cash -= trade_val + cost
+        elif order.direction == Order.SELL:
+            i = self._pos(order.stock_id)
+            if np.isclose(self.amounts[i], trade_amount):
+                # Selling all the stocks
+                self.held[i] = False
+            else:
+                self.amounts[i] -= trade_amount
+                if self.amounts[i] < -1e-5:
+                    raise ValueError(
+                        "only have {} {}, require {}".format(self.amounts[i] + trade_amount, order.stock_id, trade_amount)
+                    )
+            if self.settle_delay:
+                self.cash_delay += trade_val - cost
+            else:
+                self.cash += trade_val - cost
+        else:
+            raise NotImplementedError("do not support order direction {}".format(order.direction))
+
+    def check_against(self, position):
+        # Consistency check: raises if this shadow differs from a Position that got the same deals
+        problems = []
+        if not np.isclose(self.get_cash(include_settle=True), position.get_cash(include_settle=True)):
+            problems.append(f"cash {self.get_cash(True)} != {position.get_cash(True)}")
+        if set(self.get_stock_list()) != set(position.get_stock_list()):
+            problems.append(f"stocks {sorted(self.get_stock_list())} != {sorted(position.get_stock_list())}")
+        else:
+            for code in self.get_stock_list():
+                if not np.isclose(self.get_stock_amount(code), position.get_stock_amount(code)):
+                    problems.append(f"{code} amount {self.get_stock_amount(code)} != {position.get_stock_amount(code)}")
+        if problems:
+            raise AssertionError("Shadow position mismatch: " + "; ".join(problems))
+
 
 class TopKSkipStrategy(TopkDropoutStrategy):
-    def __init__(self, n_skip=5, **kwargs):
+    def __init__(self, n_skip=5, check_shadow=False, **kwargs):
+        # check_shadow: also run each step's sells on a deepcopy of the position and compare (slow, for debugging)
         super().__init__(**kwargs)
         self.n_skip = n_skip
+        self.check_shadow = check_shadow
+        self._ranking = None
+        self._tradability = None
+
+    def _get_ranking(self, pred_start_time, pred_end_time):
+        # (ranking, date position) of the signal used for this step, (None, None) if there is no signal.
+        # The full signal is ranked once on the first step.
+        if self._ranking is None and hasattr(self.signal, "ranking"):
+            # CompactSignal: rows are stored in ranking order
+            self._ranking = self.signal.ranking()
+        elif self._ranking is None and hasattr(self.signal, "signal_cache"):
+            self._ranking = SignalRanking(self.signal.signal_cache)
+        if self._ranking is not None:
+            dates = self._ranking.date_positions(pred_start_time, pred_end_time)
+            if len(dates) == 0:
+                return None, None
+            if len(dates) == 1:
+                return self._ranking, dates[0]
+
+        # Several signal dates in one step (or a signal without cache): rank qlib's resampled cross-section
+        pred_score = self.signal.get_signal(start_time=pred_start_time, end_time=pred_end_time)
+        if pred_score is None:
+            return None, None
+        return SignalRanking.from_cross_section(pred_score, pred_start_time), 0
+
+    def _get_tradability(self, trade_start_time, trade_end_time):
+        # (quote panel, date position) for this step, None to fall back to the exchange's per-stock calls.
+        # The panel is built from the exchange quotes on the first step.
+        if self._tradability is None:
+            self._tradability = QuotePanel.from_exchange(self.trade_exchange) or False
+        if self._tradability is False:
+            return None
+        dates = self._tradability.date_positions(trade_start_time, trade_end_time)
+        if len(dates) > 1:
+            # Several quote bars in one step: the exchange aggregates them
+            return None
+        return self._tradability, (dates[0] if len(dates) else -1)
+
+    def _buy_amounts(self, buy, value, tradability, trade_start_time, trade_end_time):
+        # Amount to buy of each stock for `value` cash each, rounded by trade unit
+        exchange = self.trade_exchange
+        if tradability is None or not buy:
+            amounts = []
+            for code in buy:
+                buy_price = exchange.get_deal_price(
+                    stock_id=code, start_time=trade_start_time, end_time=trade_end_time, direction=OrderDir.BUY
+                )
+                factor = exchange.get_factor(stock_id=code, start_time=trade_start_time, end_time=trade_end_time)
+                amounts.append(exchange.round_amount_by_trade_unit(value / buy_price, factor))
+            return amounts
+
+        panel, di = tradability
+        prices = panel.get(di, buy, exchange.buy_price)
+        # Missing / non-positive deal prices: the exchange falls back to the close price (and logs it)
+        for i in np.flatnonzero(~(prices > 1e-08)):
+            prices[i] = exchange.get_deal_price(
+                stock_id=buy[i], start_time=trade_start_time, end_time=trade_end_time, direction=OrderDir.BUY
+            )
+        factors = panel.get(di, buy, "$factor")
+        return [float(x) for x in round_amounts_by_trade_unit(exchange, value / prices, factors)]
 
     def generate_trade_decision(self, execute_result=None):
         # get the number of trading step finished, trade_step can be [0, 1, 2, ..., trade_len - 1]
         trade_step = self.trade_calendar.get_trade_step()
         trade_start_time, trade_end_time = self.trade_calendar.get_step_time(trade_step)
         pred_start_time, pred_end_time = self.trade_calendar.get_step_time(trade_step, shift=1)
-        pred_score = self.signal.get_signal(start_time=pred_start_time, end_time=pred_end_time)
-        
+
         # NOTE: the current version of topk dropout strategy can't handle pd.DataFrame(multiple signal)
         # So it only leverage the first col of signal
-        if isinstance(pred_score, pd.DataFrame):
-            pred_score = pred_score.iloc[:, 0]
-            
-        if pred_score is None:
+        ranking, di = self._get_ranking(pred_start_time, pred_end_time)
+
+        if ranking is None:
             return TradeDecisionWO([], self)
-            
+
         # --- CUSTOM SKIP LOGIC ---
-        if self.n_skip > 0:
-            # Sort descending (High Score = Best)
-            sorted_series = pred_score.sort_values(ascending=False)
-            # Remove top n_skip
-            # If we have fewer than n_skip stocks, we might end up with empty list, which is fine (no trade)
-            if len(sorted_series) > self.n_skip:
-                pred_score = sorted_series.iloc[self.n_skip:]
-            else:
-                pred_score = pd.Series(dtype=float)
+        # Candidates start after the top n_skip names (High Score = Best); the skipped names count as unscored.
+        # If we have fewer than n_skip stocks, nothing is left (no trade)
+        first = min(max(self.n_skip, 0), ranking.size(di))
         # -------------------------
 
+        tradability = self._get_tradability(trade_start_time, trade_end_time)
+
+        def is_tradable(li, direction=None):
+            # Tradability of several stocks at once (bool array)
+            if tradability is not None:
+                return tradability[0].tradable(tradability[1], li, direction)
+            return np.array([
+                self.trade_exchange.is_stock_tradable(
+                    stock_id=si, start_time=trade_start_time, end_time=trade_end_time, direction=direction
+                )
+                for si in li
+            ], dtype=bool)
+
         if self.only_tradable:
             # If The strategy only consider tradable stock when make decision
             # It needs following actions to filter stocks
             def get_first_n(li, n, reverse=False):
-                cur_n = 0
                 res = []
-                for si in reversed(li) if reverse else li:
-                    if self.trade_exchange.is_stock_tradable(
-                        stock_id=si, start_time=trade_start_time, end_time=trade_end_time
-                    ):
-                        res.append(si)
-                        cur_n += 1
-                        if cur_n >= n:
-                            break
+                it = iter(reversed(li) if reverse else li)
+                # Check candidates in small batches, only as far as needed
+                while True:
+                    chunk = list(itertools.islice(it, max(2 * (n - len(res)), 16)))
+                    if not chunk:
+                        break
+                    for si, ok in zip(chunk, is_tradable(chunk)):
+                        if ok:
+                            res.append(si)
+                            if len(res) >= n:
+                                return res[::-1] if reverse else res
                 return res[::-1] if reverse else res
 
             def get_last_n(li, n):
                 return get_first_n(li, n, reverse=True)
 
             def filter_stock(li):
-                return [
-                    si
-                    for si in li
-                    if self.trade_exchange.is_stock_tradable(
-                        stock_id=si, start_time=trade_start_time, end_time=trade_end_time
-                    )
-                ]
+                li = list(li)
+                return [si for si, ok in zip(li, is_tradable(li)) if ok]
 
         else:
             # Otherwise, the stock will make decision without the stock tradable info
             def get_first_n(li, n):
-                return list(li)[:n]
+                # li may be a lazy candidate iterator: only the first n names are read
+                return list(itertools.islice(li, n)) if n >= 0 else list(li)[:n]
 
             def get_last_n(li, n):
                 return list(li)[-n:]
@@ -75,24 +427,33 @@ class TopKSkipStrategy(TopkDropoutStrategy):
             def filter_stock(li):
                 return li
 
-        current_temp = copy.deepcopy(self.trade_position)
+        # Scratch position for the sells below; cheap to fork (a deepcopy only for non-standard positions)
+        time_per_step = self.trade_calendar.get_freq()
+        if isinstance(self.trade_position, Position):
+            current_temp = ShadowPosition.fork(self.trade_position, time_per_step)
+            check_temp = copy.deepcopy(self.trade_position) if self.check_shadow else None
+        else:
+            current_temp = copy.deepcopy(self.trade_position)
+            check_temp = None
         # generate order list for this adjust date
         sell_order_list = []
         buy_order_list = []
         # load score
         cash = current_temp.get_cash()
         current_stock_list = current_temp.get_stock_list()
-        # last position (sorted by score)
-        last = pred_score.reindex(current_stock_list).sort_values(ascending=False).index
+        # last position (sorted by score, stocks without a score last)
+        scored, unscored = ranking.order(di, current_stock_list, first)
+        last = pd.Index(np.concatenate([scored, unscored]))
+        last_set = set(last)
         # The new stocks today want to buy **at most**
         if self.method_buy == "top":
             today = get_first_n(
-                pred_score[~pred_score.index.isin(last)].sort_values(ascending=False).index,
+                (code for code in ranking.iter_names(di, first) if code not in last_set),
                 self.n_drop + self.topk - len(last),
             )
         elif self.method_buy == "random":
-            topk_candi = get_first_n(pred_score.sort_values(ascending=False).index, self.topk)
-            candi = list(filter(lambda x: x not in last, topk_candi))
+            topk_candi = get_first_n(ranking.iter_names(di, first), self.topk)
+            candi = list(filter(lambda x: x not in last_set, topk_candi))
             n = self.n_drop + self.topk - len(last)
             try:
                 today = np.random.choice(candi, n, replace=False)
@@ -102,7 +463,10 @@ class TopKSkipStrategy(TopkDropoutStrategy):
             raise NotImplementedError(f"This type of input is not supported")
         # combine(new stocks + last stocks),  we will drop stocks from this list
         # In case of dropping higher score stock and buying lower score stock.
-        comb = pred_score.reindex(last.union(pd.Index(today))).sort_values(ascending=False).index
+        new = [code for code in today if code not in last_set]
+        scored, unscored = ranking.order(di, list(last) + new, first)
+        # Unscored names keep pandas' Index.union order: sorted, unless one side is empty
+        comb = list(scored) + (sorted(unscored) if len(last) and new else list(unscored))
 
         # Get the stock list we really want to sell (After filtering the case that we sell high and buy low)
         if self.method_sell == "bottom":
@@ -118,17 +482,13 @@ class TopKSkipStrategy(TopkDropoutStrategy):
 
         # Get the stock list we really want to buy
         buy = today[: len(sell) + self.topk - len(last)]
-        for code in current_stock_list:
-            if not self.trade_exchange.is_stock_tradable(
-                stock_id=code,
-                start_time=trade_start_time,
-                end_time=trade_end_time,
-                direction=None if self.forbid_all_trade_at_limit else OrderDir.SELL,
-            ):
+        sell_set = set(sell)
+        sell_tradable = is_tradable(current_stock_list, None if self.forbid_all_trade_at_limit else OrderDir.SELL)
+        for code, tradable in zip(current_stock_list, sell_tradable):
+            if not tradable:
                 continue
-            if code in sell:
+            if code in sell_set:
                 # check hold limit
-                time_per_step = self.trade_calendar.get_freq()
                 if current_temp.get_stock_count(code, bar=time_per_step) < self.hold_thresh:
                     continue
                 # sell order
@@ -149,6 +509,10 @@ class TopKSkipStrategy(TopkDropoutStrategy):
                     )
                     # update cash
                     cash += trade_val - trade_cost
+                    if check_temp is not None:
+                        self.trade_exchange.deal_order(copy.copy(sell_order), position=check_temp)
+        if check_temp is not None:
+            current_temp.check_against(check_temp)
         # buy new stock
         # note the current has been changed
         # current_stock_list = current_temp.get_stock_list()
@@ -157,22 +521,12 @@ class TopKSkipStrategy(TopkDropoutStrategy):
         # open_cost should be considered in the real trading environment, while the backtest in evaluate.py does not
         # consider it as the aim of demo is to accomplish same strategy as evaluate.py, so comment out this line
         # value = value / (1+self.trade_exchange.open_cost) # set open_cost limit
-        for code in buy:
-            # check is stock suspended
-            if not self.trade_exchange.is_stock_tradable(
-                stock_id=code,
-                start_time=trade_start_time,
-                end_time=trade_end_time,
-                direction=None if self.forbid_all_trade_at_limit else OrderDir.BUY,
-            ):
-                continue
-            # buy order
-            buy_price = self.trade_exchange.get_deal_price(
-                stock_id=code, start_time=trade_start_time, end_time=trade_end_time, direction=OrderDir.BUY
-            )
-            buy_amount = value / buy_price
-            factor = self.trade_exchange.get_factor(stock_id=code, start_time=trade_start_time, end_time=trade_end_time)
-            buy_amount = self.trade_exchange.round_amount_by_trade_unit(buy_amount, factor)
+        buy_tradable = is_tradable(list(buy), None if self.forbid_all_trade_at_limit else OrderDir.BUY)
+        # check is stock suspended
+        buy = [code for code, tradable in zip(buy, buy_tradable) if tradable]
+        # buy order sizes for all stocks at once
+        buy_amounts = self._buy_amounts(buy, value, tradability, trade_start_time, trade_end_time)
+        for code, buy_amount in zip(buy, buy_amounts):
             buy_order = Order(
                 stock_id=code,
                 amount=buy_amount,
@@ -0,0 +1,167 @@
+import os
+import time
+import pickle
+import argparse
+import yaml
+import numpy as np
+import pandas as pd
+
+# Incremental daily run: scores for ONE trading day from the saved experts, without rebuilding the
+# 2010-2025 handlers or the regime series.
+#
+#   1. features of the new date only: the raw fields of the longest expression's lookback window
+#      (~60 bars for Alpha158 / DIST_MA) are loaded once and all expressions are evaluated across
+#      instruments with numpy (panel_features.py)
+#   2. the fitted infer processors of the training run (RobustZScoreNorm stats, Fillna) are applied as stored
+#   3. today's regime from the last LONG_WINDOW benchmark closes (RegimeTracker)
+#   4. the date is routed to its expert (predict_by_regime), then the cash logic and the data-quality
+#      exclusions (ban list of the training run, all in the past by now + the point-in-time mask of
+#      data_quality.scan on the lookback window) are applied
+#
+# The bundle (experts + feature expressions + fitted processors) is written by run_adaptive_strategy
+# to `daily_run.bundle_path`; with walk_forward enabled it holds the experts of the last fold.
+#
+#   python daily_run.py                      # last date of the calendar
+#   python daily_run.py --date 2025-12-31 --out scores.csv
+
+
+def load_config(path="config.yaml"):
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+    return config
+
+
+def handler_spec(handler):
+    # Feature expressions + fitted processors of a (built or FeatureStore-loaded) handler
+    fields, names = handler.data_loader.fields["feature"]
+    return {
+        "fields": list(fields),
+        "names": list(names),
+        "shared_processors": list(getattr(handler, "shared_processors", [])),
+        "infer_processors": list(getattr(handler, "infer_processors", [])),
+    }
+
+
+def save_bundle(path, models, handler_std, handler_ext, **meta):
+    # meta: instruments, benchmark, cash_threshold, ... (stored as is)
+    bundle = {
+        "models": models,
+        "handlers": {"std": handler_spec(handler_std), "ext": handler_spec(handler_ext)},
+        "created": time.time(),
+        **meta,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(bundle, f)
+    os.replace(tmp_path, path)
+    print(f"Live model bundle saved to {path}")
+
+
+def load_bundle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def compute_features(panel, instruments, spec, date):
+    # One date of a handler's feature group: the expressions on the shared raw panel, then the stored
+    # (already fitted) processors. Fields the panel cannot evaluate are computed by qlib.
+    from qlib.data import D
+
+    values = {}
+    fallback = []
+    for field, name in zip(spec["fields"], spec["names"]):
+        try:
+            values[name] = panel.evaluate(field)[-1]
+        except NotImplementedError:
+            fallback.append((field, name))
+    df = pd.DataFrame(values, index=pd.MultiIndex.from_product([[pd.Timestamp(date)], instruments],
+                                                                names=["datetime", "instrument"]))
+    if fallback:
+        print(f"Computing {len(fallback)} fields with D.features...")
+        extra = D.features(instruments, [f for f, _ in fallback], start_time=date, end_time=date)
+        extra.columns = [name for _, name in fallback]
+        df = df.join(extra.swaplevel().rename_axis(["datetime", "instrument"]))
+    df = df[spec["names"]]
+    df.columns = pd.MultiIndex.from_product([["feature"], spec["names"]])
+
+    for proc in spec["shared_processors"] + spec["infer_processors"]:
+        df = proc(df)
+    return df["feature"]
+
+
+def today_regime(benchmark, date):
+    from regime import LONG_WINDOW, RegimeTracker, load_benchmark_close
+
+    close = load_benchmark_close(benchmark, date, date, lookback=LONG_WINDOW - 1)
+    close = close.loc[:pd.Timestamp(date)]
+    return RegimeTracker.from_history(close.to_numpy()).regime
+
+
+def run_daily(date=None, out_path=None):
+    import qlib
+    from qlib.constant import REG_US
+    from qlib.data import D
+    from regime import REGIME_NAMES
+    from experts import predict_by_regime
+    from panel_features import load_panel
+    from data_quality import scan
+
+    start = time.time()
+    config = load_config()
+    qlib.init(provider_uri=config['qlib_init']['provider_uri'], region=REG_US)
+    daily_config = config.get('daily_run', {})
+    bundle = load_bundle(daily_config.get('bundle_path', 'live_model/moe_bundle.pkl'))
+
+    if date is None:
+        date = D.calendar()[-1]
+    date = pd.Timestamp(date)
+
+    regime_val = today_regime(bundle['benchmark'], date)
+    print(f"{date.date()}: regime {REGIME_NAMES[regime_val]}")
+
+    print("Computing features...")
+    specs = bundle['handlers']
+    # $close / $volume are always loaded for the data-quality checks
+    fields = specs['std']['fields'] + specs['ext']['fields'] + ['$close', '$volume']
+    panel, instruments = load_panel(bundle['instruments'], fields, date)
+    x_std = compute_features(panel, instruments, specs['std'], date)
+    x_ext = compute_features(panel, instruments, specs['ext'], date)
+    x_choppy = pd.concat([x_std, x_ext], axis=1)
+
+    regime = pd.Series([regime_val], index=pd.DatetimeIndex([date], name='datetime'))
+    score = predict_by_regime(bundle['models'], {1: x_std, -1: x_std, 0: x_choppy}, regime)
+    n_scored = int(score.notna().sum())
+
+    # Data quality: the ban list of the training snapshot + today's checks on the lookback window
+    # (before the cash logic: the masks are in `instruments` order, as the score rows)
+    _, live_mask, _, _ = scan(panel.raw['$close'], panel.raw['$volume'], panel.present, **bundle.get('quality_params', {}))
+    excluded = live_mask[-1] | np.isin(instruments, bundle.get('banned', []))
+    if excluded.any():
+        print(f"Excluding {int(excluded.sum())} instruments (data quality)")
+    score = score[~excluded]
+
+    # Cash logic of run_adaptive_strategy: as in its pred.pkl (CompactSignal.from_scores with min_score),
+    # names without a score or below the threshold are not candidates
+    cash_threshold = bundle.get('cash_threshold', 0.0)
+    score = score[np.isfinite(score.to_numpy()) & (score.to_numpy() >= cash_threshold)]
+
+    res = score.droplevel('datetime').sort_values(ascending=False).rename('score').to_frame()
+    res['regime'] = regime_val
+    print(f"{n_scored} instruments scored, {len(res)} above the cash threshold ({time.time() - start:.1f}s)")
+    print(res.head(20).to_string())
+
+    if out_path is None:
+        out_path = os.path.join(daily_config.get('output_dir', 'daily_scores'), f"scores_{date.date()}.csv")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    res.to_csv(out_path)
+    print(f"Scores saved to {out_path}")
+    return res
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score one trading day with the saved MoE experts")
+    parser.add_argument("--date", default=None, help="trading date (default: last date of the calendar)")
+    parser.add_argument("--out", default=None)
+    args = parser.parse_args()
+    run_daily(args.date, args.out)
@@ -0,0 +1,306 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+# Data-quality scan of the raw price / volume panel, run once per data snapshot and cached on disk.
+#
+# Checks, vectorized over a (dates x instruments) panel of $close / $volume:
+#   price:  close <= min_price (non-positive or sub-penny)             -> the instrument is banned
+#   volume: runs of >= zero_volume_run bars with zero volume           -> those dates are excluded
+#   gaps:   missing closes inside the listed span; after a gap of >= max_gap_bars bars, the next
+#           gap_cooldown bars are excluded too (rolling features are stale)
+#   jumps:  |log(close / previous close)| > log(1 + max_jump)           -> the jump date and the date before
+#           (whose label is the jump) are excluded; ban_jumps or more jumps ban the instrument
+# Instruments with more than ban_excluded_frac of their listed bars excluded are banned as well.
+#
+# The result is a per-instrument ban list + a per-date exclusion mask. Both look ahead (the label of the
+# date before a jump, whole zero-volume runs, bans counted over the full period), so they only filter
+# training rows. Predictions are filtered by the point-in-time mask instead: close <= min_price on the
+# date, missing bars, gap cooldowns and zero-volume runs as long as they have lasted by then, which is
+# also what the live daily run can see. Consumers look rows up by the level codes of their
+# (datetime, instrument) index, without loading prices again or joining frames:
+#
+#   quality = DataQuality.load_or_scan("all", "2010-01-01", "2025-12-31")
+#   train = train[~quality.excluded(train.index)]
+#   pred = pred[~quality.excluded(pred.index, point_in_time=True)]
+#
+# Entries live in <path>/<key>/ where the key covers the data snapshot (see feature_store.data_snapshot),
+# the universe, the time range and the scan parameters.
+
+DEFAULT_PARAMS = {
+    "min_price": 0.01,
+    "zero_volume_run": 5,
+    "max_gap_bars": 5,
+    "gap_cooldown": 20,
+    "max_jump": 1.0,
+    "ban_jumps": 3,
+    "ban_excluded_frac": 0.5,
+}
+
+BAN_REASONS = ["price", "jumps", "excluded"]
+
+# Part of the cache key: entries of an older scan are rescanned
+SCAN_VERSION = 2
+
+
+def runs_so_far(flag):
+    # Length of the run of True values up to and including each True cell (0 elsewhere), along axis 0
+    res = np.zeros(flag.shape, dtype=np.int32)
+    for t in range(len(flag)):
+        res[t] = ((res[t - 1] if t > 0 else 0) + 1) * flag[t]
+    return res
+
+
+def run_lengths(flag):
+    # Length of the run of True values each True cell belongs to (0 elsewhere), along axis 0
+    fwd = runs_so_far(flag)
+    bwd = runs_so_far(flag[::-1])[::-1]
+    return np.where(flag, fwd + bwd - 1, 0)
+
+
+def bars_since(flag):
+    # Bars since the last True along axis 0 (0 on True, -1 before the first True)
+    res = np.empty(flag.shape, dtype=np.int32)
+    prev = np.full(flag.shape[1:], -1, dtype=np.int32)
+    for t in range(len(flag)):
+        prev = np.where(flag[t], 0, np.where(prev >= 0, prev + 1, -1))
+        res[t] = prev
+    return res
+
+
+def scan(close, volume, exists, min_price=0.01, zero_volume_run=5, max_gap_bars=5, gap_cooldown=20,
+         max_jump=1.0, ban_jumps=3, ban_excluded_frac=0.5):
+    # close / volume: (dates x instruments) float arrays, exists: bool, True where a bar is stored.
+    # Returns (exclusion mask, point-in-time mask, {reason: per-instrument ban flags}, per-instrument counts).
+    close = np.asarray(close, dtype=np.float64)
+    volume = np.asarray(volume, dtype=np.float64)
+    exists = np.asarray(exists, dtype=bool)
+    n_dates = len(close)
+
+    # Listed span: between the first and the last stored bar
+    span = np.maximum.accumulate(exists, axis=0) & np.maximum.accumulate(exists[::-1], axis=0)[::-1]
+    valid = span & ~np.isnan(close)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        bad_price = valid & (close <= min_price)
+
+        zero_volume = valid & (volume == 0)
+        zero_run = run_lengths(zero_volume) >= zero_volume_run
+
+        missing = span & ~valid
+        long_gap = run_lengths(missing) >= max_gap_bars
+        # Bars after the END of a long gap (the first valid bar after it starts the cooldown). Known from
+        # the first bar of the cooldown on, so it is point-in-time.
+        gap_end = long_gap & ~np.vstack([long_gap[1:], np.zeros((1, close.shape[1]), dtype=bool)])
+        since = bars_since(gap_end)
+        cooldown = (since >= 1) & (since <= gap_cooldown) & span
+
+        # Jumps against the previous valid close
+        rows = np.arange(n_dates)[:, None]
+        last_valid = np.maximum.accumulate(np.where(valid, rows, -1), axis=0)
+        prev = np.vstack([np.full((1, close.shape[1]), -1), last_valid[:-1]])
+        cols = np.broadcast_to(np.arange(close.shape[1]), close.shape)
+        prev_close = np.where(prev >= 0, close[np.maximum(prev, 0), cols], np.nan)
+        ret = np.log(close / prev_close)
+        jump = valid & (prev >= 0) & (np.abs(ret) > np.log1p(max_jump))
+
+    mask = bad_price | zero_run | missing | cooldown | jump
+    # The date before a jump carries it as its label
+    t, i = np.nonzero(jump)
+    mask[prev[t, i], i] = True
+
+    # Point-in-time: only the bars up to each date (listed so far, zero-volume runs as long as they have lasted)
+    listed = np.maximum.accumulate(exists, axis=0)
+    live_zero_run = runs_so_far(zero_volume) >= zero_volume_run
+    live_missing = listed & np.isnan(close)
+    live_cooldown = (since >= 1) & (since <= gap_cooldown) & listed
+    live_mask = bad_price | live_zero_run | live_missing | live_cooldown
+
+    n_listed = span.sum(axis=0)
+    counts = {
+        "bars": n_listed,
+        "price": bad_price.sum(axis=0),
+        "zero_volume": zero_run.sum(axis=0),
+        "missing": missing.sum(axis=0),
+        "jumps": jump.sum(axis=0),
+        "excluded": (mask & span).sum(axis=0),
+    }
+    bans = {
+        "price": counts["price"] > 0,
+        "jumps": counts["jumps"] >= ban_jumps,
+        "excluded": counts["excluded"] > ban_excluded_frac * np.maximum(n_listed, 1),
+    }
+    return mask & span, live_mask, bans, counts
+
+
+def load_price_panel(instruments, start_time, end_time):
+    # Dense (dates x instruments) $close / $volume for the universe, from one D.features call
+    from qlib.data import D
+
+    if isinstance(instruments, str):
+        instruments = D.instruments(instruments)
+    df = D.features(instruments, ["$close", "$volume"], start_time=start_time, end_time=end_time)
+    dates = pd.DatetimeIndex(D.calendar(start_time=start_time, end_time=end_time))
+    inst_level = df.index.names.index("instrument")
+    date_level = df.index.names.index("datetime")
+    names = df.index.levels[inst_level]
+    date_pos = dates.get_indexer(df.index.levels[date_level])[df.index.codes[date_level]]
+    inst_pos = np.asarray(df.index.codes[inst_level])
+
+    shape = (len(dates), len(names))
+    close = np.full(shape, np.nan, dtype=np.float32)
+    volume = np.full(shape, np.nan, dtype=np.float32)
+    exists = np.zeros(shape, dtype=bool)
+    close[date_pos, inst_pos] = df["$close"].to_numpy()
+    volume[date_pos, inst_pos] = df["$volume"].to_numpy()
+    exists[date_pos, inst_pos] = True
+    return dates, list(names), close, volume, exists
+
+
+class DataQuality:
+    def __init__(self, dates, instruments, mask, live_mask, bans, counts=None):
+        self.dates = pd.DatetimeIndex(dates)
+        self.instruments = pd.Index(instruments)
+        self.mask = mask
+        self.live_mask = live_mask
+        self.bans = bans
+        self.counts = counts or {}
+
+    @property
+    def banned(self):
+        # Per-instrument ban flag (any reason)
+        return np.logical_or.reduce([self.bans[r] for r in BAN_REASONS])
+
+    def banned_instruments(self):
+        return self.instruments[self.banned].tolist()
+
+    def excluded(self, index, point_in_time=False):
+        # Bool per row of a (datetime, instrument) MultiIndex: banned instrument or excluded date (training
+        # rows), or with point_in_time only the point-in-time mask (predictions, no bans).
+        # Lookups go through the index levels (one get_indexer per level), never per row.
+        d_level = index.names.index("datetime")
+        i_level = index.names.index("instrument")
+        d = self.dates.get_indexer(index.levels[d_level])[index.codes[d_level]]
+        i = self.instruments.get_indexer(index.levels[i_level])[index.codes[i_level]]
+
+        res = np.zeros(len(index), dtype=bool)
+        # Rows of instruments that were not scanned are kept
+        known = i >= 0
+        if not point_in_time:
+            res[known] = self.banned[i[known]]
+        known_date = known & (d >= 0)
+        mask = self.live_mask if point_in_time else self.mask
+        res[known_date] |= mask[d[known_date], i[known_date]]
+        return res
+
+    def summary(self):
+        lines = [f"Data quality: {len(self.instruments)} instruments x {len(self.dates)} dates, "
+                 f"{int(self.mask.sum())} instrument-dates excluded from training, "
+                 f"{int(self.live_mask.sum())} from predictions (point-in-time)"]
+        for reason in BAN_REASONS:
+            lines.append(f"  banned ({reason}): {int(self.bans[reason].sum())}")
+        return "\n".join(lines)
+
+    # --- Cache ---
+    @classmethod
+    def load_or_scan(cls, instruments, start_time, end_time, path="data_quality", refresh=False, **params):
+        from feature_store import data_snapshot
+
+        params = {**DEFAULT_PARAMS, **params}
+        payload = {"instruments": instruments, "start_time": str(start_time), "end_time": str(end_time),
+                   "params": params, "snapshot": data_snapshot(), "version": SCAN_VERSION}
+        key = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:20]
+        entry = os.path.join(path, key)
+
+        if not refresh and os.path.exists(os.path.join(entry, "meta.json")):
+            print(f"Data quality cache hit [{key}]")
+            return cls.load(entry)
+
+        print(f"Data quality cache miss [{key}]. Scanning...")
+        start = time.time()
+        dates, names, close, volume, exists = load_price_panel(instruments, start_time, end_time)
+        mask, live_mask, bans, counts = scan(close, volume, exists, **params)
+        res = cls(dates, names, mask, live_mask, bans, counts)
+        res.save(entry, meta={"key": key, "params": params, "seconds": round(time.time() - start, 2)})
+        return res
+
+    def save(self, entry, meta=None):
+        tmp_path = f"{entry}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "mask.npy"), self.mask)
+        np.save(os.path.join(tmp_path, "live_mask.npy"), self.live_mask)
+        np.save(os.path.join(tmp_path, "dates.npy"), self.dates.values.astype("datetime64[ns]"))
+        with open(os.path.join(tmp_path, "instruments.json"), "w") as f:
+            json.dump(self.instruments.tolist(), f)
+        np.savez(os.path.join(tmp_path, "bans.npz"), **self.bans)
+        np.savez(os.path.join(tmp_path, "counts.npz"), **self.counts)
+        # Readable ban list
+        self.ban_frame().to_csv(os.path.join(tmp_path, "bans.csv"))
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"created": time.time(), **(meta or {})}, f, default=str)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.replace(tmp_path, entry)
+
+    @classmethod
+    def load(cls, entry):
+        mask = np.load(os.path.join(entry, "mask.npy"))
+        live_mask = np.load(os.path.join(entry, "live_mask.npy"))
+        dates = np.load(os.path.join(entry, "dates.npy"))
+        with open(os.path.join(entry, "instruments.json"), "r") as f:
+            instruments = json.load(f)
+        with np.load(os.path.join(entry, "bans.npz")) as z:
+            bans = {k: z[k] for k in z.files}
+        with np.load(os.path.join(entry, "counts.npz")) as z:
+            counts = {k: z[k] for k in z.files}
+        return cls(dates, instruments, mask, live_mask, bans, counts)
+
+    @classmethod
+    def training_filter(cls, dq_config, data_handler_config):
+        # `exclude` for the expert fits (DataQuality.excluded), None unless data_quality.filter_training is
+        # set. Scanned over fit_start_time..fit_end_time only: the mask and bans look ahead, so they must not
+        # see the valid / test years. Later rows (valid segment, walk-forward updates) only meet the bans of
+        # the fit window, which were known by then.
+        dq_config = dict(dq_config)
+        if not dq_config.pop('enabled', True) or not dq_config.pop('filter_training', False):
+            return None
+        quality = cls.load_or_scan(data_handler_config['instruments'], data_handler_config['fit_start_time'],
+                                   data_handler_config['fit_end_time'], **dq_config)
+        print(f"Training filter ({data_handler_config['fit_start_time']} - {data_handler_config['fit_end_time']}):")
+        print(quality.summary())
+        return quality.excluded
+
+    def ban_frame(self):
+        # One row per banned instrument with its reasons and counts
+        df = pd.DataFrame({f"ban_{r}": self.bans[r] for r in BAN_REASONS}, index=self.instruments)
+        for name, values in self.counts.items():
+            df[name] = values
+        df.index.name = "instrument"
+        return df[self.banned]
+
+
+if __name__ == "__main__":
+    import yaml
+    import qlib
+    from qlib.constant import REG_US
+
+    parser = argparse.ArgumentParser(description="Scan the data snapshot for bad prices / volumes (cached)")
+    parser.add_argument("--refresh", action="store_true")
+    args = parser.parse_args()
+
+    with open("config.yaml", "r") as f:
+        config = yaml.safe_load(f)
+    qlib.init(provider_uri=config['qlib_init']['provider_uri'], region=REG_US)
+    dq_config = dict(config.get('data_quality', {}))
+    dq_config.pop('enabled', None)
+    dq_config.pop('filter_training', None)
+    dhc = config['data_handler_config']
+    quality = DataQuality.load_or_scan(dhc['instruments'], dhc['start_time'], dhc['end_time'], refresh=args.refresh,
+                                       **dq_config)
+    print(quality.summary())
+    print(quality.ban_frame().to_string())
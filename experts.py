@@ -0,0 +1,226 @@
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shared_arrays import SharedArray, attach
+from moe_data import partition_rows, take_rows
+from lgb_cache import BinnedDatasetCache, build_datasets, dataset_params, train_booster
+from panel import Panel
+
+# Regime experts of the MoE strategy, in training order
+EXPERTS = [(1, 'Uptrend'), (0, 'Choppy'), (-1, 'Downtrend')]
+
+
+def fit_expert(x_train, y_train, x_valid, y_valid, params, cache=None, name=None):
+    # Native lgb.train on binned Datasets (same model as LGBMRegressor(**params).fit with eval_set).
+    # With a BinnedDatasetCache, the binned train/valid sets are reused across runs and trials.
+    train_set, valid_set = build_datasets(x_train, y_train, x_valid, y_valid, params, cache=cache, name=name)
+    return fit_binned(train_set, valid_set, params)
+
+
+def fit_binned(train_set, valid_set, params):
+    # Early-stopped fit on already built lgb.Datasets (in memory, cached or streamed from disk)
+    callbacks = [lgb.early_stopping(stopping_rounds=50, verbose=False), lgb.log_evaluation(period=0)]
+
+    return train_booster(params, train_set, valid_set, callbacks)
+
+
+def update_expert(model, x_new, y_new, params, rounds):
+    # Warm start: `rounds` more trees on top of `model` (lgb init_model), fitted on the new rows only.
+    # The new rows start from the previous model's scores, so the older history is not revisited.
+    train_set = lgb.Dataset(x_new, label=np.asarray(y_new, dtype=np.float64).ravel(), params=dataset_params(params),
+                            free_raw_data=True)
+    return train_booster(params, train_set, None, [lgb.log_evaluation(period=0)], init_model=model,
+                         num_boost_round=rounds)
+
+
+def train_experts(view_map, params_map, parallel=False, n_jobs=20, cache=None):
+    # view_map: regime value -> RegimePartitionedView, params_map: regime value -> LGBM params.
+    # The training rows of each expert are view.select("train", regime), validation is the full "valid" segment.
+    if parallel:
+        return train_experts_parallel(view_map, params_map, n_jobs=n_jobs, cache=cache)
+
+    models = {}
+    for k, (regime_val, regime_name) in enumerate(EXPERTS):
+        print(f"Training {regime_name} Model...")
+
+        view = view_map[regime_val]
+        subset_df = view.select("train", regime_val)
+
+        if subset_df.empty:
+            print(f"Warning: No data for {regime_name} regime. Skipping training.")
+            models[regime_val] = None
+        else:
+            valid_df = view.frame("valid")
+            models[regime_val] = fit_expert(
+                subset_df['feature'], subset_df['label'], valid_df['feature'], valid_df['label'], params_map[regime_val],
+                cache=cache, name=f"{view.name}_{regime_val}",
+            )
+            del valid_df
+            print(f"{regime_name} Model Trained.")
+        del subset_df
+
+        # The view's frames are dropped after the last expert that trains on it
+        if all(view_map[r] is not view for r, _ in EXPERTS[k + 1:]):
+            view.release()
+    return models
+
+
+def predict_by_regime(models, x_map, regime):
+    # Regime-routed inference: rows are grouped by the regime of their date and each expert
+    # predicts only its own rows. x_map: regime value -> feature frame (all on the same row index).
+    # Rows without a regime or without a trained expert stay NaN.
+    if isinstance(next(iter(x_map.values())), Panel):
+        return _predict_panels(models, x_map, regime)
+
+    index = next(iter(x_map.values())).index
+    rows = partition_rows(index, regime)
+    scores = np.full(len(index), np.nan)
+
+    for regime_val, model in models.items():
+        if model is None or regime_val not in rows:
+            continue
+        x_in = x_map[regime_val]
+        if x_in.index is not index and not x_in.index.equals(index):
+            x_in = x_in.reindex(index)
+        pos = rows[regime_val]
+        scores[pos] = model.predict(take_rows(x_in, pos))
+
+    return pd.Series(scores, index=index)
+
+
+def _predict_panels(models, panel_map, regime):
+    # Panels on the same rows: each expert predicts the row blocks of its regime's date runs straight
+    # from the panel matrix (C-contiguous views, no gather / conversion copy)
+    panel = next(iter(panel_map.values()))
+    views = panel.regime_views(regime)
+    scores = np.full(len(panel), np.nan)
+
+    for regime_val, model in models.items():
+        if model is None or regime_val not in views:
+            continue
+        for start, end, values in views[regime_val].iter_blocks(panel_map[regime_val].values):
+            scores[start:end] = model.predict(values)
+
+    return pd.Series(scores, index=panel.index)
+
+
+def split_thread_budget(sizes, total):
+    # Threads per expert proportional to its number of training rows (at least 1 each),
+    # so all experts finish at about the same time and wall clock ~ the largest expert.
+    keys = [k for k, n in sizes.items() if n > 0]
+    if not keys:
+        return {}
+    if total <= len(keys):
+        return {k: 1 for k in keys}
+
+    n_total = sum(sizes[k] for k in keys)
+    raw = {k: total * sizes[k] / n_total for k in keys}
+    alloc = {k: max(1, int(raw[k])) for k in keys}
+
+    # Largest remainder for the leftover threads / take back from the biggest if we rounded up too far
+    left = total - sum(alloc.values())
+    for k in sorted(keys, key=lambda k: raw[k] - int(raw[k]), reverse=True)[:max(left, 0)]:
+        alloc[k] += 1
+    while sum(alloc.values()) > total:
+        k = max(alloc, key=alloc.get)
+        alloc[k] -= 1
+    return alloc
+
+
+def train_experts_parallel(view_map, params_map, n_jobs=20, cache=None):
+    # Trains the experts concurrently in worker processes.
+    # - each distinct train/valid frame is placed in shared memory once (std is shared by Uptrend and Downtrend)
+    # - workers receive only the shared memory handles + their row positions
+    # - the n_jobs budget is split by subset size (see split_thread_budget)
+    # With deterministic=True, LightGBM results do not depend on num_threads, so the trees
+    # are identical to the serial path.
+    sizes = {r: len(view_map[r].rows("train", r)) for r, _ in EXPERTS}
+    threads = split_thread_budget(sizes, n_jobs)
+    models = {r: None for r, _ in EXPERTS}
+    for regime_val, regime_name in EXPERTS:
+        if sizes[regime_val] == 0:
+            print(f"Warning: No data for {regime_name} regime. Skipping training.")
+
+    shared = {}
+    tasks = {}
+    try:
+        for regime_val, regime_name in EXPERTS:
+            if sizes[regime_val] == 0:
+                continue
+            view = view_map[regime_val]
+            if id(view) not in shared:
+                shared[id(view)] = _share_view(view)
+            params = dict(params_map[regime_val])
+            params['n_jobs'] = threads[regime_val]
+            tasks[regime_val] = {
+                "name": regime_name,
+                "arrays": {k: v.spec for k, v in shared[id(view)]["arrays"].items()},
+                "columns": shared[id(view)]["columns"],
+                "rows": view.rows("train", regime_val),
+                "params": params,
+                "cache_path": cache.path if cache is not None else None,
+                "cache_name": f"{view.name}_{regime_val}",
+            }
+            print(f"Training {regime_name} Model ({sizes[regime_val]} rows, {threads[regime_val]} threads)...")
+
+        # The frames now live in shared memory (the tasks hold their row positions)
+        for view in set(view_map.values()):
+            view.release()
+
+        # spawn: forking a process that already ran LightGBM (OpenMP) can deadlock the child
+        with ProcessPoolExecutor(max_workers=len(tasks), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(_fit_expert_worker, task): regime_val for regime_val, task in tasks.items()}
+            for fut in as_completed(futures):
+                regime_val = futures[fut]
+                models[regime_val] = fut.result()
+                print(f"{tasks[regime_val]['name']} Model Trained.")
+    finally:
+        for item in shared.values():
+            for arr in item["arrays"].values():
+                arr.close()
+    return models
+
+
+def _share_view(view):
+    train_df = view.frame("train")
+    valid_df = view.frame("valid")
+    return {
+        "columns": {
+            "feature": train_df['feature'].columns.tolist(),
+            "label": train_df['label'].columns.tolist(),
+        },
+        "arrays": {
+            "x_train": SharedArray(train_df['feature'].to_numpy()),
+            "y_train": SharedArray(train_df['label'].to_numpy()),
+            "x_valid": SharedArray(valid_df['feature'].to_numpy()),
+            "y_valid": SharedArray(valid_df['label'].to_numpy()),
+        },
+    }
+
+
+def _fit_expert_worker(task):
+    handles = []
+    arrays = {}
+    for key, spec in task["arrays"].items():
+        shm, arr = attach(spec)
+        handles.append(shm)
+        arrays[key] = arr
+    try:
+        rows = task["rows"]
+        feature_cols = task["columns"]["feature"]
+        label_cols = task["columns"]["label"]
+        # Same column names as the serial path, so the boosters are identical
+        x_train = pd.DataFrame(arrays["x_train"][rows], columns=feature_cols)
+        y_train = pd.DataFrame(arrays["y_train"][rows], columns=label_cols)
+        x_valid = pd.DataFrame(arrays["x_valid"], columns=feature_cols, copy=False)
+        y_valid = pd.DataFrame(arrays["y_valid"], columns=label_cols, copy=False)
+        cache = BinnedDatasetCache(task["cache_path"]) if task["cache_path"] else None
+        model = fit_expert(x_train, y_train, x_valid, y_valid, task["params"], cache=cache, name=task["cache_name"])
+        del x_valid, y_valid
+    finally:
+        arrays.clear()
+        for shm in handles:
+            shm.close()
+    return model
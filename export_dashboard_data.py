@@ -4,6 +4,7 @@ import pickle
 import os
 import json
 import glob
+from regime import rolling_mean, regime_labels
 
 def load_latest_artifacts(base_path):
     # Find the latest experiment run
@@ -69,28 +70,19 @@ def export_data():
         
         # Calculate Indicators on Benchmark Cumulative (Proxy for Price)
         # This ensures they are on the same scale as the equity curve
-        report_df['bench_ma20'] = report_df['benchmark_cum'].rolling(window=20).mean()
-        report_df['bench_ma60'] = report_df['benchmark_cum'].rolling(window=60).mean()
+        bench_cum = report_df['benchmark_cum'].to_numpy()
+        report_df['bench_ma20'] = rolling_mean(bench_cum, 20)
+        report_df['bench_ma60'] = rolling_mean(bench_cum, 60)
         
-        # Determine Regime based on these MAs (Replicating Strategy Logic)
-        # Uptrend (1): Price > MA60 AND MA20 > MA60
-        # Downtrend (-1): Price < MA60 AND MA20 < MA60
-        # Choppy (0): Else
-        def get_regime(row):
-            price = row['benchmark_cum']
-            ma20 = row['bench_ma20']
-            ma60 = row['bench_ma60']
-            
-            if pd.isna(ma60): return 0
-            
-            if price > ma60 and ma20 > ma60:
-                return 1 # Uptrend
-            elif price < ma60 and ma20 < ma60:
-                return -1 # Downtrend
-            else:
-                return 0 # Choppy
-                
-        report_df['regime'] = report_df.apply(get_regime, axis=1)
+        # Regime: use the exact labels the strategy traded with (saved by adaptive_strategy.py).
+        # Older runs without regime.pkl fall back to the same engine on the benchmark proxy.
+        regime_path = os.path.join(artifact_path, "regime.pkl")
+        if os.path.exists(regime_path):
+            with open(regime_path, "rb") as f:
+                saved_regime = pickle.load(f)
+            report_df['regime'] = saved_regime.reindex(report_df['date']).fillna(0).astype(int).to_numpy()
+        else:
+            report_df['regime'] = regime_labels(bench_cum).astype(int)
         
         equity_curve = {
             "dates": report_df['date_str'].tolist(),
@@ -0,0 +1,422 @@
+import os
+import sys
+import argparse
+import pickle
+import yaml
+import numpy as np
+import pandas as pd
+from custom_strategy import SignalRanking, TradabilityMatrix
+
+# Array-level backtest of the TopK-skip-dropout strategy family (custom_strategy.TopKSkipStrategy)
+# for comparing topk / n_drop / n_skip settings or score transformations without a full PortAnaRecord run.
+#
+# Prices, factors and tradability flags are dense (date x instrument) arrays loaded once (MarketArrays),
+# and the signal is ranked once per date (SignalRanking). A trading day then only touches the held and
+# candidate columns: no Exchange lookups, Order objects, position copies or per-step indicators.
+#
+# The account follows qlib's Exchange / Position / Account rules for a daily close-price exchange:
+# - sells first, then buys, all at the day's $close; a stock is tradable if it has a close and no limit flag
+# - cost = max(value * open_cost / close_cost, min_cost), buys clipped by the available cash
+# - buy amounts rounded to trade_unit shares through $factor (disabled if any factor is missing)
+# - held stocks are marked to the close at the end of the day (suspended stocks keep their last price)
+# and returns the same report_normal frame (account, return, total_turnover, turnover, total_cost, cost,
+# value, cash, bench). Tolerance vs. the qlib backtest: account / return to float rounding (< 1e-12 relative),
+# turnover / cost sums to summation order. Held stocks are visited in qlib's Position order, which is the
+# string hash order of their codes: results (like qlib's) are only reproducible under a fixed PYTHONHASHSEED.
+# The command-line entry points pin it (pin_hash_seed), and so does the sweep for its worker processes.
+#
+#   market = MarketArrays.from_qlib("all", "2010-01-01", "2025-12-31", benchmark="QQQ", limit_threshold=0.095)
+#   report = simulate(pred, market, topk=10, n_drop=1, n_skip=5)
+
+REPORT_COLUMNS = ["account", "return", "total_turnover", "turnover", "total_cost", "cost", "value", "cash", "bench"]
+
+# PYTHONHASHSEED set by pin_hash_seed when none is
+HASH_SEED = "0"
+
+
+def load_config(path="config.yaml"):
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+    return config
+
+
+class MarketArrays:
+    # Dense daily quotes of the backtest universe, same tradability rule as custom_strategy.TradabilityMatrix
+    BUY_OK = TradabilityMatrix.BUY_OK
+    SELL_OK = TradabilityMatrix.SELL_OK
+
+    def __init__(self, dates, instruments, close, factor, limit_buy, limit_sell, bench=None, trade_unit=None,
+                 prev_date=None):
+        # close / factor / limit_*: (date x instrument) arrays; bench: daily benchmark return per date.
+        # prev_date: calendar day before dates[0] (signal date of the first trading day)
+        self.dates = pd.DatetimeIndex(dates)
+        self.instruments = pd.Index(instruments)
+        self.col_of = {name: i for i, name in enumerate(self.instruments)}
+        self.prev_date = None if prev_date is None else pd.Timestamp(prev_date)
+        n_dates, n = np.shape(close)
+
+        # One extra column for instruments without quotes (never tradable)
+        self.close = np.full((n_dates, n + 1), np.nan)
+        self.close[:, :n] = close
+        self.factor = np.full((n_dates, n + 1), np.nan)
+        self.factor[:, :n] = factor
+        active = ~np.isnan(self.close)
+        self.flags = np.zeros((n_dates, n + 1), dtype=np.uint8)
+        self.flags[:, :n] = (
+            (active[:, :n] & ~np.asarray(limit_buy, dtype=bool)) * self.BUY_OK
+            + (active[:, :n] & ~np.asarray(limit_sell, dtype=bool)) * self.SELL_OK
+        )
+        self.bench = np.zeros(n_dates) if bench is None else np.nan_to_num(np.asarray(bench, dtype=np.float64))
+
+        # As the exchange: a missing $factor where there is a close switches to adjusted-price trading
+        if trade_unit is not None and (np.isnan(self.factor) & active).any():
+            print("Missing $factor: trade unit rounding disabled (adjusted price mode).")
+            trade_unit = None
+        self.trade_unit = trade_unit
+
+    @classmethod
+    def from_arrays(cls, arrays, dates, instruments, trade_unit=None, prev_date=None):
+        # Rebuild from the arrays() of another MarketArrays without copying (e.g. attached from shared memory)
+        market = cls.__new__(cls)
+        market.dates = pd.DatetimeIndex(dates)
+        market.instruments = pd.Index(instruments)
+        market.col_of = {name: i for i, name in enumerate(market.instruments)}
+        market.prev_date = None if prev_date is None else pd.Timestamp(prev_date)
+        market.close = arrays["close"]
+        market.factor = arrays["factor"]
+        market.flags = arrays["flags"]
+        market.bench = arrays["bench"]
+        market.trade_unit = trade_unit
+        return market
+
+    def arrays(self):
+        return {"close": self.close, "factor": self.factor, "flags": self.flags, "bench": self.bench}
+
+    @classmethod
+    def from_quote_df(cls, quote_df, bench=None, trade_unit=None, calendar=None, prev_date=None):
+        # From an Exchange.quote_df layout: (instrument, datetime) rows with $close, $factor, limit_buy, limit_sell.
+        # calendar: trading days of the backtest (defaults to the quote dates); bench: Series by date
+        inst_codes, instruments = pd.factorize(quote_df.index.get_level_values("instrument"), sort=True)
+        date_codes, dates = pd.factorize(quote_df.index.get_level_values("datetime"), sort=True)
+        if calendar is not None:
+            dates = pd.DatetimeIndex(calendar)
+            date_codes = dates.get_indexer(quote_df.index.get_level_values("datetime"))
+            keep = date_codes >= 0
+            quote_df, date_codes, inst_codes = quote_df[keep], date_codes[keep], inst_codes[keep]
+
+        shape = (len(dates), len(instruments))
+        arrays = {}
+        for field, fill in [("$close", np.nan), ("$factor", np.nan), ("limit_buy", True), ("limit_sell", True)]:
+            arr = np.full(shape, fill, dtype=np.float64 if field.startswith("$") else bool)
+            arr[date_codes, inst_codes] = quote_df[field].to_numpy()
+            arrays[field] = arr
+
+        if bench is not None:
+            bench = pd.Series(bench).reindex(dates).to_numpy()
+        return cls(dates, instruments, arrays["$close"], arrays["$factor"], arrays["limit_buy"],
+                   arrays["limit_sell"], bench=bench, trade_unit=trade_unit, prev_date=prev_date)
+
+    @classmethod
+    def from_qlib(cls, instruments, start_time, end_time, benchmark=None, limit_threshold=None, trade_unit=None):
+        # Same quotes as the backtest Exchange (qlib must be initialized).
+        # trade_unit defaults to the region's (1 share for REG_US)
+        from qlib.config import C
+        from qlib.data import D
+
+        if isinstance(instruments, str):
+            instruments = D.instruments(instruments)
+        quote_df = D.features(instruments, ["$close", "$factor", "$change"], start_time, end_time, disk_cache=True)
+        quote_df.columns = ["$close", "$factor", "$change"]
+
+        suspended = quote_df["$close"].isna()
+        if limit_threshold is None:
+            quote_df["limit_buy"] = suspended
+            quote_df["limit_sell"] = suspended
+        else:
+            quote_df["limit_buy"] = quote_df["$change"].ge(limit_threshold) | suspended
+            quote_df["limit_sell"] = quote_df["$change"].le(-limit_threshold) | suspended
+
+        bench = None
+        if benchmark is not None:
+            bench_df = D.features([benchmark], ["$close/Ref($close,1)-1"], start_time, end_time)
+            bench = bench_df.groupby(level="datetime").mean().iloc[:, 0].fillna(0)
+
+        calendar = D.calendar(start_time=start_time, end_time=end_time)
+        before = D.calendar(end_time=start_time)
+        prev_date = before[-2] if len(before) > 1 and before[-1] == calendar[0] else (before[-1] if len(before) else None)
+        return cls.from_quote_df(
+            quote_df, bench=bench, calendar=calendar, prev_date=prev_date,
+            trade_unit=C.trade_unit if trade_unit is None else trade_unit,
+        )
+
+
+def pin_hash_seed(reexec=False):
+    # Fixes PYTHONHASHSEED for the processes started from here (spawned workers inherit the environment).
+    # The hash seed of a running interpreter cannot change: with reexec, a script started without a fixed
+    # seed restarts itself under it. Returns the seed in effect.
+    seed = os.environ.get("PYTHONHASHSEED")
+    if seed not in (None, "", "random"):
+        return seed
+    os.environ["PYTHONHASHSEED"] = HASH_SEED
+    if reexec:
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+    return HASH_SEED
+
+
+def _position_order(held, names, code_of):
+    # Held codes in Position.get_stock_list order: a set of the position keys, i.e. string hash order.
+    # Unscored holdings are ranked in this order, so it decides which of them is dropped first: the result
+    # depends on PYTHONHASHSEED (see pin_hash_seed).
+    keys = set(["cash", "now_account_value"] + [names[c] for c in held])
+    return [code_of[name] for name in keys - {"cash", "now_account_value", "cash_delay"}]
+
+
+def _round_by_trade_unit(amount, factor, trade_unit):
+    # Exchange.round_amount_by_trade_unit
+    if trade_unit is None:
+        return amount
+    return (amount * factor + 0.1) // trade_unit * trade_unit / factor
+
+
+def _buy_amount_by_cash_limit(trade_price, cash, cost_ratio, min_cost):
+    # Exchange._get_buy_amount_by_cash_limit
+    if cash < min_cost:
+        return 0.0
+    if cash >= min_cost / cost_ratio + min_cost:
+        return cash / (1 + cost_ratio) / trade_price
+    return (cash - min_cost) / trade_price
+
+
+def simulate(signal, market, topk=10, n_drop=1, n_skip=5, hold_thresh=1, only_tradable=False,
+             forbid_all_trade_at_limit=True, risk_degree=0.95, account=100000,
+             open_cost=0.0015, close_cost=0.0025, min_cost=5.0, start_time=None, end_time=None):
+    # report_normal frame of TopKSkipStrategy(method_buy="top", method_sell="bottom") on `market`.
+    # signal: score Series / DataFrame on a (datetime, instrument) index, a CompactSignal or a SignalRanking.
+    # Defaults are those of TopkDropoutStrategy / Exchange; the trade on date t uses the signal of date t-1.
+    if isinstance(signal, SignalRanking):
+        ranking = signal
+    elif hasattr(signal, "ranking"):
+        ranking = signal.ranking()
+    else:
+        ranking = SignalRanking(signal)
+    date_of = {d: i for i, d in enumerate(ranking.dates)}
+    names = ranking.names
+    col_of_code = np.array([market.col_of.get(name, len(market.instruments)) for name in names], dtype=np.int64)
+    rank_of_code = np.full(len(names), -1, dtype=np.int64)
+
+    need_all = market.BUY_OK | market.SELL_OK
+    need_sell = need_all if forbid_all_trade_at_limit else market.SELL_OK
+    need_buy = need_all if forbid_all_trade_at_limit else market.BUY_OK
+
+    dates = market.dates
+    t0 = 0 if start_time is None else int(dates.searchsorted(pd.Timestamp(start_time), side="left"))
+    t1 = len(dates) if end_time is None else int(dates.searchsorted(pd.Timestamp(end_time), side="right"))
+
+    cash = float(account)
+    held = {}  # ranking code -> [amount, price, holding days]
+    last_value = float(account)
+    total_turnover = total_cost = 0.0
+    rows = []
+    for t in range(t0, t1):
+        close = market.close[t]
+        flags = market.flags[t]
+        day_turnover = day_cost = 0.0
+
+        pred_date = dates[t - 1] if t > 0 else market.prev_date
+        di = date_of.get(pred_date)
+        if di is not None:
+            lo, hi = ranking.offsets[di], ranking.offsets[di + 1]
+            first = min(max(n_skip, 0), hi - lo)
+            # Rank of every instrument on the signal date (-1: unscored)
+            day_codes = ranking.lookup_codes[lo:hi]
+            rank_of_code[day_codes] = ranking.lookup_rank[lo:hi]
+
+            def tradable(codes, need=need_all):
+                return (flags[col_of_code[codes]] & need) == need
+
+            # last position, sorted by score (skipped / unscored names last, in position order)
+            codes = np.array(_position_order(held, names, ranking.code_of), dtype=np.int64)
+            rank = rank_of_code[codes]
+            scored = rank >= first
+            last = list(codes[scored][np.argsort(rank[scored], kind="stable")]) + list(codes[~scored])
+
+            # Best candidates not held, as many as the strategy wants to buy at most
+            n_want = n_drop + topk - len(last)
+            cand = ranking.ranked[lo + first:hi]
+            fresh = ~np.isin(cand, codes) if len(codes) else None
+            if only_tradable:
+                ok = tradable(cand) if fresh is None else tradable(cand) & fresh
+                today = list(cand[np.flatnonzero(ok)[:max(n_want, 1)]])
+            else:
+                pool = cand if fresh is None else cand[fresh]
+                today = list(pool[:n_want]) if n_want >= 0 else list(pool)[:n_want]
+
+            # comb = last + new, best first; unscored names as pandas' Index.union would order them
+            comb_codes = np.array(last + today, dtype=np.int64)
+            rank = rank_of_code[comb_codes]
+            scored = rank >= first
+            unscored = list(comb_codes[~scored])
+            if last and today:
+                unscored = sorted(unscored, key=lambda c: names[c])
+            comb = list(comb_codes[scored][np.argsort(rank[scored], kind="stable")]) + unscored
+
+            # Sell the worst n_drop of comb that we hold
+            if only_tradable:
+                worst = comb[::-1]
+                ok = tradable(np.array(worst, dtype=np.int64)) if worst else np.zeros(0, dtype=bool)
+                drop = set(np.array(worst, dtype=np.int64)[np.flatnonzero(ok)[:max(n_drop, 1)]])
+            else:
+                drop = set(comb[-n_drop:])
+            sell = [c for c in last if c in drop]
+            buy = today[:len(sell) + topk - len(last)]
+            rank_of_code[day_codes] = -1
+
+            for code in [c for c in codes if c in drop]:
+                col = col_of_code[code]
+                if (flags[col] & need_sell) != need_sell or held[code][2] < hold_thresh:
+                    continue
+                # Full position at the close; dropped if the cash cannot cover the cost
+                amount, _, _ = held[code]
+                trade_price = close[col]
+                trade_val = amount * trade_price
+                if cash + trade_val < max(trade_val * close_cost, min_cost):
+                    continue
+                trade_cost = max(trade_val * close_cost, min_cost)
+                if trade_val <= 1e-5:
+                    continue
+                trade_amount = trade_val / trade_price
+                if np.isclose(amount, trade_amount):
+                    del held[code]
+                else:
+                    held[code][0] -= trade_amount
+                cash += trade_val - trade_cost
+                day_turnover += trade_val
+                day_cost += trade_cost
+
+            value = cash * risk_degree / len(buy) if len(buy) > 0 else 0
+            buy = np.array(buy, dtype=np.int64)
+            buy = buy[tradable(buy, need_buy)]
+            cols = col_of_code[buy]
+            prices = close[cols]
+            amounts = _round_by_trade_unit(value / prices, market.factor[t, cols], market.trade_unit)
+            for code, col, trade_price, amount in zip(buy, cols, prices, amounts):
+                if (flags[col] & market.BUY_OK) != market.BUY_OK:
+                    continue
+                factor = market.factor[t, col]
+                trade_val = amount * trade_price
+                if cash < max(trade_val * open_cost, min_cost):
+                    continue
+                if cash < trade_val + max(trade_val * open_cost, min_cost):
+                    max_amount = _buy_amount_by_cash_limit(trade_price, cash, open_cost, min_cost)
+                    amount = _round_by_trade_unit(min(max_amount, amount), factor, market.trade_unit)
+                else:
+                    amount = _round_by_trade_unit(amount, factor, market.trade_unit)
+                trade_val = amount * trade_price
+                if trade_val <= 1e-5:
+                    continue
+                trade_cost = max(trade_val * open_cost, min_cost)
+                if code in held:
+                    held[code][0] += trade_val / trade_price
+                else:
+                    held[code] = [trade_val / trade_price, trade_price, 0]
+                cash -= trade_val + trade_cost
+                day_turnover += trade_val
+                day_cost += trade_cost
+
+        # Mark to the close (suspended stocks keep their price) and count the holding day
+        stock_value = 0
+        for code in _position_order(held, names, ranking.code_of):
+            item = held[code]
+            price = close[col_of_code[code]]
+            if not np.isnan(price):
+                item[1] = price
+            item[2] += 1
+            stock_value += item[0] * item[1]
+        account_value = stock_value + cash
+
+        total_turnover += day_turnover
+        total_cost += day_cost
+        rows.append((
+            account_value, (account_value - last_value + day_cost) / last_value, total_turnover,
+            day_turnover / last_value, total_cost, day_cost / last_value, stock_value, cash, market.bench[t],
+        ))
+        last_value = account_value
+
+    report = pd.DataFrame(rows, index=pd.Index(dates[t0:t1], name="datetime"), columns=REPORT_COLUMNS)
+    return report
+
+
+def strategy_kwargs(port_analysis_config):
+    # simulate() arguments from the PortAnaRecord config (strategy kwargs, account and exchange costs)
+    strategy = dict(port_analysis_config['strategy']['kwargs'])
+    strategy.pop('signal', None)
+    backtest = port_analysis_config['backtest']
+    exchange = backtest.get('exchange_kwargs', {})
+    kwargs = {k: v for k, v in strategy.items() if k in (
+        'topk', 'n_drop', 'n_skip', 'hold_thresh', 'only_tradable', 'forbid_all_trade_at_limit', 'risk_degree')}
+    kwargs.update({k: exchange[k] for k in ('open_cost', 'close_cost', 'min_cost') if k in exchange})
+    kwargs['account'] = backtest.get('account', 100000)
+    kwargs['start_time'] = backtest['start_time']
+    kwargs['end_time'] = backtest['end_time']
+    return kwargs
+
+
+def load_market(config):
+    # MarketArrays for the configured backtest window, universe, benchmark and limit threshold
+    backtest = config['port_analysis_config']['backtest']
+    exchange = backtest.get('exchange_kwargs', {})
+    if exchange.get('deal_price', 'close') not in ('close', '$close'):
+        raise ValueError("fast_backtest only supports deal_price: close")
+    return MarketArrays.from_qlib(
+        config['market'], backtest['start_time'], backtest['end_time'],
+        benchmark=backtest.get('benchmark', config['benchmark']),
+        limit_threshold=exchange.get('limit_threshold'),
+    )
+
+
+def summarize(report):
+    # Same risk analysis as PortAnaRecord (excess return over the benchmark, with and without cost)
+    from qlib.contrib.evaluate import risk_analysis
+
+    return pd.concat({
+        "excess_return_without_cost": risk_analysis(report["return"] - report["bench"], freq="day"),
+        "excess_return_with_cost": risk_analysis(report["return"] - report["bench"] - report["cost"], freq="day"),
+    })
+
+
+def run_fast_backtest(pred_path, out_path=None, **overrides):
+    import qlib
+    from qlib.constant import REG_US
+
+    config = load_config()
+    qlib.init(provider_uri=config['qlib_init']['provider_uri'], region=REG_US)
+
+    with open(pred_path, "rb") as f:
+        pred = pickle.load(f)
+
+    print("Loading market arrays...")
+    market = load_market(config)
+    kwargs = strategy_kwargs(config['port_analysis_config'])
+    kwargs.update(overrides)
+    print(f"Simulating {kwargs}...")
+    report = simulate(pred, market, **kwargs)
+    print(summarize(report))
+
+    if out_path:
+        report.to_pickle(out_path)
+        print(f"Saved report_normal to {out_path}")
+    return report
+
+
+if __name__ == "__main__":
+    pin_hash_seed(reexec=True)
+    parser = argparse.ArgumentParser(description="Fast array backtest of TopKSkipStrategy on a saved pred.pkl")
+    parser.add_argument("pred", help="pred.pkl of a recorder run")
+    parser.add_argument("--out", default=None, help="where to save the report_normal frame")
+    parser.add_argument("--topk", type=int, default=None)
+    parser.add_argument("--n-drop", type=int, default=None)
+    parser.add_argument("--n-skip", type=int, default=None)
+    args = parser.parse_args()
+    overrides = {k: v for k, v in [("topk", args.topk), ("n_drop", args.n_drop), ("n_skip", args.n_skip)]
+                 if v is not None}
+    run_fast_backtest(args.pred, args.out, **overrides)
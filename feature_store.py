@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+from qlib.config import C
+from qlib.data.dataset.handler import DataHandlerLP
+from qlib.utils import init_instance_by_config
+
+# On-disk cache for processed handler output (DK_I / DK_L).
+#
+# Layout of one entry (<root>/<fingerprint>/):
+#   meta.json                    handler class, columns, fingerprint inputs
+#   processors.pkl               fitted infer/learn/shared processors (e.g. RobustZScoreNorm stats)
+#   <key>_values.npy             2D float matrix in Fortran (column-major) order -> columnar, mmap-able
+#   <key>_codes_datetime.npy     MultiIndex codes, so the index is rebuilt without re-factorizing
+#   <key>_codes_instrument.npy
+#   <key>_level_datetime.npy
+#   last_access                  touched on every load, used for LRU eviction
+#
+# With `dtype` (e.g. "float32", memory_budget.py) the frames are cast before they are stored, and the
+# dtype is part of the fingerprint: warm loads map the smaller matrices directly.
+#
+# Warm loads open the matrices with np.load(mmap_mode="r") and wrap them without copying,
+# so the frames are read-only: never run processors on a handler that came from the store.
+
+DATA_KEYS = {DataHandlerLP.DK_I: "infer", DataHandlerLP.DK_L: "learn"}
+
+
+class FeatureStore:
+    def __init__(self, path="feature_store", max_entries=None, max_bytes=None, enabled=True, dtype=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.dtype = dtype
+
+    # --- Fingerprint ---
+    def fingerprint(self, handler):
+        # `handler` is an un-initialized handler (see `_skeleton`), so the feature expressions come
+        # from the class code itself and not only from the config kwargs.
+        payload = {
+            "handler": f"{type(handler).__module__}.{type(handler).__qualname__}",
+            "fields": getattr(handler.data_loader, "fields", None),
+            "processors": {
+                pname: [_describe_processor(p) for p in getattr(handler, pname, [])]
+                for pname in ["shared_processors", "infer_processors", "learn_processors"]
+            },
+            "process_type": getattr(handler, "process_type", None),
+            "instruments": handler.instruments,
+            "start_time": str(handler.start_time),
+            "end_time": str(handler.end_time),
+            "freq": getattr(handler.data_loader, "freq", None),
+            "snapshot": data_snapshot(),
+        }
+        if self.dtype is not None:
+            # Entries of the default dtype keep their key
+            payload["dtype"] = str(np.dtype(self.dtype))
+        blob = json.dumps(payload, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:20]
+
+    # --- Main entry point ---
+    def load_or_build(self, handler_config, refresh=False):
+        # Returns a ready handler. Cold: evaluate expressions + fit processors, then persist.
+        # Warm: open the stored frames zero-copy. `refresh=True` invalidates and rebuilds.
+        handler = _skeleton(handler_config)
+        if not self.enabled:
+            handler.setup_data()
+            cast_handler(handler, self.dtype)
+            return handler
+
+        key = self.fingerprint(handler)
+        if refresh:
+            self.invalidate(key)
+
+        if self.has(key):
+            print(f"Feature store hit: {type(handler).__name__} [{key}]")
+            self._load_into(key, handler)
+            return handler
+
+        print(f"Feature store miss: {type(handler).__name__} [{key}]. Building...")
+        handler.setup_data()
+        cast_handler(handler, self.dtype)
+        self.save(key, handler)
+        self.evict(keep=key)
+        return handler
+
+    def has(self, key):
+        return os.path.exists(os.path.join(self._entry_path(key), "meta.json"))
+
+    def save(self, key, handler):
+        # Write into a temp dir and rename, so a crashed run never leaves a half-written entry
+        final_path = self._entry_path(key)
+        tmp_path = f"{final_path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        meta = {"handler": type(handler).__name__, "created": time.time(), "frames": {}}
+        infer_df = handler._get_df_by_key(DataHandlerLP.DK_I)
+        for data_key, name in DATA_KEYS.items():
+            df = handler._get_df_by_key(data_key)
+            if name != "infer" and df is infer_df:
+                # process_type "append" without learn processors: DK_L is DK_I
+                meta["frames"][name] = "infer"
+                continue
+            _write_frame(tmp_path, name, df)
+            meta["frames"][name] = name
+        meta["columns"] = [list(c) for c in infer_df.columns]
+
+        with open(os.path.join(tmp_path, "processors.pkl"), "wb") as f:
+            pickle.dump(
+                {pname: getattr(handler, pname, []) for pname in ["shared_processors", "infer_processors", "learn_processors"]},
+                f,
+            )
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump(meta, f)
+        _touch(os.path.join(tmp_path, "last_access"))
+
+        shutil.rmtree(final_path, ignore_errors=True)
+        os.replace(tmp_path, final_path)
+
+    def _load_into(self, key, handler):
+        entry = self._entry_path(key)
+        with open(os.path.join(entry, "meta.json"), "r") as f:
+            meta = json.load(f)
+        columns = pd.MultiIndex.from_tuples([tuple(c) for c in meta["columns"]])
+
+        frames = {}
+        for name in ["infer", "learn"]:
+            source = meta["frames"][name]
+            if source not in frames:
+                frames[source] = _read_frame(entry, source, columns)
+            frames[name] = frames[source]
+
+        with open(os.path.join(entry, "processors.pkl"), "rb") as f:
+            for pname, procs in pickle.load(f).items():
+                setattr(handler, pname, procs)
+
+        # Raw data is not stored
+        handler._data = None
+        handler.drop_raw = True
+        handler._infer = frames["infer"]
+        handler._learn = frames["learn"]
+        _touch(os.path.join(entry, "last_access"))
+
+    # --- Eviction / invalidation ---
+    def entries(self):
+        # [(key, size_bytes, last_access)] sorted from least to most recently used
+        if not os.path.isdir(self.path):
+            return []
+        res = []
+        for key in os.listdir(self.path):
+            entry = self._entry_path(key)
+            if not os.path.exists(os.path.join(entry, "meta.json")):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, fn)) for fn in os.listdir(entry))
+            res.append((key, size, os.path.getmtime(os.path.join(entry, "last_access"))))
+        return sorted(res, key=lambda x: x[2])
+
+    def invalidate(self, key):
+        # NOTE: on Windows an entry that is still memory-mapped by a live process cannot be deleted
+        shutil.rmtree(self._entry_path(key), ignore_errors=True)
+
+    def clear(self):
+        for key, _, _ in self.entries():
+            self.invalidate(key)
+
+    def evict(self, keep=None):
+        # LRU eviction down to max_entries / max_bytes (the entry in `keep` is never evicted)
+        entries = self.entries()
+        count = len(entries)
+        total = sum(size for _, size, _ in entries)
+        for key, size, _ in entries:
+            over_count = self.max_entries is not None and count > self.max_entries
+            over_size = self.max_bytes is not None and total > self.max_bytes
+            if not (over_count or over_size):
+                break
+            if key == keep:
+                continue
+            print(f"Feature store: evicting {key} ({size / 1e9:.2f} GB)")
+            self.invalidate(key)
+            count -= 1
+            total -= size
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key)
+
+
+def data_snapshot():
+    # Identifies the provider data: path + size/mtime of the calendar and instrument files, and the
+    # count / total size / latest mtime of the feature .bin files (a corrected re-dump of some features
+    # leaves the calendar as it was)
+    uri = C.dpm.get_data_uri("day")
+    stats = {"provider_uri": str(uri)}
+    for sub in ["calendars", "instruments"]:
+        folder = os.path.join(uri, sub)
+        if not os.path.isdir(folder):
+            continue
+        for fn in sorted(os.listdir(folder)):
+            st = os.stat(os.path.join(folder, fn))
+            stats[f"{sub}/{fn}"] = [st.st_size, st.st_mtime_ns]
+
+    folder = os.path.join(uri, "features")
+    if os.path.isdir(folder):
+        count, size, mtime = 0, 0, 0
+        for inst in os.scandir(folder):
+            if not inst.is_dir():
+                continue
+            for entry in os.scandir(inst.path):
+                if entry.name.endswith(".bin"):
+                    st = entry.stat()
+                    count += 1
+                    size += st.st_size
+                    mtime = max(mtime, st.st_mtime_ns)
+        stats["features"] = [count, size, mtime]
+    return stats
+
+
+def cast_handler(handler, dtype):
+    # Casts the processed frames (DK_I / DK_L) to `dtype`; a frame shared by both keys stays shared
+    if dtype is None:
+        return
+    dtype = np.dtype(dtype)
+    infer_df = handler._infer
+    learn_df = handler._learn
+    handler._infer = _cast_frame(infer_df, dtype)
+    handler._learn = handler._infer if learn_df is infer_df else _cast_frame(learn_df, dtype)
+
+
+def _cast_frame(df, dtype):
+    if all(dt == dtype for dt in df.dtypes):
+        return df
+    return df.astype(dtype)
+
+
+def _skeleton(handler_config):
+    # Handler with loader and (un-fitted) processors configured but no data loaded
+    if isinstance(handler_config, DataHandlerLP):
+        return handler_config
+    return init_instance_by_config(handler_config, accept_types=DataHandlerLP, init_data=False)
+
+
+def _describe_processor(proc):
+    return [type(proc).__name__, {k: v for k, v in sorted(vars(proc).items())}]
+
+
+def _write_frame(path, name, df):
+    values = df.to_numpy()
+    np.save(os.path.join(path, f"{name}_values.npy"), np.asfortranarray(values))
+    for level_name, level, codes in zip(df.index.names, df.index.levels, df.index.codes):
+        np.save(os.path.join(path, f"{name}_codes_{level_name}.npy"), np.asarray(codes))
+        if level_name == "datetime":
+            np.save(os.path.join(path, f"{name}_level_{level_name}.npy"), level.values.astype("datetime64[ns]"))
+        else:
+            with open(os.path.join(path, f"{name}_level_{level_name}.json"), "w") as f:
+                json.dump(level.tolist(), f)
+
+
+def _read_frame(path, name, columns):
+    values = np.load(os.path.join(path, f"{name}_values.npy"), mmap_mode="r")
+    levels, codes = [], []
+    for level_name in ["datetime", "instrument"]:
+        codes.append(np.load(os.path.join(path, f"{name}_codes_{level_name}.npy")))
+        if level_name == "datetime":
+            levels.append(pd.DatetimeIndex(np.load(os.path.join(path, f"{name}_level_{level_name}.npy"))))
+        else:
+            with open(os.path.join(path, f"{name}_level_{level_name}.json"), "r") as f:
+                levels.append(pd.Index(json.load(f)))
+    index = pd.MultiIndex(levels=levels, codes=codes, names=["datetime", "instrument"], verify_integrity=False)
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def _touch(path):
+    with open(path, "a"):
+        os.utime(path, None)
+
+
+if __name__ == "__main__":
+    import yaml
+
+    parser = argparse.ArgumentParser(description="Inspect / evict / clear the feature store")
+    parser.add_argument("action", choices=["list", "evict", "clear", "invalidate"])
+    parser.add_argument("key", nargs="?")
+    args = parser.parse_args()
+
+    with open("config.yaml", "r") as f:
+        store = FeatureStore(**yaml.safe_load(f).get("feature_store", {}))
+
+    if args.action == "list":
+        for key, size, last_access in store.entries():
+            print(f"{key}  {size / 1e9:8.2f} GB  last used {time.ctime(last_access)}")
+    elif args.action == "evict":
+        store.evict()
+    elif args.action == "clear":
+        store.clear()
+    elif args.action == "invalidate":
+        store.invalidate(args.key)
@@ -0,0 +1,74 @@
+from qlib.contrib.data.handler import Alpha158, check_transform_proc
+from qlib.data.dataset.handler import DataHandlerLP
+
+# Distance from MA features used by the Choppy expert
+DIST_MA_FIELDS = [
+    "($close - Mean($close, 10)) / Mean($close, 10)",
+    "($close - Mean($close, 20)) / Mean($close, 20)",
+    "($close - Mean($close, 60)) / Mean($close, 60)",
+]
+DIST_MA_NAMES = ["DIST_MA10", "DIST_MA20", "DIST_MA60"]
+
+
+class CustomHandler(Alpha158):
+    # Monolithic Alpha158 + DIST_MA handler.
+    # Prefer Alpha158 + FeatureExtensionHandler through ExtendedDatasetH (see moe_data.py),
+    # which evaluates the 158 base expressions only once when both feature sets are needed.
+    def get_feature_config(self):
+        # Alpha158 returns a tuple: (fields, names)
+        base_conf = super().get_feature_config()
+        fields = list(base_conf[0])
+        names = list(base_conf[1])
+
+        fields.extend(DIST_MA_FIELDS)
+        names.extend(DIST_MA_NAMES)
+
+        return (fields, names)
+
+
+class FeatureExtensionHandler(DataHandlerLP):
+    # Computes ONLY the extra feature columns of a feature group.
+    # Accepts the same kwargs as Alpha158 (i.e. `data_handler_config`) so the extension is
+    # normalized with the same infer processors and fit window as the base handler.
+    # Processors like RobustZScoreNorm / Fillna work column by column, so the extension columns
+    # come out identical to the ones CustomHandler would produce.
+    # Label and learn processors are ignored: rows are always aligned to the base handler's frame.
+    def __init__(
+        self,
+        fields=DIST_MA_FIELDS,
+        names=DIST_MA_NAMES,
+        instruments="csi500",
+        start_time=None,
+        end_time=None,
+        freq="day",
+        infer_processors=[],
+        fit_start_time=None,
+        fit_end_time=None,
+        filter_pipe=None,
+        inst_processors=None,
+        **kwargs,
+    ):
+        kwargs.pop("label", None)
+        kwargs.pop("learn_processors", None)
+        infer_processors = check_transform_proc(infer_processors, fit_start_time, fit_end_time)
+
+        data_loader = {
+            "class": "QlibDataLoader",
+            "kwargs": {
+                "config": {
+                    "feature": (list(fields), list(names)),
+                },
+                "filter_pipe": filter_pipe,
+                "freq": freq,
+                "inst_processors": inst_processors,
+            },
+        }
+        super().__init__(
+            instruments=instruments,
+            start_time=start_time,
+            end_time=end_time,
+            data_loader=data_loader,
+            infer_processors=infer_processors,
+            learn_processors=[],
+            **kwargs,
+        )
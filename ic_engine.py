@@ -0,0 +1,180 @@
+import numpy as np
+import pandas as pd
+
+# Cross-sectional (per-date) IC metrics for all dates in one NumPy pass.
+#
+# Rows are grouped by date with integer date codes (the datetime level codes of a qlib
+# (datetime, instrument) index). Ranking within each date is one lexsort over (date, value), and
+# per-date sums come from np.bincount, so there is no Python loop (or pandas groupby.apply) per date.
+#
+#   daily, summary = evaluate(pred, label)        # pred / label: Series on a (datetime, instrument) index
+#   feval = daily_rank_ic_feval(x_valid.index, y_valid)   # LightGBM early stopping on daily rank IC
+
+
+def date_codes(index):
+    # (integer date id per row, dates) from a (datetime, instrument) MultiIndex or a DatetimeIndex
+    if isinstance(index, pd.MultiIndex):
+        level = index.names.index("datetime")
+        return np.asarray(index.codes[level], dtype=np.int64), index.levels[level]
+    codes, dates = pd.factorize(index, sort=True)
+    return codes.astype(np.int64), dates
+
+
+class DateSegments:
+    # Row -> date grouping shared by all per-date reductions of one index
+    def __init__(self, codes, n_dates=None):
+        self.codes = np.asarray(codes, dtype=np.int64)
+        if n_dates is None:
+            n_dates = int(self.codes.max()) + 1 if len(self.codes) else 0
+        self.n_dates = n_dates
+        self.counts = np.bincount(self.codes, minlength=n_dates)
+        # Offset of each date's first row once rows are sorted by date
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+
+    def sum(self, x):
+        return np.bincount(self.codes, weights=x, minlength=self.n_dates)
+
+    def mean(self, x):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum(x) / self.counts
+
+    def rank(self, values):
+        # 1-based rank within each date; ties share their average rank (as pandas rank / scipy rankdata)
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return np.empty(0)
+        order = np.lexsort((values, self.codes))
+        v = values[order]
+        c = self.codes[order]
+
+        new_group = np.ones(n, dtype=bool)
+        new_group[1:] = (v[1:] != v[:-1]) | (c[1:] != c[:-1])
+        group_start = np.flatnonzero(new_group)
+        group_end = np.append(group_start[1:], n)
+        group_rank = (group_start + group_end - 1) / 2.0 - self.starts[c[group_start]] + 1
+
+        ranks = np.empty(n)
+        ranks[order] = np.repeat(group_rank, group_end - group_start)
+        return ranks
+
+    def corr(self, x, y):
+        # Pearson correlation per date; NaN for dates with < 2 rows or no variance
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        dx = x - self.mean(x)[self.codes]
+        dy = y - self.mean(y)[self.codes]
+        sxy = self.sum(dx * dy)
+        sxx = self.sum(dx * dx)
+        syy = self.sum(dy * dy)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            res = sxy / np.sqrt(sxx * syy)
+        res[self.counts < 2] = np.nan
+        return res
+
+
+def _valid_rows(pred, label):
+    return np.isfinite(pred) & np.isfinite(label)
+
+
+def daily_ic(pred, label, index=None):
+    # DataFrame (datetime x [ic, rank_ic, count]) of per-date Pearson and Spearman IC.
+    # pred / label: Series on the same index, or arrays together with `index`.
+    index = pred.index if index is None else index
+    pred = np.asarray(pred, dtype=np.float64).ravel()
+    label = np.asarray(label, dtype=np.float64).ravel()
+    codes, dates = date_codes(index)
+
+    mask = _valid_rows(pred, label)
+    segs = DateSegments(codes[mask], n_dates=len(dates))
+    p, l = pred[mask], label[mask]
+
+    res = pd.DataFrame({
+        "ic": segs.corr(p, l),
+        "rank_ic": segs.corr(segs.rank(p), segs.rank(l)),
+        "count": segs.counts,
+    }, index=pd.Index(dates, name="datetime"))
+    return res[res["count"] > 0]
+
+
+def ic_summary(daily):
+    # Mean / std / IR of the daily IC series (same definitions as qlib's SigAnaRecord)
+    ic = daily["ic"]
+    rank_ic = daily["rank_ic"]
+    return {
+        "IC": ic.mean(),
+        "ICStd": ic.std(),
+        "ICIR": ic.mean() / ic.std(),
+        "Rank IC": rank_ic.mean(),
+        "Rank ICStd": rank_ic.std(),
+        "Rank ICIR": rank_ic.mean() / rank_ic.std(),
+        "Dates": int(ic.notna().sum()),
+    }
+
+
+def quantile_returns(pred, label, index=None, n_quantiles=5):
+    # DataFrame (datetime x Q1..Qn) of the mean label per prediction quantile (Q1 = lowest scores),
+    # plus "spread" = Qn - Q1 (long-short return of the top vs bottom bucket)
+    index = pred.index if index is None else index
+    pred = np.asarray(pred, dtype=np.float64).ravel()
+    label = np.asarray(label, dtype=np.float64).ravel()
+    codes, dates = date_codes(index)
+
+    mask = _valid_rows(pred, label)
+    segs = DateSegments(codes[mask], n_dates=len(dates))
+    p, l = pred[mask], label[mask]
+
+    # Rank percentile within the date -> bucket 0..n-1
+    with np.errstate(invalid="ignore", divide="ignore"):
+        pct = (segs.rank(p) - 0.5) / segs.counts[segs.codes]
+    bucket = np.minimum((pct * n_quantiles).astype(np.int64), n_quantiles - 1)
+
+    cell = segs.codes * n_quantiles + bucket
+    size = segs.n_dates * n_quantiles
+    counts = np.bincount(cell, minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.bincount(cell, weights=l, minlength=size) / counts
+
+    cols = [f"Q{i + 1}" for i in range(n_quantiles)]
+    res = pd.DataFrame(means.reshape(segs.n_dates, n_quantiles), index=pd.Index(dates, name="datetime"), columns=cols)
+    res["spread"] = res[cols[-1]] - res[cols[0]]
+    return res[segs.counts > 0]
+
+
+def evaluate(pred, label, n_quantiles=5):
+    # (daily IC frame, summary dict incl. mean quantile spread) for aligned pred / label Series
+    if isinstance(pred, pd.DataFrame):
+        pred = pred.iloc[:, 0]
+    if isinstance(label, pd.DataFrame):
+        label = label.iloc[:, 0]
+    label = label.reindex(pred.index)
+
+    daily = daily_ic(pred, label)
+    quantiles = quantile_returns(pred, label, n_quantiles=n_quantiles)
+    daily = daily.join(quantiles)
+
+    summary = ic_summary(daily)
+    summary["Spread"] = daily["spread"].mean()
+    return daily, summary
+
+
+def daily_rank_ic_feval(index, label, eval_period=1, name="rank_ic", n_rounds=None):
+    # LightGBM feval: mean daily rank IC of the valid predictions (higher is better).
+    # Date grouping and label ranks are computed once; each evaluation is one lexsort + bincounts.
+    # With eval_period > 1 the value is recomputed on the first round, every eval_period-th round and the
+    # last one (n_rounds), and repeated in between: early stopping can only pick those rounds.
+    codes = index if isinstance(index, np.ndarray) else date_codes(index)[0]
+    segs = DateSegments(codes)
+    label_rank = segs.rank(np.asarray(label, dtype=np.float64).ravel())
+    state = {"calls": 0, "value": 0.0}
+
+    def feval(preds, eval_data):
+        calls = state["calls"]
+        if calls == 0 or (calls + 1) % eval_period == 0 or calls + 1 == n_rounds:
+            daily = segs.corr(segs.rank(preds), label_rank)
+            # Constant predictions (e.g. the first rounds of a shallow model) carry no ranking: IC 0
+            state["value"] = float(np.nanmean(daily)) if np.isfinite(daily).any() else 0.0
+        state["calls"] += 1
+        return name, state["value"], True
+
+    return feval
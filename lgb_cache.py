@@ -0,0 +1,118 @@
+import os
+import json
+import hashlib
+import numpy as np
+import lightgbm as lgb
+
+# Cache of LightGBM binned datasets (lgb.Dataset in LightGBM's binary format).
+#
+# Histogram binning of the training matrix is a fixed cost of every fit. Datasets are built once per
+# (feature set, regime, segment), saved with save_binary and reloaded by later fits / tuning trials.
+# Validation sets are always binned with the training set as reference.
+#
+# The file name carries a fingerprint of the data (columns, shape, dtype and every value and label, in
+# row-major order whatever the memory layout or index) and of the binning params, so changed data or
+# binning settings never hit a stale file, and the same rows hit the same file from every path
+# (feature-store frames of the serial fits / tuning, RangeIndex copies of the parallel expert workers).
+
+# Rows hashed per step (bounds the row-major copy of a Fortran-ordered matrix)
+HASH_CHUNK_ROWS = 65536
+
+# Params that change how a Dataset is binned. Everything else can vary between fits on the same Dataset.
+BINNING_PARAMS = [
+    "max_bin", "min_data_in_bin", "bin_construct_sample_cnt", "subsample_for_bin",
+    "data_random_seed", "seed", "use_missing", "zero_as_missing", "linear_tree",
+]
+
+# feature_pre_filter=False lets trials change min_data_in_leaf on an already binned Dataset
+BASE_DATASET_PARAMS = {"feature_pre_filter": False, "verbosity": -1}
+
+
+def dataset_params(params):
+    res = dict(BASE_DATASET_PARAMS)
+    res.update({k: v for k, v in params.items() if k in BINNING_PARAMS})
+    return res
+
+
+def data_fingerprint(x, y):
+    h = hashlib.sha256()
+    h.update(json.dumps([str(c) for c in getattr(x, "columns", [])]).encode("utf-8"))
+    values = np.asarray(x)
+    h.update(f"{values.shape}|{values.dtype}".encode("utf-8"))
+    _hash_rows(h, values)
+    # Labels as LightGBM gets them
+    _hash_rows(h, _label(y))
+    return h.hexdigest()[:16]
+
+
+def _hash_rows(h, values):
+    # Values in row-major order, HASH_CHUNK_ROWS rows at a time (no copy of a C-contiguous matrix)
+    for start in range(0, len(values), HASH_CHUNK_ROWS):
+        h.update(np.ascontiguousarray(values[start:start + HASH_CHUNK_ROWS]).reshape(-1).view(np.uint8))
+
+
+def _label(y):
+    return np.asarray(y, dtype=np.float64).ravel()
+
+
+class BinnedDatasetCache:
+    def __init__(self, path="lgb_cache"):
+        self.path = path
+        # Datasets already loaded in this process, so repeated trials share the same object
+        self._loaded = {}
+
+    def get(self, name, x, y, params, reference=None):
+        # name: e.g. "choppy_0_train" (feature set, regime, segment)
+        fp = self.fingerprint(name, x, y, params, reference)
+        if fp in self._loaded:
+            return self._loaded[fp]
+
+        file_path = os.path.join(self.path, f"{name}_{fp}.bin")
+        if os.path.exists(file_path):
+            print(f"LightGBM dataset cache hit: {name}")
+            ds = lgb.Dataset(file_path, reference=reference, params=dataset_params(params))
+        else:
+            print(f"LightGBM dataset cache miss: {name}. Binning...")
+            ds = lgb.Dataset(x, label=_label(y), reference=reference, params=dataset_params(params), free_raw_data=True)
+            ds.construct()
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = f"{file_path}.tmp{os.getpid()}"
+            ds.save_binary(tmp_path)
+            os.replace(tmp_path, file_path)
+
+        ds._cache_fingerprint = fp
+        ds._cache_file = file_path
+        self._loaded[fp] = ds
+        return ds
+
+    def get_pair(self, name, x_train, y_train, x_valid, y_valid, params):
+        train_set = self.get(f"{name}_train", x_train, y_train, params)
+        valid_set = self.get(f"{name}_valid", x_valid, y_valid, params, reference=train_set)
+        return train_set, valid_set
+
+    def fingerprint(self, name, x, y, params, reference=None):
+        parts = [name, data_fingerprint(x, y), json.dumps(dataset_params(params), sort_keys=True)]
+        if reference is not None:
+            parts.append(getattr(reference, "_cache_fingerprint", ""))
+        return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def build_datasets(x_train, y_train, x_valid, y_valid, params, cache=None, name=None):
+    # Train/valid lgb.Dataset pair, from the cache when one is given
+    if cache is not None and name is not None:
+        return cache.get_pair(name, x_train, y_train, x_valid, y_valid, params)
+    train_set = lgb.Dataset(x_train, label=_label(y_train), params=dataset_params(params), free_raw_data=True)
+    valid_set = lgb.Dataset(x_valid, label=_label(y_valid), reference=train_set, params=dataset_params(params), free_raw_data=True)
+    return train_set, valid_set
+
+
+def train_booster(params, train_set, valid_set, callbacks, feval=None, init_model=None, num_boost_round=None):
+    # lgb.train with LGBMRegressor-style params (n_estimators -> num_boost_round).
+    # init_model continues boosting from an existing Booster; valid_set may be None (fixed rounds).
+    train_params = dict(params)
+    n_estimators = train_params.pop("n_estimators", 100)
+    if num_boost_round is None:
+        num_boost_round = n_estimators
+    valid_sets = [valid_set] if valid_set is not None else None
+    return lgb.train(train_params, train_set, num_boost_round=num_boost_round, valid_sets=valid_sets,
+                     feval=feval, callbacks=callbacks, init_model=init_model)
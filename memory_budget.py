@@ -0,0 +1,262 @@
+import os
+import gc
+import sys
+import time
+import argparse
+import itertools
+import threading
+import numpy as np
+import pandas as pd
+from qlib.data.dataset.handler import DataHandlerLP
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Memory-budget mode of run_adaptive_strategy (config `memory`).
+#
+#   - handler frames are cast to `dtype` (float32) at the feature store boundary, so every prepared
+#     segment, training subset, shared-memory copy and LightGBM input is half the size of float64
+#   - handler data keys nobody reads are dropped (raw data, DK_I once the labels are taken) and all
+#     frames are released once the scores exist
+#   - before a segment is prepared its size is estimated; if it would take the process over
+#     `budget_gb` it is refused (on_exceed: "raise") or prepared date chunk by date chunk into a
+#     memory-mapped file (on_exceed: "spill"), so only one chunk is in RAM at a time
+#   - peak RSS (sampled every `interval` s) is reported per stage
+#
+#   memory = MemoryBudget(**config.get('memory', {}))
+#   memory.stage("training")
+#   df = memory.prepare(dataset_std, "test", col_set=["feature", "label"], data_key=DataHandlerLP.DK_L, name="std")
+#   memory.report()
+#
+# float32 vs float64: compare the raw_pred.pkl of a run with dtype "float64" and one with "float32"
+#
+#   python memory_budget.py compare <float32 run>/raw_pred.pkl <float64 run>/raw_pred.pkl --tolerance 1e-3
+
+# Prepare copies the segment out of the handler frame (column selection, concat of extension columns):
+# the peak is about twice the size of the result
+PREPARE_OVERHEAD = 2.0
+
+# Bytes per row of the (datetime, instrument) index codes
+INDEX_ROW_BYTES = 16
+
+
+def current_rss():
+    # Resident set size of this process in bytes, None where it cannot be read
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def release_data_keys(handler, keep=()):
+    # Drops the frames of the handler's data keys that are not in `keep` (a frame shared with a kept key stays).
+    # A later fetch of a released key fails: only call this once nothing reads those keys anymore.
+    kept = [handler._get_df_by_key(k) for k in keep]
+    for data_key, attr in [(DataHandlerLP.DK_R, "_data"), (DataHandlerLP.DK_I, "_infer"), (DataHandlerLP.DK_L, "_learn")]:
+        df = getattr(handler, attr, None)
+        if data_key in keep or df is None or any(df is k for k in kept):
+            continue
+        setattr(handler, attr, None)
+
+
+class MemoryBudget:
+    def __init__(self, enabled=False, dtype="float32", budget_gb=None, on_exceed="spill", spill_path="spill",
+                 chunk_days=250, interval=0.05, tolerance=None):
+        if on_exceed not in ("spill", "raise"):
+            raise ValueError(f"memory on_exceed must be 'spill' or 'raise', got {on_exceed!r}")
+        self.enabled = enabled
+        # Feature store dtype (None: frames as the handlers produce them)
+        self.dtype = dtype if enabled else None
+        self.budget = budget_gb * 1e9 if enabled and budget_gb else None
+        self.on_exceed = on_exceed
+        self.spill_path = spill_path
+        self.chunk_days = chunk_days
+        self.interval = interval
+        self.tolerance = tolerance
+        self.stages = []
+        self._spilled = []
+        # Spill file numbers (next() is atomic, prepare may run in several threads)
+        self._spill_ids = itertools.count()
+        self._current = None
+        self._sampler = None
+        self._stop = threading.Event()
+
+    # --- Peak memory per stage ---
+    def stage(self, name):
+        # Ends the current stage and starts `name`
+        if not self.enabled:
+            return
+        self._end_stage()
+        gc.collect()
+        rss = current_rss()
+        self._current = {"stage": name, "start_rss": rss, "peak_rss": rss, "start": time.time()}
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, args=(self._current,), daemon=True)
+        self._sampler.start()
+
+    def _sample(self, stage):
+        while not self._stop.wait(self.interval):
+            rss = current_rss()
+            if rss is not None:
+                stage["peak_rss"] = max(stage["peak_rss"] or 0, rss)
+
+    def _end_stage(self):
+        if self._current is None:
+            return
+        self._stop.set()
+        self._sampler.join()
+        stage = self._current
+        stage["end_rss"] = current_rss()
+        if stage["end_rss"] is not None:
+            stage["peak_rss"] = max(stage["peak_rss"] or 0, stage["end_rss"])
+        stage["seconds"] = round(time.time() - stage.pop("start"), 1)
+        self.stages.append(stage)
+        self._current = None
+
+    def report(self):
+        if not self.enabled:
+            return
+        self._end_stage()
+        if current_rss() is None:
+            print("Memory report unavailable (install psutil to read the RSS on this platform)")
+            return
+        budget = f", budget {self.budget / 1e9:.2f} GB" if self.budget else ""
+        print(f"Peak memory per stage (RSS, sampled every {self.interval}s{budget}):")
+        for stage in self.stages:
+            print(f"  {stage['stage']:<14} start {stage['start_rss'] / 1e9:7.2f} GB  peak {stage['peak_rss'] / 1e9:7.2f} GB  "
+                  f"end {stage['end_rss'] / 1e9:7.2f} GB  ({stage['seconds']}s)")
+
+    # --- Budget ---
+    def prepare(self, dataset, segment, col_set=DataHandlerLP.CS_ALL, data_key=DataHandlerLP.DK_I, name="dataset"):
+        # dataset.prepare(segment, ...) if the result fits the budget, otherwise refused or spilled to disk.
+        # `segment`: a segment name of the dataset or a slice of dates.
+        if self.budget is None:
+            return dataset.prepare(segment, col_set=col_set, data_key=data_key)
+
+        slc = slice(*dataset.segments[segment]) if isinstance(segment, str) else segment
+        index = dataset.handler._get_df_by_key(data_key).index
+        dates = _segment_dates(index, slc)
+        sample = dataset.prepare(slice(dates[0], dates[0]), col_set=col_set, data_key=data_key) if len(dates) else None
+        if sample is None or isinstance(sample, pd.Series):
+            return dataset.prepare(segment, col_set=col_set, data_key=data_key)
+
+        n_rows = _count_rows(index, dates)
+        row_bytes = sum(dt.itemsize for dt in sample.dtypes) + INDEX_ROW_BYTES
+        nbytes = n_rows * row_bytes
+        rss = current_rss() or 0
+        if rss + PREPARE_OVERHEAD * nbytes <= self.budget:
+            return dataset.prepare(segment, col_set=col_set, data_key=data_key)
+
+        msg = (f"{name}: ~{nbytes / 1e9:.2f} GB "
+               f"({n_rows} rows x {sample.shape[1]} columns) with {rss / 1e9:.2f} GB in use, "
+               f"budget {self.budget / 1e9:.2f} GB")
+        if self.on_exceed == "raise":
+            raise MemoryError(f"{msg} (memory.on_exceed: raise)")
+        print(f"{msg}. Spilling to disk...")
+        return self._spill(dataset, dates, col_set, data_key, name, n_rows, sample)
+
+    def _spill(self, dataset, dates, col_set, data_key, name, n_rows, sample):
+        # Prepares `chunk_days` dates at a time into one memory-mapped (Fortran order, as the feature store)
+        # matrix; the returned frame wraps it without copying and is read-only
+        os.makedirs(self.spill_path, exist_ok=True)
+        file_path = os.path.join(self.spill_path, f"{name}_{next(self._spill_ids)}.npy")
+        self._spilled.append(file_path)
+        dtype = np.result_type(*sample.dtypes)
+        values = np.lib.format.open_memmap(file_path, mode="w+", dtype=dtype, shape=(n_rows, sample.shape[1]),
+                                           fortran_order=True)
+
+        # Index codes against the segment dates and the handler's instruments
+        handler_index = dataset.handler._get_df_by_key(data_key).index
+        names = list(sample.index.names)
+        levels = [dates if n == "datetime" else handler_index.levels[handler_index.names.index(n)] for n in names]
+        codes = [[] for _ in names]
+
+        offset = 0
+        for start in range(0, len(dates), self.chunk_days):
+            chunk_dates = dates[start:start + self.chunk_days]
+            df = dataset.prepare(slice(chunk_dates[0], chunk_dates[-1]), col_set=col_set, data_key=data_key)
+            values[offset:offset + len(df)] = df.to_numpy(dtype=dtype)
+            for k, level in enumerate(levels):
+                codes[k].append(level.get_indexer(df.index.levels[k])[df.index.codes[k]])
+            offset += len(df)
+            del df
+        values.flush()
+        del values
+
+        values = np.load(file_path, mmap_mode="r")[:offset]
+        index = pd.MultiIndex(levels=levels, codes=[np.concatenate(c) for c in codes], names=names,
+                              verify_integrity=False)
+        return pd.DataFrame(values, index=index, columns=sample.columns, copy=False)
+
+    def cleanup(self):
+        # Spill files of this run (NOTE: on Windows a file still mapped by a live frame cannot be deleted)
+        for file_path in self._spilled:
+            try:
+                os.remove(file_path)
+            except OSError:
+                pass
+        self._spilled = []
+
+
+def _segment_dates(index, slc):
+    # Dates of the (datetime, instrument) index inside slc (inclusive, as qlib's fetch)
+    dates = index.levels[index.names.index("datetime")]
+    lo, hi = dates.slice_locs(slc.start, slc.stop)
+    return dates[lo:hi]
+
+
+def _count_rows(index, dates):
+    level = index.names.index("datetime")
+    pos = index.levels[level].get_indexer(dates)
+    counts = np.bincount(index.codes[level], minlength=len(index.levels[level]))
+    return int(counts[pos].sum())
+
+
+def compare_predictions(pred, ref):
+    # Scores of two runs (e.g. float32 vs float64 frames) on their common rows
+    from ic_engine import daily_ic
+
+    pred, ref = pred.align(ref, join="inner")
+    valid = np.isfinite(pred.to_numpy()) & np.isfinite(ref.to_numpy())
+    diff = np.abs(pred.to_numpy() - ref.to_numpy())[valid]
+    daily = daily_ic(pred[valid], ref[valid])
+    return {
+        "rows": int(valid.sum()),
+        "max_abs_diff": float(diff.max()) if len(diff) else np.nan,
+        "mean_abs_diff": float(diff.mean()) if len(diff) else np.nan,
+        "min_daily_rank_corr": float(daily["rank_ic"].min()),
+        "mean_daily_rank_corr": float(daily["rank_ic"].mean()),
+    }
+
+
+if __name__ == "__main__":
+    from compact_signal import load_pred
+
+    parser = argparse.ArgumentParser(description="Memory-budget mode tools")
+    sub = parser.add_subparsers(dest="action", required=True)
+    cmp_parser = sub.add_parser("compare", help="compare the scores of two runs (e.g. float32 vs float64)")
+    cmp_parser.add_argument("pred")
+    cmp_parser.add_argument("ref")
+    cmp_parser.add_argument("--tolerance", type=float, default=None,
+                            help="max |score difference| accepted (default: memory.tolerance of config.yaml)")
+    args = parser.parse_args()
+
+    tolerance = args.tolerance
+    if tolerance is None:
+        import yaml
+
+        with open("config.yaml", "r") as f:
+            tolerance = yaml.safe_load(f).get("memory", {}).get("tolerance")
+
+    res = compare_predictions(load_pred(args.pred).iloc[:, 0], load_pred(args.ref).iloc[:, 0])
+    for k, v in res.items():
+        print(f"{k:>22}: {v}")
+    if tolerance is not None:
+        ok = res["max_abs_diff"] <= tolerance
+        print(f"{'within' if ok else 'OUTSIDE'} tolerance {tolerance}")
+        sys.exit(0 if ok else 1)
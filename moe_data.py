@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+from qlib.data.dataset import DatasetH
+from qlib.data.dataset.handler import DataHandler, DataHandlerLP
+from qlib.utils import init_instance_by_config
+
+
+class ExtendedDatasetH(DatasetH):
+    # DatasetH whose "feature" group is the base handler's features plus the columns of one or
+    # more extension handlers (e.g. FeatureExtensionHandler with the DIST_MA fields).
+    # The base handler can be shared with a plain DatasetH, so Alpha158 is computed and stored once:
+    #
+    #   base = Alpha158(**data_handler_config)
+    #   dataset_std = DatasetH(handler=base, segments=segments)
+    #   dataset_choppy = ExtendedDatasetH(handler=base, segments=segments, extensions=[ext])
+    def __init__(self, handler, segments, extensions=(), **kwargs):
+        super().__init__(handler=handler, segments=segments, **kwargs)
+        self.extensions = [init_instance_by_config(ext, accept_types=DataHandler) for ext in extensions]
+
+    def _prepare_seg(self, slc, **kwargs):
+        df = super()._prepare_seg(slc, **kwargs)
+        col_set = kwargs.get("col_set", DataHandler.CS_ALL)
+        if not self.extensions or not _has_feature_group(col_set):
+            return df
+
+        # Extension rows follow the base frame (DK_L rows already went through DropnaLabel)
+        extra = [
+            ext.fetch(slc, col_set="feature", data_key=DataHandlerLP.DK_I).reindex(df.index)
+            for ext in self.extensions
+        ]
+        if col_set == "feature":
+            return pd.concat([df] + extra, axis=1)
+
+        extra = pd.concat(extra, axis=1)
+        extra.columns = pd.MultiIndex.from_product([["feature"], extra.columns])
+
+        # Keep the column layout of a single handler: feature columns (base + extra) first
+        parts = []
+        for group in df.columns.get_level_values(0).unique():
+            parts.append(df[[group]])
+            if group == "feature":
+                parts.append(extra)
+        return pd.concat(parts, axis=1)
+
+
+def _has_feature_group(col_set):
+    if col_set == DataHandler.CS_ALL:
+        return True
+    if isinstance(col_set, str):
+        return col_set == "feature"
+    return "feature" in col_set
+
+
+class RegimePartitionedView:
+    # Prepares each segment of a dataset ONCE and indexes its rows by regime in a single pass.
+    # `regime` is a Series of regime labels indexed by datetime (see get_market_regime).
+    #
+    #   view = RegimePartitionedView(dataset_std, train_regime)
+    #   up_df = view.select("train", 1)     # rows of Uptrend dates only
+    #   valid_df = view.frame("valid")      # full segment, prepared once and reused
+    #
+    # `exclude` (e.g. DataQuality.excluded) maps an index to a bool per row; those rows are left out of rows().
+    # `prepare` (e.g. MemoryBudget.prepare) replaces dataset.prepare for the segment frames.
+    def __init__(self, dataset, regime, col_set=["feature", "label"], data_key=DataHandlerLP.DK_L, name="dataset",
+                 exclude=None, prepare=None):
+        self.dataset = dataset
+        self.name = name
+        self.regime = regime
+        self.exclude = exclude
+        self.prepare = prepare
+        self.col_set = col_set
+        self.data_key = data_key
+        self._frames = {}
+        self._rows = {}
+
+    def frame(self, segment):
+        if segment not in self._frames:
+            if self.prepare is not None:
+                self._frames[segment] = self.prepare(self.dataset, segment, col_set=self.col_set, data_key=self.data_key,
+                                                     name=f"{self.name}_{segment}")
+            else:
+                self._frames[segment] = self.dataset.prepare(segment, col_set=self.col_set, data_key=self.data_key)
+        return self._frames[segment]
+
+    def rows(self, segment, regime_val):
+        # Integer row positions (ascending) of `regime_val` inside the prepared segment
+        if segment not in self._rows:
+            index = self.frame(segment).index
+            self._rows[segment] = partition_rows(index, self.regime, self.exclude(index) if self.exclude else None)
+        return self._rows[segment].get(regime_val, np.empty(0, dtype=np.int64))
+
+    def select(self, segment, regime_val):
+        return take_rows(self.frame(segment), self.rows(segment, regime_val))
+
+    def release(self, segment=None):
+        # Drop cached frames once the experts no longer need them
+        for seg in [segment] if segment is not None else list(self._frames):
+            self._frames.pop(seg, None)
+            self._rows.pop(seg, None)
+
+
+def take_rows(df, pos):
+    # Rows are sorted by datetime, so positions covering one continuous block give a view
+    if len(pos) > 0 and pos[-1] - pos[0] + 1 == len(pos):
+        return df.iloc[pos[0] : pos[-1] + 1]
+    return df.take(pos)
+
+
+def partition_rows(index, regime, excluded=None):
+    # {regime value -> row positions} for a (datetime, instrument) MultiIndex.
+    # Works on the datetime level codes, so the regime lookup is done per unique date and not per row.
+    # Rows flagged in `excluded` (bool per row) are left out.
+    level = index.names.index("datetime")
+    dates = index.levels[level]
+    codes = index.codes[level]
+
+    date_regime = regime.reindex(dates).to_numpy(dtype=float)
+    row_regime = date_regime[codes]
+    if excluded is not None:
+        row_regime = np.where(excluded, np.nan, row_regime)
+
+    order = np.argsort(row_regime, kind="stable")  # NaN (dates without regime) sort last
+    sorted_regime = row_regime[order]
+    n_valid = int((~np.isnan(sorted_regime)).sum())
+    values, starts = np.unique(sorted_regime[:n_valid], return_index=True)
+    ends = np.append(starts[1:], n_valid)
+    return {int(v): order[s:e] for v, s, e in zip(values, starts, ends)}
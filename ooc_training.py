@@ -0,0 +1,174 @@
+import os
+import shutil
+import time
+import numpy as np
+import lightgbm as lgb
+from qlib.data.dataset.handler import DataHandlerLP
+from moe_data import partition_rows
+from experts import EXPERTS, fit_binned
+from lgb_cache import dataset_params
+from stream_inference import segment_dates, date_chunks
+
+# Out-of-core training of the regime experts.
+#
+# The in-memory path prepares the whole train segment and copies each expert's rows into one frame before
+# LightGBM bins it. Here the segments are written once, chunk by chunk (`chunk_months` of dates at a time),
+# to row-major .npy files: the train segment split by regime (excluded rows left out), the valid segment
+# whole. Each expert's lgb.Dataset is then built from those files as a list of lgb.Sequence:
+#
+#   1. bin boundaries from a sample of bin_construct_sample_cnt rows (single-row reads)
+#   2. all rows pushed into the binned Dataset `batch_rows` at a time
+#
+# so the float features of the history are never in memory together: RSS is bounded by one prepared chunk
+# while writing, and by the binned Dataset (1 byte per feature value) + labels while training.
+# Rows keep the order of the in-memory path and LightGBM samples the same rows for binning, so the
+# experts are the same as train_experts'.
+#
+#   models = train_experts_ooc({1: dataset_std, -1: dataset_std, 0: dataset_choppy}, params_map, train_regime)
+
+
+class ChunkFile(lgb.Sequence):
+    # Rows of a row-major .npy matrix, read from the file on demand (no mmap: only the rows asked for are
+    # loaded). Single rows come back as float64 (LightGBM's bin sampling needs doubles), batches as stored.
+    def __init__(self, path, batch_size=65536):
+        self.path = path
+        self.batch_size = batch_size
+        with open(path, "rb") as f:
+            version = np.lib.format.read_magic(f)
+            read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+            shape, fortran_order, self.dtype = read_header(f)
+            self.offset = f.tell()
+        if fortran_order or len(shape) != 2:
+            raise ValueError(f"{path}: expected a row-major 2D matrix")
+        self.n_rows, self.n_cols = shape
+        self._file = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(self.n_rows)
+            if step != 1:
+                return self[list(range(start, stop, step))]
+            return self._read(start, stop - start)
+        if isinstance(idx, list):
+            return np.stack([self._read(i, 1)[0] for i in idx]) if idx else np.empty((0, self.n_cols), dtype=self.dtype)
+        return self._read(int(idx), 1)[0].astype(np.float64)
+
+    def _read(self, start, n_rows):
+        if self._file is None:
+            self._file = open(self.path, "rb")
+        self._file.seek(self.offset + start * self.n_cols * self.dtype.itemsize)
+        return np.fromfile(self._file, dtype=self.dtype, count=n_rows * self.n_cols).reshape(n_rows, self.n_cols)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def sequence_dataset_params(params):
+    # dataset_params for a Dataset built from Sequences. The bin sample rows are drawn in Python there, from
+    # the dataset params without `seed`, so the data_random_seed that LightGBM derives from `seed` (first
+    # draw of its Random(seed) LCG) is set explicitly: the same rows are sampled as for an in-memory matrix.
+    res = dataset_params(params)
+    if "seed" in res and "data_random_seed" not in res:
+        x = (214013 * int(res["seed"]) + 2531011) & 0xFFFFFFFF
+        res["data_random_seed"] = ((x >> 16) & 0x7FFF) % 32767
+    return res
+
+
+class ChunkedSegments:
+    # Date-chunked feature / label files of one dataset, grouped by part:
+    # ("train", regime value) for the train segment split by regime, "valid" for the whole valid segment
+    def __init__(self, path):
+        self.path = path
+        self.parts = {}
+        self.feature_names = None
+
+    def write(self, dataset, segment, regime=None, exclude=None, chunk_months=12, data_key=DataHandlerLP.DK_L):
+        # One prepare per chunk of dates; with `regime`, rows go to one file per regime value
+        os.makedirs(self.path, exist_ok=True)
+        for k, (lo, hi) in enumerate(date_chunks(segment_dates(dataset, segment, data_key), chunk_months)):
+            df = dataset.prepare(slice(lo, hi), col_set=["feature", "label"], data_key=data_key)
+            if self.feature_names is None:
+                self.feature_names = [str(c) for c in df['feature'].columns]
+            x = df['feature'].to_numpy()
+            y = df['label'].to_numpy()
+            if regime is None:
+                self._add(segment, f"{segment}_{k}", x, y)
+            else:
+                rows = partition_rows(df.index, regime, exclude(df.index) if exclude else None)
+                for regime_val, pos in rows.items():
+                    self._add((segment, regime_val), f"{segment}_{regime_val}_{k}", x[pos], y[pos])
+            del df, x, y
+
+    def _add(self, part, file_name, x, y):
+        x_path = os.path.join(self.path, f"{file_name}.npy")
+        np.save(x_path, np.ascontiguousarray(x))
+        np.save(os.path.join(self.path, f"{file_name}_label.npy"), np.asarray(y, dtype=np.float64).ravel())
+        self.parts.setdefault(part, []).append(x_path)
+
+    def n_rows(self, part):
+        return sum(ChunkFile(p).n_rows for p in self.parts.get(part, []))
+
+    def sequences(self, part, batch_size=65536):
+        return [ChunkFile(p, batch_size=batch_size) for p in self.parts.get(part, [])]
+
+    def labels(self, part):
+        return np.concatenate([np.load(p[:-len(".npy")] + "_label.npy") for p in self.parts.get(part, [])])
+
+    def dataset(self, part, params, reference=None, batch_size=65536):
+        # lgb.Dataset streamed from the part's files (bins sampled from them, or taken from `reference`)
+        seqs = self.sequences(part, batch_size)
+        ds = lgb.Dataset(seqs, label=self.labels(part), reference=reference, params=sequence_dataset_params(params),
+                         feature_name=self.feature_names, free_raw_data=True)
+        ds.construct()
+        for seq in seqs:
+            seq.close()
+        return ds
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def train_experts_ooc(dataset_map, params_map, regime, path="ooc_chunks", chunk_months=12, batch_rows=65536,
+                      exclude=None, train_segment="train", valid_segment="valid"):
+    # dataset_map / params_map: regime value -> dataset / LGBM params (as train_experts). Datasets shared by
+    # several regimes are written once. The chunk files are removed once the experts are trained.
+    chunked = {}
+    for regime_val, dataset in dataset_map.items():
+        if id(dataset) in chunked:
+            continue
+        start = time.time()
+        files = ChunkedSegments(os.path.join(path, f"dataset_{len(chunked)}"))
+        files.cleanup()
+        print(f"Writing chunk files of dataset {len(chunked)} ({chunk_months}-month chunks)...")
+        files.write(dataset, train_segment, regime=regime, exclude=exclude, chunk_months=chunk_months)
+        files.write(dataset, valid_segment, chunk_months=chunk_months)
+        print(f"Chunk files written to {files.path} ({time.time() - start:.1f}s)")
+        chunked[id(dataset)] = files
+
+    models = {}
+    try:
+        for regime_val, regime_name in EXPERTS:
+            files = chunked[id(dataset_map[regime_val])]
+            part = (train_segment, regime_val)
+            n_rows = files.n_rows(part)
+            if n_rows == 0 or files.n_rows(valid_segment) == 0:
+                print(f"Warning: No data for {regime_name} regime. Skipping training.")
+                models[regime_val] = None
+                continue
+
+            params = params_map[regime_val]
+            print(f"Training {regime_name} Model ({n_rows} rows from {len(files.parts[part])} chunk files)...")
+            train_set = files.dataset(part, params, batch_size=batch_rows)
+            valid_set = files.dataset(valid_segment, params, reference=train_set, batch_size=batch_rows)
+            models[regime_val] = fit_binned(train_set, valid_set, params)
+            del train_set, valid_set
+            print(f"{regime_name} Model Trained.")
+    finally:
+        for files in chunked.values():
+            files.cleanup()
+    return models
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+
+# Panel layout of prepared (datetime, instrument) data: one C-contiguous (rows x columns) matrix with the
+# rows of each date in one block, CSR-style as CompactSignal.
+#
+#   rows offsets[d]:offsets[d+1] are the instruments of dates[d], codes[i] -> instruments[codes[i]]
+#
+# A date is a dict lookup + two offsets (O(1)), a date range two binary searches, and both are views of
+# the matrix. A regime view is the list of row blocks covering the runs of consecutive dates of one
+# regime: nothing is copied until to_numpy() / to_frame(), and each block is a C-contiguous matrix that
+# LightGBM predicts on without converting it. Features, labels and scores all fit the layout; qlib's
+# MultiIndex frames are converted at the edges:
+#
+#   panel = Panel.from_frame(dataset.prepare("test", col_set="feature"))
+#   day = panel.cross_section("2024-03-01")          # instrument-indexed frame (view)
+#   up = panel.regime_views(test_regime)[1]           # Uptrend dates, blocks of the same matrix
+#   score = pd.Series(scores, index=panel.index)      # back to (datetime, instrument)
+
+
+class Panel:
+    def __init__(self, dates, instruments, offsets, codes, values, columns=None):
+        self.dates = pd.DatetimeIndex(dates)
+        self.instruments = pd.Index(instruments)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.codes = np.asarray(codes)
+        self.values = values
+        self.columns = pd.Index(range(values.shape[1])) if columns is None else columns
+        self._date_pos = None
+
+    @classmethod
+    def from_frame(cls, df, dtype=None):
+        # (datetime, instrument) DataFrame / Series -> Panel. Rows are grouped by date (stable, so the
+        # instrument order within a date is kept); dates without rows are dropped. Copies the values once.
+        if isinstance(df, pd.Series):
+            df = df.to_frame()
+        index = df.index
+        d_level = index.names.index("datetime")
+        i_level = index.names.index("instrument")
+        dates = index.levels[d_level]
+        date_codes = np.asarray(index.codes[d_level], dtype=np.int64)
+
+        # Level positions -> positions among the dates that have rows, in time order
+        counts = np.bincount(date_codes, minlength=len(dates))
+        level_order = np.argsort(dates.values, kind="stable")
+        level_order = level_order[counts[level_order] > 0]
+        new_code = np.full(len(dates), -1, dtype=np.int64)
+        new_code[level_order] = np.arange(len(level_order))
+        date_codes = new_code[date_codes]
+
+        values = df.to_numpy(dtype=dtype)
+        codes = np.asarray(index.codes[i_level])
+        if len(date_codes) > 1 and (np.diff(date_codes) < 0).any():
+            order = np.argsort(date_codes, kind="stable")
+            date_codes, codes, values = date_codes[order], codes[order], values[order]
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(date_codes, minlength=len(level_order)))])
+        return cls(dates[level_order], index.levels[i_level], offsets, codes, np.ascontiguousarray(values),
+                   columns=df.columns)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def date_codes(self):
+        # Date position of each row
+        return np.repeat(np.arange(len(self.dates)), np.diff(self.offsets))
+
+    @property
+    def index(self):
+        # (datetime, instrument) MultiIndex of the rows
+        return pd.MultiIndex(levels=[self.dates, self.instruments], codes=[self.date_codes(), self.codes],
+                             names=["datetime", "instrument"], verify_integrity=False)
+
+    def to_frame(self):
+        # Wraps the matrix without copying
+        return pd.DataFrame(self.values, index=self.index, columns=self.columns, copy=False)
+
+    def with_values(self, values, columns=None):
+        # Panel of other values on the same rows (e.g. scores), sharing dates / offsets / codes
+        values = np.asarray(values)
+        if values.ndim == 1:
+            values = values[:, None]
+        return Panel(self.dates, self.instruments, self.offsets, self.codes, values, columns=columns)
+
+    def group(self, name):
+        # Columns of one group of a (group, name) column index, e.g. "feature" or "label" (a view if they are adjacent)
+        pos = np.flatnonzero(self.columns.get_level_values(0) == name)
+        if len(pos) and pos[-1] - pos[0] + 1 == len(pos):
+            values = self.values[:, pos[0]:pos[-1] + 1]
+        else:
+            values = self.values[:, pos]
+        return Panel(self.dates, self.instruments, self.offsets, self.codes, values,
+                     columns=self.columns[pos].droplevel(0))
+
+    # --- Dates ---
+    def date_pos(self, date):
+        # Position of `date` (None if it has no rows); one dict lookup
+        if self._date_pos is None:
+            self._date_pos = {d: i for i, d in enumerate(self.dates)}
+        return self._date_pos.get(pd.Timestamp(date))
+
+    def rows(self, di):
+        # Row range of date position `di`
+        return int(self.offsets[di]), int(self.offsets[di + 1])
+
+    def cross_section(self, date):
+        # Rows of one date as an instrument-indexed frame (a view), None if the date has no rows
+        di = self.date_pos(date)
+        if di is None:
+            return None
+        lo, hi = self.rows(di)
+        return pd.DataFrame(self.values[lo:hi], columns=self.columns, copy=False,
+                            index=pd.Index(self.instruments[self.codes[lo:hi]], name="instrument"))
+
+    def slice(self, start_time=None, end_time=None):
+        # Panel of the dates within [start_time, end_time], sharing the matrix
+        lo = 0 if start_time is None else np.searchsorted(self.dates, pd.Timestamp(start_time), side="left")
+        hi = len(self.dates) if end_time is None else np.searchsorted(self.dates, pd.Timestamp(end_time), side="right")
+        hi = max(hi, lo)
+        r0, r1 = self.offsets[lo], self.offsets[hi]
+        return Panel(self.dates[lo:hi], self.instruments, self.offsets[lo:hi + 1] - r0, self.codes[r0:r1],
+                     self.values[r0:r1], columns=self.columns)
+
+    # --- Regimes ---
+    def regime_views(self, regime):
+        # {regime value -> PanelView} of a datetime-indexed regime Series; dates without a regime are in no view
+        date_regime = regime.reindex(self.dates).to_numpy(dtype=float)
+        # Runs of consecutive dates with the same regime
+        change = np.flatnonzero(np.diff(date_regime) != 0) + 1
+        starts = np.concatenate([[0], change]) if len(date_regime) else np.empty(0, dtype=np.int64)
+        ends = np.append(starts[1:], len(date_regime)).astype(np.int64)
+        run_regime = date_regime[starts]
+
+        views = {}
+        for regime_val in np.unique(run_regime[~np.isnan(run_regime)]):
+            sel = run_regime == regime_val
+            blocks = np.column_stack([self.offsets[starts[sel]], self.offsets[ends[sel]]])
+            views[int(regime_val)] = PanelView(self, blocks[blocks[:, 1] > blocks[:, 0]])
+        return views
+
+
+class PanelView:
+    # Row blocks [start, end) of a Panel (e.g. the dates of one regime); the blocks are views of its matrix
+    def __init__(self, panel, blocks):
+        self.panel = panel
+        self.blocks = np.asarray(blocks, dtype=np.int64).reshape(-1, 2)
+
+    def __len__(self):
+        return int((self.blocks[:, 1] - self.blocks[:, 0]).sum())
+
+    def iter_blocks(self, values=None):
+        # (start, end, rows of `values`) per block; `values`: the panel's matrix or another one on the same rows
+        values = self.panel.values if values is None else values
+        for start, end in self.blocks:
+            yield start, end, values[start:end]
+
+    def rows(self):
+        # Row positions, ascending
+        if len(self.blocks) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(s, e) for s, e in self.blocks])
+
+    def to_numpy(self):
+        # Rows of all blocks in one matrix (copy)
+        return np.concatenate([v for _, _, v in self.iter_blocks()]) if len(self.blocks) else self.panel.values[:0]
+
+    def to_frame(self):
+        pos = self.rows()
+        return pd.DataFrame(self.to_numpy(), index=self.panel.index[pos], columns=self.panel.columns, copy=False)
@@ -0,0 +1,289 @@
+import warnings
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from qlib.data import ops
+from qlib.data.base import Feature
+
+# Cross-sectional evaluation of qlib feature expressions on the last bars of many instruments.
+#
+# qlib evaluates every expression instrument by instrument on pandas Series, so one date costs about as
+# much as a year: the per (instrument, expression) overhead dominates. Here the raw fields of the lookback
+# window are loaded once as (bars x instruments) panels and each expression tree (qlib's own parser) is
+# evaluated with numpy over all instruments at once. A node only computes the rows its parents need:
+# the last row for the top node, + N - 1 rows below each Rolling(N) (N for Ref).
+#
+# The semantics follow qlib / pandas: rolling windows skip NaN (min_periods=1), Std / Corr use ddof=1,
+# Slope / Rsquare / Resi regress on the bar position as qlib's rolling.pyx, element-wise ops keep the
+# float32 of the stored data. Operators not listed below raise NotImplementedError (the caller computes
+# those fields with D.features).
+#
+#   panel = PanelEvaluator(raw, present)     # raw: {"$close": (bars x instruments) array, ...}
+#   values = panel.evaluate("Mean($close, 5)/$close")    # last bar, one value per instrument
+
+
+def expression(field):
+    from qlib.data.data import ExpressionD
+
+    return ExpressionD.get_expression_instance(field)
+
+
+def lookback(fields):
+    # Bars before the last one that the longest expression needs (qlib's extended window)
+    return max([expression(f).get_extended_window_size()[0] for f in fields] + [0])
+
+
+def raw_fields(fields):
+    # "$name" of every stored field used by the expressions
+    names = set()
+
+    def walk(node):
+        if isinstance(node, Feature):
+            names.add(str(node))
+        for attr in ("feature", "feature_left", "feature_right", "condition"):
+            child = getattr(node, attr, None)
+            if child is not None:
+                walk(child)
+
+    for f in fields:
+        walk(expression(f))
+    return sorted(names)
+
+
+class PanelEvaluator:
+    def __init__(self, raw, present):
+        # raw: {"$field": (bars x instruments) array}, present: bool (bars x instruments), False where the
+        # instrument has no stored bar (before its first bar). Bars are in time order, the last one is evaluated.
+        self.raw = raw
+        self.present = np.asarray(present, dtype=bool)
+        self.n_bars = self.present.shape[0]
+        self._cache = {}
+
+    def evaluate(self, field, n=1):
+        node = field if not isinstance(field, str) else expression(field)
+        with np.errstate(all="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.asarray(self._eval(node, n), dtype=np.float64)
+
+    def _eval(self, node, n):
+        # Last n rows of `node` (n x instruments), or a scalar for constants
+        if isinstance(node, (int, float)):
+            return node
+        key = (str(node), n)
+        if key not in self._cache:
+            self._cache[key] = self._compute(node, n)
+        return self._cache[key]
+
+    def _rows(self, values, n):
+        # Last n rows of a panel, padded on top (NaN / False) if the window is shorter
+        if n <= len(values):
+            return values[len(values) - n:]
+        if values.dtype == bool:
+            pad = np.zeros((n - len(values),) + values.shape[1:], dtype=bool)
+        else:
+            pad = np.full((n - len(values),) + values.shape[1:], np.nan, dtype=np.result_type(values, np.float32))
+        return np.concatenate([pad, values])
+
+    def _compute(self, node, n):
+        if isinstance(node, Feature):
+            return self._rows(self.raw[str(node)], n)
+
+        if isinstance(node, ops.NpElemOperator):
+            return getattr(np, node.func)(self._eval(node.feature, n))
+        if isinstance(node, ops.NpPairOperator):
+            return getattr(np, node.func)(self._eval(node.feature_left, n), self._eval(node.feature_right, n))
+        if isinstance(node, ops.If):
+            return np.where(self._eval(node.condition, n), self._eval(node.feature_left, n),
+                            self._eval(node.feature_right, n))
+
+        if isinstance(node, (ops.Rolling, ops.PairRolling)) and not (isinstance(node.N, int) and node.N > 0):
+            raise NotImplementedError(f"{node}: expanding / EMA windows")
+
+        if isinstance(node, ops.Ref):
+            return self._eval(node.feature, n + node.N)[:n]
+
+        if isinstance(node, ops.PairRolling):
+            N = node.N
+            x = self._windows(self._eval(node.feature_left, n + N - 1), N)
+            y = self._windows(self._eval(node.feature_right, n + N - 1), N)
+            if isinstance(node, ops.Corr):
+                res = _corr(x, y)
+                # qlib: NaN where either side is (almost) constant over the window
+                res[np.isclose(_std(x), 0, atol=2e-05) | np.isclose(_std(y), 0, atol=2e-05)] = np.nan
+                return res
+            if isinstance(node, ops.Cov):
+                return _cov(x, y)
+            raise NotImplementedError(str(node))
+
+        if isinstance(node, ops.Rolling):
+            N = node.N
+            w = self._windows(self._eval(node.feature, n + N - 1), N)
+            func = ROLLING.get(type(node))
+            if func is not None:
+                return func(w)
+            if isinstance(node, ops.Quantile):
+                return _quantile(w, node.qscore)
+            if isinstance(node, (ops.IdxMax, ops.IdxMin)):
+                return _idx_extreme(w, self._present(n + N - 1, N), isinstance(node, ops.IdxMax))
+            if isinstance(node, ops.Rsquare):
+                res = _rsquare(w)
+                res[np.isclose(_std(w), 0, atol=2e-05)] = np.nan
+                return res
+            raise NotImplementedError(str(node))
+
+        raise NotImplementedError(str(node))
+
+    def _present(self, n, N):
+        return sliding_window_view(self._rows(self.present, n), N, axis=0)
+
+    def _windows(self, values, N):
+        # (rows, instruments, N) windows over the time axis, in float64 (as pandas rolling).
+        # Bars before an instrument's first stored bar are NaN: qlib's series does not have them, and
+        # e.g. a comparison on them would be False instead of missing.
+        w = sliding_window_view(np.asarray(values, dtype=np.float64), N, axis=0)
+        return np.where(self._present(len(values), N), w, np.nan)
+
+
+def _count(w):
+    return (~np.isnan(w)).sum(axis=-1)
+
+
+def _sum(w):
+    return np.where(_count(w) > 0, np.nansum(w, axis=-1), np.nan)
+
+
+def _mean(w):
+    return np.nanmean(w, axis=-1)
+
+
+def _std(w):
+    return np.where(_count(w) > 1, np.nanstd(w, axis=-1, ddof=1), np.nan)
+
+
+def _var(w):
+    return np.where(_count(w) > 1, np.nanvar(w, axis=-1, ddof=1), np.nan)
+
+
+def _max(w):
+    return np.nanmax(w, axis=-1)
+
+
+def _min(w):
+    return np.nanmin(w, axis=-1)
+
+
+def _quantile(w, q):
+    # Linear interpolation between the sorted valid values (pandas rolling().quantile)
+    return np.nanquantile(w, q, axis=-1)
+
+
+def _rank(w):
+    # Percentile rank of the last value in its window, ties averaged (pandas rolling().rank(pct=True))
+    last = w[..., -1:]
+    less = (w < last).sum(axis=-1)
+    equal = (w == last).sum(axis=-1)
+    return np.where(np.isnan(last[..., 0]), np.nan, (less + (equal + 1) / 2) / _count(w))
+
+
+def _idx_extreme(w, present, is_max):
+    # 1-based position of the max / min in the window (rolling().apply(argmax + 1, raw=True)).
+    # qlib's series starts at the first stored bar, so its windows are shorter there: bars before it
+    # are skipped here and the position is counted from the first stored bar. A NaN inside the window
+    # wins (numpy argmax / argmin), as in qlib.
+    fill = -np.inf if is_max else np.inf
+    vals = np.where(present, w, fill)
+    pos = np.argmax(vals, axis=-1) if is_max else np.argmin(vals, axis=-1)
+    res = pos - (~present).sum(axis=-1) + 1.0
+    return np.where(_count(w) > 0, res, np.nan)
+
+
+def _regression_sums(w):
+    # Sums of the regression of the window values on the bar position 1..N (NaN bars skipped)
+    valid = ~np.isnan(w)
+    x = np.arange(1, w.shape[-1] + 1, dtype=np.float64)
+    y = np.where(valid, w, 0.0)
+    xv = np.where(valid, x, 0.0)
+    return valid.sum(axis=-1), xv.sum(axis=-1), (xv * xv).sum(axis=-1), y.sum(axis=-1), (y * y).sum(axis=-1), (xv * y).sum(axis=-1)
+
+
+def _slope(w):
+    n, sx, sxx, sy, syy, sxy = _regression_sums(w)
+    return (n * sxy - sx * sy) / (n * sxx - sx * sx)
+
+
+def _resi(w):
+    # Residual of the last bar (NaN if the last bar is NaN)
+    n, sx, sxx, sy, syy, sxy = _regression_sums(w)
+    slope = (n * sxy - sx * sy) / (n * sxx - sx * sx)
+    intercept = sy / n - slope * sx / n
+    return w[..., -1] - (slope * w.shape[-1] + intercept)
+
+
+def _rsquare(w):
+    n, sx, sxx, sy, syy, sxy = _regression_sums(w)
+    r = (n * sxy - sx * sy) / np.sqrt((n * sxx - sx * sx) * (n * syy - sy * sy))
+    return r * r
+
+
+def _pairwise(x, y):
+    # Windows restricted to the bars where both sides are valid (pandas rolling().corr / cov)
+    both = ~(np.isnan(x) | np.isnan(y))
+    return np.where(both, x, np.nan), np.where(both, y, np.nan), both.sum(axis=-1)
+
+
+def _cov(x, y):
+    x, y, n = _pairwise(x, y)
+    dx = x - np.nanmean(x, axis=-1, keepdims=True)
+    dy = y - np.nanmean(y, axis=-1, keepdims=True)
+    return np.where(n > 1, np.nansum(dx * dy, axis=-1) / (n - 1), np.nan)
+
+
+def _corr(x, y):
+    x, y, n = _pairwise(x, y)
+    dx = x - np.nanmean(x, axis=-1, keepdims=True)
+    dy = y - np.nanmean(y, axis=-1, keepdims=True)
+    res = np.nansum(dx * dy, axis=-1) / np.sqrt(np.nansum(dx * dx, axis=-1) * np.nansum(dy * dy, axis=-1))
+    return np.where(n > 1, res, np.nan)
+
+
+# Rolling operators that only need the window values
+ROLLING = {
+    ops.Mean: _mean, ops.Sum: _sum, ops.Std: _std, ops.Var: _var, ops.Max: _max, ops.Min: _min,
+    ops.Rank: _rank, ops.Slope: _slope, ops.Resi: _resi, ops.Count: _count,
+}
+
+
+def load_panel(instruments, fields, date):
+    # Raw fields of the lookback window of `fields` up to `date`, for the instruments listed on `date`.
+    # Returns (PanelEvaluator, instruments with a bar on `date`).
+    from qlib.data import D
+
+    date = pd.Timestamp(date)
+    calendar = D.calendar(end_time=date)
+    if len(calendar) == 0 or calendar[-1] != date:
+        raise ValueError(f"{date.date()} is not a trading day of the calendar")
+    bars = calendar[max(len(calendar) - 1 - lookback(fields), 0):]
+
+    if isinstance(instruments, str):
+        instruments = D.instruments(instruments)
+    if isinstance(instruments, dict):
+        instruments = D.list_instruments(instruments, start_time=date, end_time=date, as_list=True)
+    instruments = sorted(instruments)
+
+    # Listed as plain codes: rows are the stored bars (as qlib's expression engine sees them)
+    df = D.features(instruments, raw_fields(fields), start_time=bars[0], end_time=date)
+    return panel_from_features(df, instruments, bars)
+
+
+def panel_from_features(df, instruments, bars):
+    # (instrument, datetime) frame of raw fields -> (PanelEvaluator, instruments). Only the instruments
+    # with a bar on the last date are kept, so the panel columns and the returned list line up.
+    exists = pd.Series(True, index=df.index).unstack(level=0).reindex(index=bars, columns=instruments)
+    exists = exists.fillna(False).to_numpy(dtype=bool)
+    keep = exists[-1]
+    # From the first stored bar on (stored NaN bars are rows too)
+    present = np.maximum.accumulate(exists, axis=0)[:, keep]
+
+    df = df.reindex(pd.MultiIndex.from_product([instruments, bars], names=df.index.names))
+    raw = {name: df[name].unstack(level=0).reindex(columns=instruments).to_numpy()[:, keep] for name in df.columns}
+    return PanelEvaluator(raw, present), [inst for inst, ok in zip(instruments, keep) if ok]
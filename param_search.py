@@ -0,0 +1,296 @@
+import csv
+import math
+import time
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shared_arrays import SharedArray, attach
+from lgb_cache import build_datasets, dataset_params, train_booster
+from ic_engine import DateSegments, date_codes, daily_rank_ic_feval
+
+# Parallel hyperparameter search for a regime expert.
+#
+# The train/valid matrices are placed in shared memory once. Each worker process attaches to them
+# when it starts, builds (or loads from the binned dataset cache) its lgb.Dataset pair once, and then
+# runs many trials with a small thread budget. Results are appended to a CSV as trials finish, so a
+# long search can be watched (or stopped) while it runs.
+#
+#   trials = expand_grid(param_grid)
+#   res = search_expert(view, 0, trials, base_params, n_workers=5, threads_per_trial=4)
+#   res = search_expert(view, 0, trials, base_params, tuner="halving")   # successive halving on rank IC
+
+
+def expand_grid(param_grid):
+    # {"max_depth": [3, 4], "num_leaves": [8, 16]} -> [{"max_depth": 3, "num_leaves": 8}, ...]
+    keys = list(param_grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*(param_grid[k] for k in keys))]
+
+
+def score_predictions(preds, label, segs):
+    # Daily (per-date) IC / rank IC / ICIR and MSE on the validation rows
+    label = np.asarray(label, dtype=np.float64).ravel()
+    ic = segs.corr(preds, label)
+    rank_ic = segs.corr(segs.rank(preds), segs.rank(label))
+    mse = float(np.mean((preds - label) ** 2))
+    ic = ic[np.isfinite(ic)]
+    rank_ic = rank_ic[np.isfinite(rank_ic)]
+    return {
+        "mse": mse,
+        "ic": float(ic.mean()) if len(ic) else np.nan,
+        "rank_ic": float(rank_ic.mean()) if len(rank_ic) else np.nan,
+        # ICIR needs at least two dates
+        "icir": float(ic.mean() / ic.std(ddof=1)) if len(ic) > 1 else np.nan,
+    }
+
+
+class ResultsTable:
+    # Trial results, streamed to `path` (CSV) one row at a time
+    def __init__(self, columns, path=None, sort_by="rank_ic"):
+        self.columns = list(columns)
+        self.path = path
+        self.sort_by = sort_by
+        self.rows = []
+        self.best = None
+        if path is not None:
+            with open(path, "w", newline="") as f:
+                csv.DictWriter(f, fieldnames=self.columns).writeheader()
+
+    def add(self, row):
+        self.rows.append(row)
+        if self.path is not None:
+            with open(self.path, "a", newline="") as f:
+                csv.DictWriter(f, fieldnames=self.columns, extrasaction="ignore").writerow(row)
+        is_best = self.best is None or row[self.sort_by] > self.best[self.sort_by]
+        if is_best:
+            self.best = row
+        print(f"[{len(self.rows)}] " + " ".join(f"{k}={row[k]}" for k in self.columns if k in row)
+              + ("  <- best" if is_best else ""))
+
+    def frame(self):
+        return pd.DataFrame(self.rows, columns=self.columns).sort_values(self.sort_by, ascending=False)
+
+
+class SearchPool:
+    # Worker processes attached to one shared train/valid pair. run() can be called many times
+    # (e.g. once per successive-halving rung) without re-sharing or re-binning the data.
+    def __init__(self, x_train, y_train, x_valid, y_valid, base_params, n_workers=5, threads_per_trial=4,
+                 cache=None, name=None):
+        self.base_params = dict(base_params)
+        self.base_params["n_jobs"] = threads_per_trial
+
+        # With a cache, bin once here and let the workers load the binary files
+        bin_files = None
+        if cache is not None and name is not None:
+            train_set, valid_set = cache.get_pair(name, x_train, y_train, x_valid, y_valid, self.base_params)
+            bin_files = (train_set._cache_file, valid_set._cache_file)
+
+        # Valid rows are scored per date; without a datetime level all rows form one cross-section
+        if isinstance(x_valid.index, pd.MultiIndex) and "datetime" in x_valid.index.names:
+            valid_dates = date_codes(x_valid.index)[0]
+        else:
+            valid_dates = np.zeros(len(x_valid), dtype=np.int64)
+
+        self.shared = {
+            "x_valid": SharedArray(x_valid.to_numpy()),
+            "y_valid": SharedArray(np.asarray(y_valid, dtype=np.float64).ravel()),
+            "valid_dates": SharedArray(valid_dates),
+        }
+        if bin_files is None:
+            # No binned files: workers bin the training matrix themselves (once per worker)
+            self.shared["x_train"] = SharedArray(x_train.to_numpy())
+            self.shared["y_train"] = SharedArray(np.asarray(y_train, dtype=np.float64).ravel())
+
+        specs = {k: v.spec for k, v in self.shared.items()}
+        columns = [str(c) for c in x_train.columns]
+        print(f"Starting {n_workers} search workers x {threads_per_trial} threads...")
+        # spawn: forking a process that already ran LightGBM (OpenMP) can deadlock the child
+        self.pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker,
+                                        initargs=(specs, columns, bin_files, self.base_params))
+
+    def run(self, trials, early_stopping_rounds=20, objective="mse", **overrides):
+        # trials: [(trial_id, param dict), ...]; yields result rows as they finish
+        futures = [
+            self.pool.submit(_run_trial, trial_id, trial, {**self.base_params, **trial, **overrides},
+                             early_stopping_rounds, objective)
+            for trial_id, trial in trials
+        ]
+        for fut in as_completed(futures):
+            yield fut.result()
+
+    def close(self):
+        self.pool.shutdown()
+        for arr in self.shared.values():
+            arr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_search(x_train, y_train, x_valid, y_valid, trials, base_params, n_workers=5, threads_per_trial=4,
+               results_path=None, cache=None, name=None, early_stopping_rounds=20, tuner="grid", **tuner_kwargs):
+    # trials: list of param dicts applied on top of base_params.
+    # tuner="grid" runs every trial to early stopping on MSE;
+    # tuner="halving" / "hyperband" allocate boosting rounds adaptively, early stopping on rank IC.
+    # All results are scored and sorted by the mean daily rank IC of the validation rows.
+    with SearchPool(x_train, y_train, x_valid, y_valid, base_params, n_workers=n_workers,
+                    threads_per_trial=threads_per_trial, cache=cache, name=name) as pool:
+        if tuner == "halving":
+            return successive_halving(pool, trials, results_path=results_path, **tuner_kwargs)
+        if tuner == "hyperband":
+            return hyperband(pool, trials, results_path=results_path, **tuner_kwargs)
+
+        trial_keys = sorted({k for trial in trials for k in trial})
+        columns = ["trial"] + trial_keys + ["best_iteration", "mse", "ic", "rank_ic", "icir", "seconds"]
+        table = ResultsTable(columns, path=results_path, sort_by="rank_ic")
+        print(f"Running {len(trials)} trials...")
+        for row in pool.run(list(enumerate(trials)), early_stopping_rounds=early_stopping_rounds):
+            table.add(row)
+        return table.frame()
+
+
+def successive_halving(pool, trials, min_rounds=10, max_rounds=500, eta=3, results_path=None, table=None,
+                       trial_ids=None, bracket=0):
+    # Every config gets `min_rounds` boosting rounds; the best 1/eta by validation rank IC are retrained
+    # with eta times the rounds, until one config is left or max_rounds is reached.
+    # Returns the rows of the final rung, sorted by rank IC.
+    if table is None:
+        table = ResultsTable(_halving_columns(trials), path=results_path, sort_by="rank_ic")
+        print(f"Successive halving: {len(trials)} configs, at most {halving_rounds(len(trials), min_rounds, max_rounds, eta)} "
+              f"boosting rounds")
+    alive = list(zip(trial_ids if trial_ids is not None else range(len(trials)), trials))
+    budget = min(min_rounds, max_rounds)
+    rung = 0
+    while True:
+        print(f"Bracket {bracket} rung {rung}: {len(alive)} configs x {budget} rounds")
+        rows = []
+        # Patience of at least two rank IC evaluations (recomputed every 10 rounds)
+        patience = max(min(budget // 2, 50), 20)
+        for row in pool.run(alive, early_stopping_rounds=patience, objective="rank_ic", n_estimators=budget):
+            row.update(bracket=bracket, rung=rung, rounds=budget)
+            table.add(row)
+            rows.append(row)
+
+        if budget >= max_rounds or len(alive) <= 1:
+            break
+        rows.sort(key=lambda r: r["rank_ic"], reverse=True)
+        keep = {r["trial"] for r in rows[:max(1, len(rows) // eta)]}
+        alive = [(i, trial) for i, trial in alive if i in keep]
+        budget = min(budget * eta, max_rounds)
+        rung += 1
+
+    res = pd.DataFrame(rows, columns=table.columns)
+    return res.sort_values("rank_ic", ascending=False)
+
+
+def halving_rounds(n_configs, min_rounds, max_rounds, eta):
+    # Boosting rounds successive_halving runs at most (early stopping only lowers it)
+    total = 0
+    budget = min(min_rounds, max_rounds)
+    while True:
+        total += n_configs * budget
+        if budget >= max_rounds or n_configs <= 1:
+            return total
+        n_configs = max(1, n_configs // eta)
+        budget = min(budget * eta, max_rounds)
+
+
+def hyperband_brackets(n_configs, min_rounds, max_rounds, eta):
+    # [(first-rung rounds, configs)] per bracket, most configs first. Every config goes to exactly one
+    # bracket, in proportion to Hyperband's bracket sizes ceil((s_max + 1) / (s + 1) * eta^s).
+    s_max = int(math.floor(math.log(max_rounds / min_rounds, eta) + 1e-9))
+    s_values = list(range(s_max, -1, -1))
+    weights = np.array([math.ceil((s_max + 1) / (s + 1) * eta ** s) for s in s_values], dtype=float)
+    share = n_configs * weights / weights.sum()
+    counts = np.floor(share).astype(int)
+    # Largest remainders get the configs left over
+    counts[np.argsort(counts - share, kind="stable")[:n_configs - counts.sum()]] += 1
+    return [(max(int(max_rounds * eta ** -s), 1), int(n)) for s, n in zip(s_values, counts)]
+
+
+def hyperband(pool, trials, min_rounds=10, max_rounds=500, eta=3, results_path=None, seed=42):
+    # Hyperband: several successive-halving brackets that trade number of configs against rounds per
+    # config. All `trials` are spread over the brackets (shuffled with `seed`).
+    table = ResultsTable(_halving_columns(trials), path=results_path, sort_by="rank_ic")
+    order = np.random.default_rng(seed).permutation(len(trials))
+    brackets = hyperband_brackets(len(trials), min_rounds, max_rounds, eta)
+    total = sum(halving_rounds(n, rounds, max_rounds, eta) for rounds, n in brackets if n)
+    print(f"Hyperband: {len(trials)} configs in brackets {[n for _, n in brackets]}, at most {total} boosting rounds")
+
+    finals = []
+    start = 0
+    for bracket, (rounds, n) in enumerate(brackets):
+        ids = [int(i) for i in order[start:start + n]]
+        start += n
+        if not ids:
+            continue
+        finals.append(successive_halving(pool, [trials[i] for i in ids], min_rounds=rounds, max_rounds=max_rounds,
+                                         eta=eta, table=table, trial_ids=ids, bracket=bracket))
+    return pd.concat(finals).sort_values("rank_ic", ascending=False)
+
+
+def _halving_columns(trials):
+    trial_keys = sorted({k for trial in trials for k in trial})
+    return ["trial"] + trial_keys + ["bracket", "rung", "rounds", "best_iteration", "mse", "ic", "rank_ic", "icir", "seconds"]
+
+
+def search_expert(view, regime_val, trials, base_params, **kwargs):
+    # Search for the expert of `regime_val`: train and valid rows of that regime from a RegimePartitionedView
+    train_df = view.select("train", regime_val)
+    valid_df = view.select("valid", regime_val)
+    print(f"Train Samples: {len(train_df)}")
+    print(f"Valid Samples: {len(valid_df)}")
+    kwargs.setdefault("name", f"{view.name}_{regime_val}")
+    return run_search(train_df['feature'], train_df['label'], valid_df['feature'], valid_df['label'],
+                      trials, base_params, **kwargs)
+
+
+# Per-process state of a search worker (set once by _init_worker)
+_WORKER = {}
+
+
+def _init_worker(specs, columns, bin_files, base_params):
+    handles = []
+    arrays = {}
+    for key, spec in specs.items():
+        shm, arr = attach(spec)
+        handles.append(shm)
+        arrays[key] = arr
+
+    x_valid = pd.DataFrame(arrays["x_valid"], columns=columns, copy=False)
+    if bin_files is not None:
+        train_set = lgb.Dataset(bin_files[0], params=dataset_params(base_params))
+        valid_set = lgb.Dataset(bin_files[1], reference=train_set, params=dataset_params(base_params))
+    else:
+        x_train = pd.DataFrame(arrays["x_train"], columns=columns, copy=False)
+        train_set, valid_set = build_datasets(x_train, arrays["y_train"], x_valid, arrays["y_valid"], base_params)
+
+    # Shared memory stays attached for the life of the worker process
+    _WORKER.update(handles=handles, train_set=train_set, valid_set=valid_set,
+                   x_valid=x_valid, y_valid=arrays["y_valid"], valid_dates=arrays["valid_dates"],
+                   segs=DateSegments(arrays["valid_dates"]))
+
+
+def _run_trial(trial_id, trial, params, early_stopping_rounds, objective="mse"):
+    start = time.time()
+    callbacks = [lgb.early_stopping(stopping_rounds=early_stopping_rounds, verbose=False)]
+    feval = None
+    if objective == "rank_ic":
+        # Early stopping and the trial score follow the validation rank IC only
+        params = dict(params, metric="None")
+        # Also evaluated on the last round, so a short rung is not scored on its first round
+        feval = daily_rank_ic_feval(_WORKER["valid_dates"], _WORKER["y_valid"], eval_period=10,
+                                    n_rounds=params.get("n_estimators"))
+    model = train_booster(params, _WORKER["train_set"], _WORKER["valid_set"], callbacks, feval=feval)
+    preds = model.predict(_WORKER["x_valid"])
+
+    row = {"trial": trial_id, **trial, "best_iteration": model.best_iteration}
+    row.update(score_predictions(preds, _WORKER["y_valid"], _WORKER["segs"]))
+    row["seconds"] = round(time.time() - start, 2)
+    return row
@@ -0,0 +1,146 @@
+import numpy as np
+import pandas as pd
+
+# 3-State market regime from the benchmark close and two moving averages (default MA20 / MA60):
+#   Uptrend (1):   Price > MA_long AND MA_short > MA_long
+#   Downtrend (-1): Price < MA_long AND MA_short < MA_long
+#   Choppy (0):    Everything else (including bars where an MA is not available)
+#
+# This is the single implementation used for training, tuning, backtesting and the dashboard.
+# Moving averages follow qlib's `Mean($close, N)`: pandas rolling(N, min_periods=1) that skips NaN,
+# evaluated with N-1 bars of history before the requested start (qlib's extended window).
+
+UPTREND = 1
+CHOPPY = 0
+DOWNTREND = -1
+REGIME_NAMES = {UPTREND: 'Uptrend', CHOPPY: 'Choppy', DOWNTREND: 'Downtrend'}
+
+SHORT_WINDOW = 20
+LONG_WINDOW = 60
+
+
+def rolling_mean(values, window):
+    # NaN-aware rolling mean via cumulative sums. Works on 1D arrays or column-wise on 2D (time x series).
+    return rolling_means(values, [window])[window]
+
+
+def rolling_means(values, windows):
+    # {window -> rolling mean} for several windows from ONE pass of cumulative sums
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    # Centering keeps the cumulative sums small, so the differences stay accurate on long histories
+    with np.errstate(invalid="ignore"):
+        center = np.nan_to_num(np.nanmean(values, axis=0)) if valid.any() else 0.0
+    x = np.where(valid, values - center, 0.0)
+
+    pad = np.zeros((1,) + values.shape[1:])
+    csum = np.concatenate([pad, np.cumsum(x, axis=0)])
+    ccnt = np.concatenate([pad, np.cumsum(valid, axis=0, dtype=np.float64)])
+
+    n = values.shape[0]
+    hi = np.arange(1, n + 1)
+    res = {}
+    for window in windows:
+        lo = np.maximum(hi - window, 0)
+        total = csum[hi] - csum[lo]
+        count = ccnt[hi] - ccnt[lo]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            res[window] = np.where(count > 0, total / np.where(count > 0, count, 1) + center, np.nan)
+    return res
+
+
+def classify(close, ma_short, ma_long):
+    # Vectorized 3-state rule; NaN comparisons are False -> Choppy
+    close = np.asarray(close)
+    with np.errstate(invalid="ignore"):
+        up = (close > ma_long) & (ma_short > ma_long)
+        down = (close < ma_long) & (ma_short < ma_long)
+    return np.where(up, UPTREND, np.where(down, DOWNTREND, CHOPPY)).astype(np.int8)
+
+
+def regime_labels(close, short=SHORT_WINDOW, long=LONG_WINDOW):
+    # Labels for a whole close series (1D) or a (time x benchmark) matrix in one pass
+    return classify(close, rolling_mean(close, short), rolling_mean(close, long))
+
+
+def load_benchmark_close(benchmark, start_time, end_time, lookback=LONG_WINDOW - 1):
+    # Benchmark close indexed by datetime, with `lookback` extra bars before start_time
+    from qlib.data import D
+
+    calendar = D.calendar(end_time=end_time)
+    first = max(int(np.searchsorted(calendar, pd.Timestamp(start_time))) - lookback, 0)
+    df = D.features([benchmark], ["$close"], start_time=calendar[first], end_time=end_time)
+    close = df.droplevel('instrument')["$close"].sort_index()
+    return close[~close.index.duplicated(keep='last')]
+
+
+def get_market_regime(benchmark, start_time, end_time, short=SHORT_WINDOW, long=LONG_WINDOW):
+    close = load_benchmark_close(benchmark, start_time, end_time, lookback=max(short, long) - 1)
+    regime = regime_series(close, short, long)
+    return regime.loc[pd.Timestamp(start_time):]
+
+
+def regime_series(close, short=SHORT_WINDOW, long=LONG_WINDOW):
+    # Same as regime_labels for a datetime-indexed close Series
+    labels = regime_labels(close.to_numpy(), short, long)
+    regime = pd.Series(labels.astype(np.int64), index=close.index, name='regime')
+    regime.index.name = 'datetime'
+    return regime
+
+
+class RegimeTracker:
+    # Streaming regime for daily live use: O(1) work per new bar.
+    # Keeps running sums over ring buffers of the last `long` closes; sums are recomputed from the
+    # buffer every `long` bars so rounding never accumulates. Labels match regime_labels except for
+    # exact ties at the ~1e-12 level.
+    #
+    #   tracker = RegimeTracker.from_history(close_history)
+    #   today_regime = tracker.update(today_close)
+    def __init__(self, short=SHORT_WINDOW, long=LONG_WINDOW):
+        self.short = short
+        self.long = long
+        self.buffer = np.full(max(short, long), np.nan)
+        self.pos = 0
+        self.n_seen = 0
+        self.sums = {short: 0.0, long: 0.0}
+        self.counts = {short: 0, long: 0}
+        self.regime = CHOPPY
+        self.ma = {short: np.nan, long: np.nan}
+
+    @classmethod
+    def from_history(cls, close, short=SHORT_WINDOW, long=LONG_WINDOW):
+        tracker = cls(short, long)
+        for value in np.asarray(close, dtype=np.float64)[-max(short, long):]:
+            tracker.update(value)
+        return tracker
+
+    def update(self, close):
+        size = len(self.buffer)
+        for window in (self.short, self.long):
+            # Value leaving this window (if the window is already full)
+            if self.n_seen >= window:
+                old = self.buffer[(self.pos - window) % size]
+                if not np.isnan(old):
+                    self.sums[window] -= old
+                    self.counts[window] -= 1
+            if not np.isnan(close):
+                self.sums[window] += close
+                self.counts[window] += 1
+
+        self.buffer[self.pos] = close
+        self.pos = (self.pos + 1) % size
+        self.n_seen += 1
+        if self.n_seen % size == 0:
+            self._resync()
+
+        for window in (self.short, self.long):
+            self.ma[window] = self.sums[window] / self.counts[window] if self.counts[window] > 0 else np.nan
+        self.regime = int(classify(close, self.ma[self.short], self.ma[self.long]))
+        return self.regime
+
+    def _resync(self):
+        size = len(self.buffer)
+        for window in (self.short, self.long):
+            last = self.buffer[(self.pos - np.arange(1, min(window, self.n_seen) + 1)) % size]
+            self.sums[window] = float(np.nansum(last))
+            self.counts[window] = int((~np.isnan(last)).sum())
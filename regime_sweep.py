@@ -0,0 +1,147 @@
+import yaml
+import numpy as np
+import pandas as pd
+from regime import rolling_means, classify, UPTREND, CHOPPY, DOWNTREND, REGIME_NAMES
+
+# Screens many regime definitions (short/long MA window pairs x benchmarks) without retraining.
+# All moving averages come from one cumulative-sum pass per benchmark (regime.rolling_means),
+# labels for the whole grid are a (pair x time x benchmark) tensor, and the statistics below
+# are reductions over that tensor. Forward returns are the dataset label averaged over the
+# universe per date (what the experts are trained to predict), the same for every benchmark.
+
+TRADING_DAYS = 252
+
+
+def load_config(path="config.yaml"):
+    with open(path, "r") as f:
+        config = yaml.safe_load(f)
+    return config
+
+
+def load_benchmark_closes(benchmarks, start_time, end_time, lookback):
+    # (datetime x benchmark) close matrix with `lookback` bars of history before start_time
+    from qlib.data import D
+
+    calendar = D.calendar(end_time=end_time)
+    first = max(int(np.searchsorted(calendar, pd.Timestamp(start_time))) - lookback, 0)
+    df = D.features(list(benchmarks), ["$close"], start_time=calendar[first], end_time=end_time)
+    return df["$close"].unstack("instrument").reindex(columns=list(benchmarks)).sort_index()
+
+
+def regime_label_grid(close, pairs):
+    # close: (T x B) array, pairs: [(short, long), ...] -> int8 labels of shape (P x T x B)
+    close = np.asarray(close, dtype=np.float64)
+    if close.ndim == 1:
+        close = close[:, None]
+    windows = sorted({w for pair in pairs for w in pair})
+    ma = rolling_means(close, windows)
+    return np.stack([classify(close, ma[short], ma[long]) for short, long in pairs])
+
+
+def universe_forward_returns(instruments, label, start_time, end_time):
+    # Cross-sectional mean of the dataset label per date (Series indexed by datetime)
+    from qlib.data import D
+
+    if isinstance(instruments, str):
+        instruments = D.instruments(instruments)
+    df = D.features(instruments, [label], start_time=start_time, end_time=end_time)
+    return df.iloc[:, 0].groupby(level="datetime").mean()
+
+
+def forward_returns(close):
+    # Same definition as the dataset label: Ref($close, -1) / $close - 1
+    close = np.asarray(close, dtype=np.float64)
+    fwd = np.full(close.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        fwd[:-1] = close[1:] / close[:-1] - 1
+    return fwd
+
+
+def regime_grid_stats(labels, fwd):
+    # labels: (P x T x B), fwd: (T x B) forward returns aligned with the labels.
+    # Returns a dict of (P x B) arrays.
+    n_days = labels.shape[1]
+    stats = {}
+
+    switches = (labels[:, 1:] != labels[:, :-1]).sum(axis=1)
+    stats['switches_per_year'] = switches * TRADING_DAYS / max(n_days - 1, 1)
+    stats['avg_run_days'] = n_days / (switches + 1)
+
+    has_fwd = ~np.isnan(fwd)[None]
+    fwd0 = np.nan_to_num(fwd)[None]
+    for regime_val in [UPTREND, CHOPPY, DOWNTREND]:
+        name = REGIME_NAMES[regime_val].lower()
+        mask = labels == regime_val
+        stats[f'occ_{name}'] = mask.mean(axis=1)
+
+        m = mask & has_fwd
+        cnt = m.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (fwd0 * m).sum(axis=1) / cnt
+            var = ((fwd0 ** 2) * m).sum(axis=1) / cnt - mean ** 2
+            std = np.sqrt(np.maximum(var, 0))
+            stats[f'fwd_mean_{name}'] = mean
+            stats[f'fwd_ann_{name}'] = mean * TRADING_DAYS
+            stats[f'fwd_sharpe_{name}'] = mean / std * np.sqrt(TRADING_DAYS)
+            stats[f'fwd_hit_{name}'] = ((fwd0 > 0) & m).sum(axis=1) / cnt
+
+    # How well the regime separates good from bad days
+    stats['fwd_spread_up_down'] = stats['fwd_ann_uptrend'] - stats['fwd_ann_downtrend']
+    return stats
+
+
+def sweep_regimes(close_df, pairs, start_time=None, fwd_df=None):
+    # close_df: (datetime x benchmark) closes incl. lookback history.
+    # fwd_df: optional forward returns on the same grid (e.g. the universe's average label);
+    #         defaults to each benchmark's own next-day return.
+    labels = regime_label_grid(close_df.to_numpy(), pairs)
+    fwd = forward_returns(close_df.to_numpy()) if fwd_df is None else fwd_df.reindex_like(close_df).to_numpy()
+
+    # Drop the lookback bars only after the MAs have been computed
+    keep = np.ones(len(close_df), dtype=bool) if start_time is None else (close_df.index >= pd.Timestamp(start_time))
+    stats = regime_grid_stats(labels[:, keep], fwd[keep])
+
+    rows = []
+    for p, (short, long) in enumerate(pairs):
+        for b, bench in enumerate(close_df.columns):
+            row = {'benchmark': bench, 'short': short, 'long': long}
+            row.update({k: v[p, b] for k, v in stats.items()})
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def run_sweep():
+    import qlib
+    from qlib.constant import REG_US
+
+    config = load_config()
+    qlib.init(provider_uri=config['qlib_init']['provider_uri'], region=REG_US)
+
+    benchmarks = [config['benchmark'], "SPY", "IWM"]
+    shorts = [5, 10, 15, 20, 30, 40, 50]
+    longs = [30, 40, 60, 80, 100, 120, 150, 200]
+    pairs = [(s, l) for s in shorts for l in longs if s < l]
+
+    start_time = config['data_handler_config']['start_time']
+    end_time = config['data_handler_config']['end_time']
+    close_df = load_benchmark_closes(benchmarks, start_time, end_time, lookback=max(longs) - 1)
+
+    dhc = config['data_handler_config']
+    print(f"Loading the label of {dhc['instruments']} (universe average per date)...")
+    label = universe_forward_returns(dhc['instruments'], dhc['label'][0], start_time, end_time)
+    fwd_df = pd.DataFrame({bench: label for bench in benchmarks}).reindex(close_df.index)
+
+    print(f"Sweeping {len(pairs)} window pairs x {len(benchmarks)} benchmarks ({len(pairs) * len(benchmarks)} grid points)...")
+    res = sweep_regimes(close_df, pairs, start_time=start_time, fwd_df=fwd_df)
+    res = res.sort_values('fwd_spread_up_down', ascending=False)
+
+    pd.set_option('display.width', 200)
+    print(res[['benchmark', 'short', 'long', 'occ_uptrend', 'occ_choppy', 'occ_downtrend',
+               'switches_per_year', 'fwd_ann_uptrend', 'fwd_ann_choppy', 'fwd_ann_downtrend',
+               'fwd_spread_up_down']].head(30).to_string(index=False))
+    res.to_csv("regime_sweep.csv", index=False)
+    print("Full results saved to regime_sweep.csv")
+
+
+if __name__ == "__main__":
+    run_sweep()
@@ -0,0 +1,35 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+# NumPy arrays in shared memory, so worker processes can read the same matrix without
+# each receiving a pickled copy.
+#
+#   with SharedArray(x) as sx:
+#       pool.submit(worker, sx.spec)      # worker: shm, x = attach(spec)
+
+
+class SharedArray:
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.array = np.ndarray(array.shape, dtype=array.dtype, buffer=self.shm.buf)
+        self.array[...] = array
+        self.spec = (self.shm.name, array.shape, array.dtype.str)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach(spec):
+    # Returns (shm, array). Keep `shm` alive as long as `array` is used, then call shm.close().
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
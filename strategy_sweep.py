@@ -0,0 +1,209 @@
+import argparse
+import pickle
+import time
+import multiprocessing
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from shared_arrays import SharedArray, attach
+from custom_strategy import SignalRanking
+from fast_backtest import MarketArrays, load_config, load_market, pin_hash_seed, simulate, strategy_kwargs
+from param_search import expand_grid, ResultsTable
+
+# Parallel sweep of TopKSkipStrategy settings (topk / n_drop / n_skip) and the cash threshold of
+# run_adaptive_strategy (names scoring below it are not candidates) on one saved prediction.
+#
+# The prediction (date / instrument codes + scores) and the market arrays of fast_backtest are placed in
+# shared memory once. Worker processes attach when they start, so each config costs one simulate() loop
+# and, per distinct cash threshold, one ranking of the signal. Results stream to a CSV as configs finish.
+#
+#   res = run_sweep_grid(pred, market, expand_grid({"topk": [10, 20], "cash_threshold": [None, 0.0]}), base_kwargs)
+#
+# The cash threshold is applied to the scores it is given: to sweep below the threshold already applied
+# in pred.pkl, pass the raw scores (raw_pred.pkl of the recorder).
+
+# Bars per year of qlib's risk_analysis for daily data (so the metrics match PortAnaRecord's)
+TRADING_DAYS = 238
+METRIC_COLUMNS = ["annualized_return", "information_ratio", "max_drawdown", "abs_return", "turnover", "seconds"]
+
+def apply_cash_threshold(score, threshold):
+    # Rows kept as candidates, as the pred.pkl of run_adaptive_strategy (CompactSignal.from_scores with
+    # min_score=threshold): missing scores and scores below `threshold` are dropped. None keeps every row.
+    score = np.asarray(score, dtype=np.float64)
+    if threshold is None:
+        return np.ones(len(score), dtype=bool)
+    return np.isfinite(score) & (score >= threshold)
+
+
+def report_metrics(report):
+    # Excess return with cost over the benchmark, with qlib risk_analysis definitions (sum mode),
+    # plus the annualized absolute return after cost and the mean daily turnover
+    net = (report["return"] - report["cost"]).to_numpy()
+    excess = net - report["bench"].to_numpy()
+    if len(excess) == 0:
+        return {k: np.nan for k in METRIC_COLUMNS if k != "seconds"}
+    cum = np.cumsum(excess)
+    std = excess.std(ddof=1) if len(excess) > 1 else np.nan
+    return {
+        "annualized_return": excess.mean() * TRADING_DAYS,
+        "information_ratio": excess.mean() / std * np.sqrt(TRADING_DAYS) if std > 0 else np.nan,
+        "max_drawdown": (cum - np.maximum.accumulate(cum)).min(),
+        "abs_return": net.mean() * TRADING_DAYS,
+        "turnover": report["turnover"].mean(),
+    }
+
+
+class SweepPool:
+    # Worker processes attached to one shared prediction + market; run() can be called many times
+    def __init__(self, pred, market, n_workers=4):
+        if hasattr(pred, "to_series"):
+            # CompactSignal
+            pred = pred.to_series()
+        if isinstance(pred, pd.DataFrame):
+            pred = pred.iloc[:, 0]
+        index = pred.index
+        levels = [index.names.index("datetime"), index.names.index("instrument")]
+        self.shared = {
+            "date_codes": SharedArray(np.asarray(index.codes[levels[0]], dtype=np.int64)),
+            "inst_codes": SharedArray(np.asarray(index.codes[levels[1]], dtype=np.int64)),
+            "score": SharedArray(pred.to_numpy(dtype=np.float64)),
+        }
+        for key, arr in market.arrays().items():
+            self.shared[f"market_{key}"] = SharedArray(arr)
+
+        specs = {k: v.spec for k, v in self.shared.items()}
+        meta = {
+            "signal_levels": (index.levels[levels[0]], index.levels[levels[1]]),
+            "dates": market.dates, "instruments": market.instruments,
+            "trade_unit": market.trade_unit, "prev_date": market.prev_date,
+        }
+        # Same hash seed in every worker: the Position order of held stocks (fast_backtest._position_order)
+        # follows it, so otherwise one config could give different results on different workers
+        seed = pin_hash_seed()
+        print(f"Starting {n_workers} sweep workers (PYTHONHASHSEED={seed})...")
+        # spawn, as the other worker pools of this project (no inherited OpenMP / qlib state)
+        self.pool = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_init_worker, initargs=(specs, meta))
+
+    def run(self, configs, base_kwargs):
+        # configs: [(config_id, dict of simulate() overrides + optional "cash_threshold"), ...].
+        # Submitted grouped by threshold, so consecutive configs on a worker reuse its ranking.
+        configs = sorted(configs, key=lambda item: _threshold_key(item[1].get("cash_threshold")))
+        futures = [self.pool.submit(_run_config, config_id, config, base_kwargs) for config_id, config in configs]
+        for fut in as_completed(futures):
+            yield fut.result()
+
+    def close(self):
+        self.pool.shutdown()
+        for arr in self.shared.values():
+            arr.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def run_sweep_grid(pred, market, configs, base_kwargs, n_workers=4, results_path=None, sort_by="information_ratio"):
+    # configs: list of dicts of simulate() arguments (topk, n_drop, n_skip, ...) and "cash_threshold",
+    # applied on top of base_kwargs. Returns one row per config, best `sort_by` first.
+    keys = sorted({k for config in configs for k in config})
+    table = ResultsTable(["config"] + keys + METRIC_COLUMNS, path=results_path, sort_by=sort_by)
+    with SweepPool(pred, market, n_workers=n_workers) as pool:
+        print(f"Running {len(configs)} strategy configs...")
+        for row in pool.run(list(enumerate(configs)), base_kwargs):
+            table.add(row)
+    return table.frame()
+
+
+def _threshold_key(threshold):
+    return (threshold is not None, -np.inf if threshold is None else threshold)
+
+
+# Per-process state of a sweep worker (set once by _init_worker)
+_WORKER = {}
+
+
+def _init_worker(specs, meta):
+    handles = []
+    arrays = {}
+    for key, spec in specs.items():
+        shm, arr = attach(spec)
+        handles.append(shm)
+        arrays[key] = arr
+
+    market = MarketArrays.from_arrays(
+        {k[len("market_"):]: v for k, v in arrays.items() if k.startswith("market_")},
+        meta["dates"], meta["instruments"], trade_unit=meta["trade_unit"], prev_date=meta["prev_date"],
+    )
+    index = pd.MultiIndex(levels=list(meta["signal_levels"]), codes=[arrays["date_codes"], arrays["inst_codes"]],
+                          names=["datetime", "instrument"], verify_integrity=False)
+    # Shared memory stays attached for the life of the worker process
+    _WORKER.update(handles=handles, market=market, index=index, score=arrays["score"], ranking=(None, None))
+
+
+def _get_ranking(threshold):
+    # SignalRanking of the prediction after the cash threshold; the last one is kept for the next config
+    key, ranking = _WORKER["ranking"]
+    if ranking is None or key != _threshold_key(threshold):
+        keep = apply_cash_threshold(_WORKER["score"], threshold)
+        if keep.all():
+            score = pd.Series(_WORKER["score"], index=_WORKER["index"], copy=False)
+        else:
+            score = pd.Series(_WORKER["score"][keep], index=_WORKER["index"][keep])
+        ranking = SignalRanking(score)
+        _WORKER["ranking"] = (_threshold_key(threshold), ranking)
+    return ranking
+
+
+def _run_config(config_id, config, base_kwargs):
+    start = time.time()
+    kwargs = dict(base_kwargs)
+    kwargs.update({k: v for k, v in config.items() if k != "cash_threshold"})
+    report = simulate(_get_ranking(config.get("cash_threshold")), _WORKER["market"], **kwargs)
+
+    row = {"config": config_id, **config}
+    row.update(report_metrics(report))
+    row["seconds"] = round(time.time() - start, 2)
+    return row
+
+
+def run_strategy_sweep(pred_path, results_path="strategy_sweep_results.csv"):
+    import qlib
+    from qlib.constant import REG_US
+
+    config = load_config()
+    qlib.init(provider_uri=config['qlib_init']['provider_uri'], region=REG_US)
+    sweep_config = config.get('strategy_sweep', {})
+
+    with open(pred_path, "rb") as f:
+        pred = pickle.load(f)
+
+    print("Loading market arrays...")
+    market = load_market(config)
+    base_kwargs = strategy_kwargs(config['port_analysis_config'])
+
+    grid = {
+        "topk": sweep_config.get('topk', [base_kwargs.get('topk', 10)]),
+        "n_drop": sweep_config.get('n_drop', [base_kwargs.get('n_drop', 1)]),
+        "n_skip": sweep_config.get('n_skip', [base_kwargs.get('n_skip', 5)]),
+        "cash_threshold": sweep_config.get('cash_threshold', [None]),
+    }
+    configs = expand_grid(grid)
+    res = run_sweep_grid(pred, market, configs, base_kwargs, n_workers=sweep_config.get('n_workers', 4),
+                         results_path=results_path)
+
+    pd.set_option('display.width', 200)
+    print(res.head(20).to_string(index=False))
+    print(f"Full results saved to {results_path}")
+    return res
+
+
+if __name__ == "__main__":
+    pin_hash_seed(reexec=True)
+    parser = argparse.ArgumentParser(description="Parallel TopKSkipStrategy / cash threshold sweep on a saved prediction")
+    parser.add_argument("pred", help="pred.pkl (or raw_pred.pkl to sweep the cash threshold freely)")
+    parser.add_argument("--out", default="strategy_sweep_results.csv")
+    args = parser.parse_args()
+    run_strategy_sweep(args.pred, args.out)
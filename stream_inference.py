@@ -0,0 +1,95 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from qlib.data.dataset.handler import DataHandlerLP
+from experts import predict_by_regime
+from panel import Panel
+from walk_forward import fold_starts
+
+# Streaming regime-routed inference over a long test segment.
+#
+# Instead of preparing the whole segment once per dataset (two 2010-2025 feature frames before the first
+# predict), the segment is walked in chunks of `chunk_months` calendar months. Each chunk is prepared
+# (feature columns only), routed to the experts by regime and predicted, and only its scores are kept.
+# Chunks are prepared by a thread pool `prefetch` chunks ahead while the current one is predicted, so at
+# most prefetch + 1 chunks of features are in memory (the current one and the queued ones; the next chunk
+# is only submitted once the current one is released), however long the segment or wide the universe.
+# The prefetch threads also lay each chunk out as a Panel (with panel=True, briefly holding the prepared
+# frame and its Panel copy), so the experts predict their regime's date blocks straight from one
+# C-contiguous matrix instead of gathering rows into new frames.
+#
+#   scores = predict_streaming(models, {1: dataset_std, -1: dataset_std, 0: dataset_choppy}, test_regime,
+#                              "test", chunk_months=12, prefetch=1)
+#
+# The rows and scores are the same as predict_by_regime on the fully prepared segment.
+
+
+def segment_dates(dataset, segment, data_key=DataHandlerLP.DK_L):
+    # Dates of the handler frame inside `segment` (a segment name or a slice, inclusive as qlib's fetch)
+    slc = slice(*dataset.segments[segment]) if isinstance(segment, str) else segment
+    index = dataset.handler._get_df_by_key(data_key).index
+    dates = index.levels[index.names.index("datetime")]
+    lo, hi = dates.slice_locs(slc.start, slc.stop)
+    return dates[lo:hi]
+
+
+def date_chunks(dates, chunk_months):
+    # [(first date, last date)] of consecutive `chunk_months` calendar-month blocks of `dates`
+    if len(dates) == 0:
+        return []
+    starts = fold_starts(dates, dates[0], chunk_months)
+    pos = np.append(dates.get_indexer(starts), len(dates))
+    return [(dates[a], dates[b - 1]) for a, b in zip(pos[:-1], pos[1:])]
+
+
+def predict_streaming(models, dataset_map, regime, segment, chunk_months=12, prefetch=1,
+                      data_key=DataHandlerLP.DK_L, prepare=None, panel=True):
+    # models / dataset_map: regime value -> expert / dataset (datasets shared by several regimes are
+    # prepared once per chunk). `prepare` (e.g. MemoryBudget.prepare) replaces dataset.prepare.
+    datasets = {}
+    for dataset in dataset_map.values():
+        datasets.setdefault(id(dataset), dataset)
+    chunks = date_chunks(segment_dates(next(iter(datasets.values())), segment, data_key), chunk_months)
+
+    def load(lo, hi):
+        frames = {}
+        for key, dataset in datasets.items():
+            if prepare is not None:
+                frames[key] = prepare(dataset, slice(lo, hi), col_set="feature", data_key=data_key,
+                                      name=f"chunk_{lo.date()}_{len(frames)}")
+            else:
+                frames[key] = dataset.prepare(slice(lo, hi), col_set="feature", data_key=data_key)
+            if panel:
+                frames[key] = Panel.from_frame(frames[key])
+        return {regime_val: frames[id(dataset)] for regime_val, dataset in dataset_map.items()}
+
+    parts = []
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as pool:
+        queue = deque()
+        todo = iter(chunks)
+        # The first chunk + `prefetch` chunks ahead
+        for lo, hi in todo:
+            queue.append((lo, hi, pool.submit(load, lo, hi)))
+            if len(queue) > prefetch:
+                break
+
+        while queue:
+            lo, hi, fut = queue.popleft()
+            start = time.time()
+            x_map = fut.result()
+            # The queued chunks are prepared while this one is predicted
+            n_rows = len(next(iter(x_map.values())))
+            parts.append(predict_by_regime(models, x_map, regime))
+            del x_map
+            print(f"Predicted {lo.date()} - {hi.date()} ({n_rows} rows, {time.time() - start:.1f}s)")
+
+            # Submitted once this chunk is released: at most prefetch + 1 chunks in memory
+            nxt = next(todo, None)
+            if nxt is not None:
+                queue.append((*nxt, pool.submit(load, *nxt)))
+
+    if not parts:
+        return pd.Series(np.empty(0), index=pd.MultiIndex.from_arrays([[], []], names=["datetime", "instrument"]))
+    return pd.concat(parts)
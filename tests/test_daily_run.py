@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import qlib
+from qlib.constant import REG_US
+
+from panel_features import panel_from_features
+from daily_run import compute_features
+from data_quality import scan
+
+INSTRUMENTS = ["AAA", "BBB", "CCC"]
+BARS = pd.bdate_range("2024-01-01", periods=10)
+SPEC = {
+    "fields": ["Mean($close, 5)/$close", "$close/Ref($close, 1)"],
+    "names": ["MA5", "RET"],
+    "shared_processors": [],
+    "infer_processors": [],
+}
+
+
+@pytest.fixture(scope="module", autouse=True)
+def qlib_init(tmp_path_factory):
+    # Expressions are only parsed, no data is read
+    qlib.init(provider_uri=str(tmp_path_factory.mktemp("qlib_data")), region=REG_US)
+
+
+def raw_features(missing):
+    # (instrument, datetime) frame of $close / $volume; `missing`: (instrument, bar) pairs without a stored bar
+    rows = [(inst, d) for inst in INSTRUMENTS for d in BARS if (inst, d) not in missing]
+    index = pd.MultiIndex.from_tuples(rows, names=["instrument", "datetime"])
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        "$close": rng.uniform(10, 20, len(index)).astype(np.float32),
+        "$volume": rng.uniform(1e5, 1e6, len(index)).astype(np.float32),
+    }, index=index)
+
+
+def test_missing_bar_on_scored_date():
+    panel, instruments = panel_from_features(raw_features({("BBB", BARS[-1])}), INSTRUMENTS, BARS)
+    assert instruments == ["AAA", "CCC"]
+    assert panel.raw["$close"].shape == (len(BARS), 2)
+    assert panel.present.shape == (len(BARS), 2)
+
+    x = compute_features(panel, instruments, SPEC, BARS[-1])
+    assert x.index.get_level_values("instrument").tolist() == ["AAA", "CCC"]
+    assert np.isfinite(x.to_numpy()).all()
+
+    mask, live_mask, bans, _ = scan(panel.raw["$close"], panel.raw["$volume"], panel.present)
+    assert mask.shape[1] == live_mask.shape[1] == len(instruments)
+    assert all(len(b) == len(instruments) for b in bans.values())
+
+
+def test_all_bars_present():
+    panel, instruments = panel_from_features(raw_features(set()), INSTRUMENTS, BARS)
+    assert instruments == INSTRUMENTS
+    x = compute_features(panel, instruments, SPEC, BARS[-1])
+    assert len(x) == len(INSTRUMENTS)
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+
+from data_quality import DataQuality, scan
+
+
+def price_panel(n_dates=60, n_instruments=4, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 20 * np.exp(np.cumsum(rng.normal(0, 0.01, (n_dates, n_instruments)), axis=0))
+    volume = rng.uniform(1e5, 1e6, (n_dates, n_instruments))
+    exists = np.ones((n_dates, n_instruments), dtype=bool)
+    return close, volume, exists
+
+
+def test_point_in_time_mask_ignores_later_bars():
+    close, volume, exists = price_panel()
+    # Later events: a jump, a zero-volume run, a sub-penny close, a long gap
+    later_close, later_volume, later_exists = close.copy(), volume.copy(), exists.copy()
+    later_close[40:, 0] *= 5
+    later_volume[41:50, 1] = 0
+    later_close[45, 2] = 0.001
+    later_close[42:50, 3] = np.nan
+    later_exists[42:50, 3] = False
+
+    _, live, _, _ = scan(close, volume, exists)
+    mask_later, live_later, _, _ = scan(later_close, later_volume, later_exists)
+    assert np.array_equal(live[:40], live_later[:40])
+    # The training mask does see the jump the day before
+    assert mask_later[39, 0]
+
+
+def test_label_mask_looks_ahead_point_in_time_mask_does_not():
+    close, volume, exists = price_panel()
+    close[30:, 0] *= 5
+    volume[10:20, 1] = 0
+    mask, live, _, _ = scan(close, volume, exists)
+
+    # Jump eve: excluded from training only
+    assert mask[29, 0] and mask[30, 0]
+    assert not live[29, 0] and not live[30, 0]
+    # Zero-volume run: the training mask has all of it, predictions from its 5th bar on
+    assert mask[10:20, 1].all()
+    assert not live[10:14, 1].any() and live[14:20, 1].all()
+
+
+def test_excluded_point_in_time_skips_bans():
+    close, volume, exists = price_panel()
+    close[50, 2] = 0.001
+    mask, live, bans, counts = scan(close, volume, exists)
+    assert bans["price"][2]
+
+    dates = pd.bdate_range("2020-01-01", periods=len(close))
+    quality = DataQuality(dates, ["A", "B", "C", "D"], mask, live, bans, counts)
+    index = pd.MultiIndex.from_product([dates[[10, 50]], ["C"]], names=["datetime", "instrument"])
+    assert quality.excluded(index).tolist() == [True, True]
+    assert quality.excluded(index, point_in_time=True).tolist() == [False, True]
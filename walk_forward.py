@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+from qlib.data.dataset.handler import DataHandlerLP
+from moe_data import partition_rows, take_rows
+from experts import EXPERTS, fit_expert, update_expert, predict_by_regime
+
+# Walk-forward retraining of the regime experts with warm starts.
+#
+# The out-of-sample period is cut into folds of `cadence_months` months. Before each fold, every expert
+# is brought up to date on the labelled rows that became available since its last fit: `update_rounds`
+# more trees are boosted on those rows only, on top of the previous booster (lgb init_model). Each fold
+# is predicted by the experts as they stood at its start, and the folds are stitched into one series.
+#
+#   window="expanding": the experts only grow (refit_every > 0 still refits on the full history)
+#   window="rolling":   every `refit_every` folds the experts are refit from scratch on the last
+#                       `window_years` (trees cannot be taken out of a boosted model), warm updates in between
+#
+# All folds are slices of one prepared frame per dataset (the FeatureStore handlers), so no feature is
+# recomputed. The normalization stats stay the ones fitted on fit_start_time..fit_end_time, which
+# precede every fold.
+#
+#   scores, models = walk_forward_predict({1: dataset_std, -1: dataset_std, 0: dataset_choppy}, params_map,
+#                                         full_regime, segments, cadence_months=3)
+
+
+class RegimeFrame:
+    # Prepared (datetime, instrument) frame of one dataset with its rows split by regime.
+    # Rows are sorted by datetime, so date ranges are two binary searches on the row dates.
+    def __init__(self, df, regime, exclude=None):
+        self.df = df
+        self.row_dates = df.index.get_level_values("datetime").values
+        self.regime_rows = partition_rows(df.index, regime, exclude(df.index) if exclude else None)
+
+    def block(self, lo, hi):
+        # Rows with lo <= datetime < hi, as a view
+        start, end = np.searchsorted(self.row_dates, [np.datetime64(lo), np.datetime64(hi)])
+        return self.df.iloc[start:end]
+
+    def rows(self, regime_val, lo, hi):
+        # Positions of the `regime_val` rows with lo <= datetime < hi
+        pos = self.regime_rows.get(regime_val, np.empty(0, dtype=np.int64))
+        start, end = np.searchsorted(self.row_dates[pos], [np.datetime64(lo), np.datetime64(hi)])
+        return pos[start:end]
+
+    def select(self, regime_val, lo, hi):
+        return take_rows(self.df, self.rows(regime_val, lo, hi))
+
+
+def fold_starts(dates, start_time, cadence_months):
+    # First trading date of each fold: a new fold every `cadence_months` calendar months from start_time
+    dates = pd.DatetimeIndex(dates)
+    dates = dates[dates >= pd.Timestamp(start_time)]
+    if len(dates) == 0:
+        return dates
+    months = (dates.year - dates[0].year) * 12 + dates.month - dates[0].month
+    fold_no = np.asarray(months) // cadence_months
+    first = np.concatenate([[True], fold_no[1:] != fold_no[:-1]])
+    return dates[first]
+
+
+def walk_forward_predict(dataset_map, params_map, regime, segments, start_time=None, cadence_months=3,
+                         window="expanding", window_years=10, refit_every=0, valid_months=12,
+                         update_rounds=50, min_update_rows=1000, gap=1, exclude=None, prepare=None):
+    # dataset_map / params_map: regime value -> dataset / LGBM params (as train_experts).
+    # The experts are first fit on the "train" segment with early stopping on "valid" (as run_adaptive_strategy),
+    # then walked forward over the "test" segment from `start_time` (default: the day after "valid").
+    # `gap` trading days are left between the last training row and a fold: the label of date d is the
+    # return to d+1, so it is only known one day later. `exclude` (e.g. DataQuality.excluded) drops
+    # rows from every fit. `prepare` (e.g. MemoryBudget.prepare) replaces dataset.prepare for the frames.
+    if window not in ("expanding", "rolling"):
+        raise ValueError(f"walk_forward window must be 'expanding' or 'rolling', got {window!r}")
+    if window == "rolling" and refit_every < 1:
+        raise ValueError("walk_forward window 'rolling' needs refit_every >= 1")
+
+    fit_start, fit_end = [pd.Timestamp(t) for t in segments["train"]]
+    valid_start, valid_end = [pd.Timestamp(t) for t in segments["valid"]]
+    test_end = pd.Timestamp(segments["test"][1])
+    if start_time is None:
+        start_time = valid_end + pd.Timedelta(days=1)
+    start_time = max(pd.Timestamp(start_time), pd.Timestamp(segments["test"][0]))
+
+    # One prepared frame per distinct dataset over the whole history; every fit and fold slices it
+    frames = {}
+    frame_map = {}
+    for regime_val, dataset in dataset_map.items():
+        if id(dataset) not in frames:
+            print(f"Preparing walk-forward frame ({fit_start.date()} - {test_end.date()})...")
+            if prepare is not None:
+                df = prepare(dataset, slice(fit_start, test_end), col_set=["feature", "label"],
+                             data_key=DataHandlerLP.DK_L, name=f"walk_forward_{len(frames)}")
+            else:
+                df = dataset.prepare(slice(fit_start, test_end), col_set=["feature", "label"], data_key=DataHandlerLP.DK_L)
+            frames[id(dataset)] = RegimeFrame(df, regime, exclude)
+        frame_map[regime_val] = frames[id(dataset)]
+
+    calendar = pd.DatetimeIndex(np.unique(frame_map[EXPERTS[0][0]].row_dates))
+    starts = fold_starts(calendar[calendar <= test_end], start_time, cadence_months)
+    if len(starts) == 0:
+        raise ValueError(f"No trading dates between {start_time.date()} and {test_end.date()} to walk forward")
+
+    def cutoff(fold_start):
+        # Training rows must be strictly before this date
+        return calendar[max(calendar.get_loc(fold_start) - gap, 0)]
+
+    first_cutoff = cutoff(starts[0])
+    if valid_start >= first_cutoff:
+        raise ValueError("walk_forward start_time must leave room for the valid segment before the first fold")
+
+    # Initial fit, as the single-shot run: train segment + early stopping on the valid segment
+    models = {}
+    fitted_until = {}
+    for regime_val, regime_name in EXPERTS:
+        models[regime_val] = _refit(frame_map[regime_val], regime_val, regime_name, params_map[regime_val],
+                                    fit_start, min(fit_end + pd.Timedelta(days=1), valid_start),
+                                    min(valid_end + pd.Timedelta(days=1), first_cutoff))
+        fitted_until[regime_val] = min(fit_end + pd.Timedelta(days=1), valid_start)
+
+    parts = []
+    ends = list(starts[1:]) + [test_end + pd.Timedelta(days=1)]
+    for k, (fold_start, fold_end) in enumerate(zip(starts, ends)):
+        limit = cutoff(fold_start)
+        last = calendar[calendar < fold_end][-1]
+        print(f"Fold {k + 1}/{len(starts)}: {fold_start.date()} - {last.date()} "
+              f"(training rows before {limit.date()})")
+
+        if k > 0 and refit_every > 0 and k % refit_every == 0:
+            lo = fit_start if window == "expanding" else max(fit_start, limit - pd.DateOffset(years=window_years))
+            split = limit - pd.DateOffset(months=valid_months)
+            for regime_val, regime_name in EXPERTS:
+                models[regime_val] = _refit(frame_map[regime_val], regime_val, regime_name, params_map[regime_val],
+                                            lo, split, limit)
+                # The early-stopping tail is picked up by the warm update below
+                fitted_until[regime_val] = split
+
+        # Warm update on the rows labelled since each expert's last fit
+        for regime_val, regime_name in EXPERTS:
+            new_df = frame_map[regime_val].select(regime_val, fitted_until[regime_val], limit)
+            if len(new_df) < min_update_rows:
+                # Too few rows for a meaningful update; they are kept for the next fold
+                continue
+            models[regime_val] = update_expert(models[regime_val], new_df['feature'], new_df['label'],
+                                               params_map[regime_val], update_rounds)
+            fitted_until[regime_val] = limit
+            print(f"  {regime_name}: +{update_rounds} trees on {len(new_df)} new rows")
+
+        x_map = {regime_val: frame_map[regime_val].block(fold_start, fold_end)['feature'] for regime_val in dataset_map}
+        parts.append(predict_by_regime(models, x_map, regime))
+
+    # Experts as of the last fold (e.g. for the live bundle of daily_run.py)
+    return pd.concat(parts), models
+
+
+def _refit(frame, regime_val, regime_name, params, lo, split, hi):
+    # Fit from scratch on [lo, split) with early stopping on [split, hi)
+    train_df = frame.select(regime_val, lo, split)
+    valid_df = frame.block(split, hi)
+    if train_df.empty or valid_df.empty:
+        print(f"Warning: No data for {regime_name} regime. Skipping training.")
+        return None
+    print(f"Training {regime_name} Model ({len(train_df)} rows, {lo.date()} - {split.date()})...")
+    return fit_expert(train_df['feature'], train_df['label'], valid_df['feature'], valid_df['label'], params)